@@ -12,6 +12,7 @@ import logging
 import os
 
 from flye.utils.utils import which
+import flye.utils.telemetry as telemetry
 
 ASSEMBLE_BIN = "flye-assemble"
 logger = logging.getLogger()
@@ -58,7 +59,7 @@ def assemble(args, run_params, out_file, log_file, config_path):
 
     try:
         logger.debug("Running: " + " ".join(cmdline))
-        subprocess.check_call(cmdline)
+        telemetry.check_call(cmdline)
     except subprocess.CalledProcessError as e:
         if e.returncode == -9:
             logger.error("Looks like the system ran out of memory")
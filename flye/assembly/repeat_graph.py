@@ -12,6 +12,7 @@ import logging
 import os
 
 from flye.utils.utils import which
+import flye.utils.telemetry as telemetry
 
 REPEAT_BIN = "flye-repeat"
 CONTIGGER_BIN = "flye-contigger"
@@ -54,7 +55,7 @@ def analyse_repeats(args, run_params, input_assembly, out_folder,
 
     try:
         logger.debug("Running: " + " ".join(cmdline))
-        subprocess.check_call(cmdline)
+        telemetry.check_call(cmdline)
     except subprocess.CalledProcessError as e:
         if e.returncode == -9:
             logger.error("Looks like the system ran out of memory")
@@ -81,7 +82,7 @@ def generate_contigs(args, run_params, graph_edges, out_folder,
 
     try:
         logger.debug("Running: " + " ".join(cmdline))
-        subprocess.check_call(cmdline)
+        telemetry.check_call(cmdline)
     except subprocess.CalledProcessError as e:
         if e.returncode == -9:
             logger.error("Looks like the system ran out of memory")
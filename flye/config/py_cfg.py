@@ -41,6 +41,38 @@ vals = {
         "max_bubble_branches" : 50,
         "max_read_coverage" : 1000,
         "min_polish_aln_len" : 500,
+        "min_shard_length" : 100000,
+        #pass bubbles / consensus to flye-polish in the binary format
+        "binary_bubbles" : False,
+        #pipe bubbles into flye-polish while they are being generated
+        "stream_bubbles" : False,
+        #only re-polish the windows (extended by the margin) around
+        #the regions changed by the previous iteration
+        "incremental_polishing" : False,
+        "polish_window_margin" : 10000,
+        #stop polishing iterations once the fraction of bases changed
+        #by an iteration falls below this value (None: run all iterations)
+        "polish_min_change_rate" : None,
+        #subsample reads to the target coverage before the alignment
+        #(None: use all reads), if the estimated coverage is at least
+        #min_ratio times higher. Reads are selected by length or quality
+        "polish_subsample_coverage" : None,
+        "polish_subsample_min_ratio" : 1.5,
+        "polish_subsample_order" : "length",
+        #number of flye-polish processes per polishing iteration (each
+        #gets a group of bubble shards), and restarts of the failed ones
+        "polish_bin_shards" : 1,
+        "polish_bin_retries" : 1,
+        #generate polished graph edges by lifting their positions in contigs
+        #over the polishing changes (the rest are aligned to the contigs)
+        "polished_gfa_liftover" : False,
+
+        #minimap2 memory governor (off by default): the budget is either
+        #set explicitly (for example, "32G"), or "auto" for a fraction
+        #of the available memory
+        "minimap_memory_budget" : None,
+        "minimap_memory_fraction" : 0.9,
+        "minimap_oom_retries" : 2,
 
         #final coverage filtering
         "relative_minimum_coverage" : 5,
@@ -13,12 +13,15 @@ import os
 import logging
 import argparse
 import json
+import copy
 import shutil
 import subprocess
+import threading
 
 import flye.polishing.alignment as aln
 import flye.polishing.polish as pol
 import flye.polishing.consensus as cons
+from flye.polishing.subsample import subsample_reads
 import flye.assembly.assemble as asm
 import flye.assembly.repeat_graph as repeat
 import flye.assembly.scaffolder as scf
@@ -29,6 +32,11 @@ from flye.config.configurator import setup_params
 from flye.utils.bytes2human import human2bytes, bytes2human
 from flye.utils.sam_parser import AlignmentException
 import flye.utils.fasta_parser as fp
+import flye.utils.worker_pool as worker_pool
+import flye.utils.telemetry as telemetry
+import flye.utils.profiling as profiling
+from flye.utils.job_scheduler import JobScheduler
+from flye.utils.checkpoint import Checkpoint, write_state
 import flye.short_plasmids.plasmids as plas
 import flye.trestle.trestle as tres
 import flye.trestle.graph_resolver as tres_graph
@@ -43,25 +51,60 @@ class ResumeException(Exception):
 class Job(object):
     """
     Describes an abstract list of jobs with persistent
-    status that can be resumed
+    status that can be resumed. Jobs declare the files they read
+    (in_files) and produce (out_files), so independent jobs
+    can run concurrently (see JobScheduler)
     """
     run_params = {"stage_name" : ""}
+    #run_params are updated by the concurrent jobs
+    save_lock = threading.RLock()
+    #thread limit of the short jobs that run alongside the critical path
+    #(None: the job shares the thread budget, see JobScheduler)
+    max_threads = None
 
     def __init__(self):
         self.name = None
         self.args = None
         self.work_dir = None
+        self.in_files = {}
         self.out_files = {}
         self.log_file = None
 
     def run(self):
         logger.info(">>>STAGE: %s", self.name)
 
-    def save(self, save_file):
-        Job.run_params["stage_name"] = self.name
-
-        with open(save_file, "w") as f:
-            json.dump(Job.run_params, f)
+    def set_threads(self, num_threads):
+        """
+        Sets the job's share of the thread budget
+        """
+        if self.args.threads != num_threads:
+            self.args = copy.copy(self.args)
+            self.args.threads = num_threads
+
+    def save(self, save_file, completed_stages=()):
+        """
+        Saves this job as the one to resume from. Later jobs that
+        were already completed (concurrently) are listed separately
+        """
+        with Job.save_lock:
+            Job.run_params["stage_name"] = self.name
+            Job.run_params["completed_stages"] = list(completed_stages)
+            write_state(Job.run_params, save_file)
+
+    def checkpoint(self, save_file):
+        """
+        Progress within the job, which is saved with the run state
+        and kept until the job is completed
+        """
+        with Job.save_lock:
+            state = Job.run_params.setdefault("checkpoints", {}) \
+                                  .setdefault(self.name, {})
+        return Checkpoint(state, lambda: write_state(Job.run_params, save_file),
+                          Job.save_lock)
+
+    def clear_checkpoint(self):
+        with Job.save_lock:
+            Job.run_params.get("checkpoints", {}).pop(self.name, None)
 
     def load(self, save_file):
         with open(save_file, "r") as f:
@@ -89,6 +132,7 @@ class JobConfigure(Job):
         self.args = args
         self.work_dir = work_dir
         self.name = "configure"
+        self.out_files["params"] = os.path.join(work_dir, "params.json")
 
     def run(self):
         super(JobConfigure, self).run()
@@ -103,6 +147,7 @@ class JobAssembly(Job):
         self.args = args
         self.work_dir = work_dir
         self.log_file = log_file
+        self.in_files["params"] = os.path.join(work_dir, "params.json")
 
         self.name = "assembly"
         self.assembly_dir = os.path.join(self.work_dir, "00-assembly")
@@ -125,23 +170,22 @@ class JobAssembly(Job):
 
 
 class JobShortPlasmidsAssembly(Job):
-    def __init__(self, args, work_dir, contigs_file, repeat_graph,
-                 graph_edges):
+    #runs alongside the (much longer) repeat analysis
+    max_threads = 4
+
+    def __init__(self, args, work_dir, contigs_file):
         super(JobShortPlasmidsAssembly, self).__init__()
 
         self.args = args
-        self.work_dir = work_dir
         self.work_dir = os.path.join(work_dir, "22-plasmids")
         self.contigs_path = contigs_file
-        self.repeat_graph = repeat_graph
-        self.graph_edges = graph_edges
+        self.in_files["contigs"] = contigs_file
 
         self.name = "plasmids"
-        self.out_files["repeat_graph"] = os.path.join(self.work_dir,
-                                                      "repeat_graph_dump")
-        self.out_files["repeat_graph_edges"] = \
-            os.path.join(self.work_dir, "repeat_graph_edges.fasta")
-
+        self.out_files["plasmids"] = os.path.join(self.work_dir,
+                                                  "plasmids.fasta")
+        self.out_files["plasmids_stats"] = os.path.join(self.work_dir,
+                                                        "plasmids_stats.txt")
 
     def run(self):
         super(JobShortPlasmidsAssembly, self).run()
@@ -150,10 +194,37 @@ class JobShortPlasmidsAssembly(Job):
             os.mkdir(self.work_dir)
         plasmids = plas.assemble_short_plasmids(self.args, self.work_dir,
                                                 self.contigs_path)
+        plas.write_plasmids(plasmids, self.out_files["plasmids"],
+                            self.out_files["plasmids_stats"])
+
+
+class JobAddPlasmids(Job):
+    def __init__(self, args, work_dir, plasmids, plasmids_stats,
+                 repeat_graph, graph_edges):
+        super(JobAddPlasmids, self).__init__()
+
+        self.args = args
+        self.work_dir = os.path.join(work_dir, "22-plasmids")
+        self.in_files["plasmids"] = plasmids
+        self.in_files["plasmids_stats"] = plasmids_stats
+        self.in_files["repeat_graph"] = repeat_graph
+        self.in_files["graph_edges"] = graph_edges
+
+        self.name = "add_plasmids"
+        self.out_files["repeat_graph"] = os.path.join(self.work_dir,
+                                                      "repeat_graph_dump")
+        self.out_files["repeat_graph_edges"] = \
+            os.path.join(self.work_dir, "repeat_graph_edges.fasta")
+
+    def run(self):
+        super(JobAddPlasmids, self).run()
+        plasmids = plas.read_plasmids(self.in_files["plasmids"],
+                                      self.in_files["plasmids_stats"])
 
         #updating repeat graph
-        repeat_graph = RepeatGraph(fp.read_sequence_dict(self.graph_edges))
-        repeat_graph.load_from_file(self.repeat_graph)
+        repeat_graph = \
+            RepeatGraph(fp.read_sequence_dict(self.in_files["graph_edges"]))
+        repeat_graph.load_from_file(self.in_files["repeat_graph"])
         plas.update_graph(repeat_graph, plasmids)
         repeat_graph.dump_to_file(self.out_files["repeat_graph"])
         fp.write_fasta_dict(repeat_graph.edges_fasta,
@@ -169,6 +240,8 @@ class JobRepeat(Job):
         self.disjointigs = disjointigs
         self.log_file = log_file
         self.name = "repeat"
+        self.in_files["params"] = os.path.join(work_dir, "params.json")
+        self.in_files["disjointigs"] = disjointigs
 
         self.work_dir = os.path.join(work_dir, "20-repeat")
         self.out_files["repeat_graph"] = os.path.join(self.work_dir,
@@ -201,6 +274,10 @@ class JobContigger(Job):
         self.reads_alignment = reads_alignment
         self.log_file = log_file
         self.name = "contigger"
+        self.in_files["params"] = os.path.join(work_dir, "params.json")
+        self.in_files["repeat_graph_edges"] = repeat_graph_edges
+        self.in_files["repeat_graph"] = repeat_graph
+        self.in_files["reads_alignment"] = reads_alignment
 
         self.work_dir = os.path.join(work_dir, "30-contigger")
         self.out_files["contigs"] = os.path.join(self.work_dir,
@@ -254,6 +331,13 @@ class JobFinalize(Job):
         self.scaffold_links = scaffold_links
         self.polished_gfa = polished_gfa
         self.work_dir = work_dir
+        for name, path in [("contigs", contigs_file), ("graph", graph_file),
+                           ("repeat_stats", repeat_stats),
+                           ("polished_stats", polished_stats),
+                           ("polished_gfa", polished_gfa),
+                           ("scaffold_links", scaffold_links)]:
+            if path is not None:
+                self.in_files[name] = path
 
         #self.out_files["contigs"] = os.path.join(work_dir, "contigs.fasta")
         #self.out_files["scaffolds"] = os.path.join(work_dir, "scaffolds.fasta")
@@ -298,6 +382,7 @@ class JobConsensus(Job):
         self.consensus_dir = os.path.join(work_dir, "10-consensus")
         self.out_consensus = os.path.join(self.consensus_dir, "consensus.fasta")
         self.name = "consensus"
+        self.in_files["contigs"] = in_contigs
         self.out_files["consensus"] = self.out_consensus
 
     def run(self):
@@ -312,28 +397,39 @@ class JobConsensus(Job):
                                        CHUNK_SIZE)
         fp.write_fasta_dict(chunks, chunks_file)
 
+        reads = self.args.reads
+        reads_subset = os.path.join(self.consensus_dir, "reads_subset.fasta")
+        if subsample_reads(reads, self.in_contigs, reads_subset):
+            reads = [reads_subset]
+        else:
+            reads_subset = None
+
         logger.info("Running Minimap2")
         out_alignment = os.path.join(self.consensus_dir, "minimap.sam")
-        aln.make_alignment(chunks_file, self.args.reads, self.args.threads,
-                           self.consensus_dir, self.args.platform, out_alignment,
-                           reference_mode=True, sam_output=True)
+        sam_sorter = aln.make_alignment(chunks_file, reads,
+                                        self.args.threads, self.consensus_dir,
+                                        self.args.platform, out_alignment,
+                                        reference_mode=True, sam_output=True,
+                                        stream_sorting=True)
 
         contigs_info = aln.get_contigs_info(chunks_file)
         logger.info("Computing consensus")
         consensus_fasta = cons.get_consensus(out_alignment, chunks_file,
                                              contigs_info, self.args.threads,
-                                             self.args.platform)
+                                             self.args.platform, sam_sorter)
 
         #merge chunks back into single sequences
         merged_fasta = aln.merge_chunks(consensus_fasta)
         fp.write_fasta_dict(merged_fasta, self.out_consensus)
         os.remove(chunks_file)
         os.remove(out_alignment)
+        if reads_subset:
+            os.remove(reads_subset)
 
 
 class JobPolishing(Job):
     def __init__(self, args, work_dir, log_file, in_contigs, in_graph_edges,
-                 in_graph_gfa):
+                 in_graph_gfa, in_contigs_stats):
         super(JobPolishing, self).__init__()
 
         self.args = args
@@ -341,7 +437,13 @@ class JobPolishing(Job):
         self.in_contigs = in_contigs
         self.in_graph_edges = in_graph_edges
         self.in_graph_gfa = in_graph_gfa
+        self.in_contigs_stats = in_contigs_stats
         self.polishing_dir = os.path.join(work_dir, "40-polishing")
+        self.save_file = os.path.join(work_dir, "params.json")
+        self.in_files["contigs"] = in_contigs
+        self.in_files["graph_edges"] = in_graph_edges
+        self.in_files["graph_gfa"] = in_graph_gfa
+        self.in_files["contigs_stats"] = in_contigs_stats
 
         self.name = "polishing"
         final_contigs = os.path.join(self.polishing_dir,
@@ -357,10 +459,16 @@ class JobPolishing(Job):
         if not os.path.isdir(self.polishing_dir):
             os.mkdir(self.polishing_dir)
 
+        edge_positions = None
+        if cfg.vals["polished_gfa_liftover"]:
+            edge_positions = pol.locate_edges(self.in_graph_edges,
+                                              self.in_contigs,
+                                              self.in_contigs_stats)
         contigs, stats = \
             pol.polish(self.in_contigs, self.args.reads, self.polishing_dir,
                        self.args.num_iters, self.args.threads, self.args.platform,
-                       output_progress=True)
+                       output_progress=True, liftover=edge_positions,
+                       checkpoint=self.checkpoint(self.save_file))
         #contigs = os.path.join(self.polishing_dir, "polished_1.fasta")
         #stats = os.path.join(self.polishing_dir, "contigs_stats.txt")
         pol.filter_by_coverage(self.args, stats, contigs,
@@ -368,7 +476,7 @@ class JobPolishing(Job):
         pol.generate_polished_edges(self.in_graph_edges, self.in_graph_gfa,
                                     self.out_files["contigs"],
                                     self.polishing_dir, self.args.platform,
-                                    self.args.threads)
+                                    self.args.threads, edge_positions)
         os.remove(contigs)
 
 
@@ -379,11 +487,15 @@ class JobTrestle(Job):
 
         self.args = args
         self.work_dir = os.path.join(work_dir, "21-trestle")
+        self.save_file = os.path.join(work_dir, "params.json")
         self.log_file = log_file
         #self.repeats_dump = repeats_dump
         self.graph_edges = graph_edges
         self.repeat_graph = repeat_graph
         self.reads_alignment_file = reads_alignment_file
+        self.in_files["repeat_graph"] = repeat_graph
+        self.in_files["graph_edges"] = graph_edges
+        self.in_files["reads_alignment"] = reads_alignment_file
 
         self.name = "trestle"
         self.out_files["repeat_graph"] = os.path.join(self.work_dir,
@@ -411,7 +523,8 @@ class JobTrestle(Job):
                                     os.path.join(self.work_dir, "repeats_dump"))
 
             tres.resolve_repeats(self.args, self.work_dir, repeats_info,
-                                 summary_file, resolved_repeats_seqs)
+                                 summary_file, resolved_repeats_seqs,
+                                 self.checkpoint(self.save_file))
             tres_graph.apply_changes(repeat_graph, summary_file,
                                      fp.read_sequence_dict(resolved_repeats_seqs))
         except KeyboardInterrupt as e:
@@ -428,7 +541,8 @@ class JobTrestle(Job):
 
 def _create_job_list(args, work_dir, log_file):
     """
-    Build pipeline as a list of consecutive jobs
+    Build pipeline as a list of jobs (in a valid execution order),
+    the dependencies are given by the jobs' input and output files
     """
     jobs = []
 
@@ -459,10 +573,14 @@ def _create_job_list(args, work_dir, log_file):
         repeat_graph_edges = jobs[-1].out_files["repeat_graph_edges"]
         repeat_graph = jobs[-1].out_files["repeat_graph"]
 
-    #Short plasmids
+    #Short plasmids: only depend on the disjointigs,
+    #and are added to the graph once it is resolved
     if args.plasmids:
-        jobs.append(JobShortPlasmidsAssembly(args, work_dir, disjointigs,
-                                             repeat_graph, repeat_graph_edges))
+        jobs.append(JobShortPlasmidsAssembly(args, work_dir, disjointigs))
+        plasmids = jobs[-1].out_files["plasmids"]
+        plasmids_stats = jobs[-1].out_files["plasmids_stats"]
+        jobs.append(JobAddPlasmids(args, work_dir, plasmids, plasmids_stats,
+                                   repeat_graph, repeat_graph_edges))
         repeat_graph_edges = jobs[-1].out_files["repeat_graph_edges"]
         repeat_graph = jobs[-1].out_files["repeat_graph"]
 
@@ -482,7 +600,7 @@ def _create_job_list(args, work_dir, log_file):
     polished_gfa = gfa_file
     if args.num_iters > 0:
         jobs.append(JobPolishing(args, work_dir, log_file, raw_contigs,
-                                 final_graph_edges, gfa_file))
+                                 final_graph_edges, gfa_file, repeat_stats))
         contigs_file = jobs[-1].out_files["contigs"]
         polished_stats = jobs[-1].out_files["stats"]
         polished_gfa = jobs[-1].out_files["polished_gfa"]
@@ -512,9 +630,27 @@ def _run_polisher_only(args):
     logger.info("Running Flye polisher")
     logger.debug("Cmd: %s", " ".join(sys.argv))
 
-    pol.polish(args.polish_target, args.reads, args.out_dir,
-               args.num_iters, args.threads, args.platform,
-               output_progress=True)
+    if args.profile:
+        profiling.enable(os.path.join(args.out_dir, "profiles"))
+    worker_pool.start_pool(args.threads)
+    try:
+        with telemetry.stage("polishing"):
+            if args.polish_regions:
+                pol.polish_regions(args.polish_target, args.polish_regions,
+                                   args.reads, args.out_dir, args.num_iters,
+                                   args.threads, args.platform,
+                                   output_progress=True)
+            else:
+                pol.polish(args.polish_target, args.reads, args.out_dir,
+                           args.num_iters, args.threads, args.platform,
+                           output_progress=True)
+    except BaseException:
+        worker_pool.stop_pool(terminate=True)
+        raise
+    finally:
+        if args.profile:
+            profiling.write_all()
+    worker_pool.stop_pool()
 
 
 def _run(args):
@@ -530,6 +666,7 @@ def _run(args):
             raise ResumeException("Can't open " + read_file)
 
     save_file = os.path.join(args.out_dir, "params.json")
+    metrics_file = os.path.join(args.out_dir, "run_metrics.json")
     jobs = _create_job_list(args, args.out_dir, args.log_file)
 
     if args.stop_after and not args.stop_after in [j.name for j in jobs]:
@@ -537,24 +674,24 @@ def _run(args):
                                 .format(args.stop_after))
 
     current_job = 0
+    completed_stages = set()
     if args.resume or args.resume_from:
         if not os.path.exists(save_file):
             raise ResumeException("Can't find save file")
 
         logger.info("Resuming previous run")
+        saved_state = json.load(open(save_file, "r"))
         if args.resume_from:
             job_to_resume = args.resume_from
         else:
-            job_to_resume = json.load(open(save_file, "r"))["stage_name"]
+            job_to_resume = saved_state["stage_name"]
+            completed_stages = set(saved_state.get("completed_stages", []))
 
         can_resume = False
         for i in range(len(jobs)):
             if jobs[i].name == job_to_resume:
                 jobs[i].load(save_file)
                 current_job = i
-                if not jobs[i - 1].completed(save_file):
-                    raise ResumeException("Can't resume: stage '{0}' incomplete"
-                                          .format(jobs[i - 1].name))
                 can_resume = True
                 break
 
@@ -562,14 +699,72 @@ def _run(args):
             raise ResumeException("Can't resume: stage {0} does not exist"
                                   .format(job_to_resume))
 
-    for i in range(current_job, len(jobs)):
-        jobs[i].save(save_file)
-        jobs[i].run()
-        if args.stop_after == jobs[i].name:
-            if i + 1 < len(jobs):
-                jobs[i + 1].save(save_file)
+    #jobs that were completed concurrently with the ones
+    #before the resumed stage are not repeated
+    finished = set(j.name for j in jobs[:current_job])
+    for job in jobs[current_job:]:
+        if job.name in completed_stages and job.completed(save_file):
+            finished.add(job.name)
+    to_run = [j for j in jobs[current_job:] if not j.name in finished]
+    #--resume continues the interrupted stages from their checkpoints,
+    #while --resume-from runs the stages from the beginning
+    if args.resume_from:
+        for job in to_run:
+            job.clear_checkpoint()
+
+    if args.stop_after:
+        stop_job = [j.name for j in jobs].index(args.stop_after)
+        if stop_job >= current_job:
+            to_run = [j for j in to_run if jobs.index(j) <= stop_job]
+
+    required_files = set(f for j in to_run for f in j.in_files.values())
+    for job in jobs:
+        if job in to_run or not required_files & set(job.out_files.values()):
+            continue
+        if not job.completed(save_file):
+            raise ResumeException("Can't resume: stage '{0}' incomplete"
+                                  .format(job.name))
+
+    #resource usage of the stages, appended to the previous runs if resumed
+    previous_runs = []
+    if args.resume or args.resume_from:
+        previous_runs = telemetry.read_previous_runs(metrics_file)
+    telemetry.start_run()
+
+    def save_state(finished_job=None):
+        if finished_job is not None:
+            finished.add(finished_job.name)
+            finished_job.clear_checkpoint()
+            telemetry.write_metrics(metrics_file, args.threads, previous_runs)
+            if args.profile:
+                profiling.write_stage(finished_job.name)
+        pending = [i for i, j in enumerate(jobs) if not j.name in finished]
+        resume_job = pending[0] if pending else len(jobs) - 1
+        jobs[resume_job].save(save_file,
+                              [j.name for j in jobs[resume_job + 1:]
+                               if j.name in finished])
+
+    #profiling is set up before the workers are forked
+    if args.profile:
+        profiling.enable(os.path.join(args.out_dir, "profiles"))
+    #worker processes are forked once and shared by all parallel stages
+    worker_pool.start_pool(args.threads)
+    try:
+        save_state()
+        JobScheduler(to_run, args.threads) \
+            .run(on_finish=save_state,
+                 job_context=lambda job: telemetry.stage(job.name))
+        if args.stop_after and len(finished) < len(jobs):
             logger.info("Pipeline stopped as requested by --stop-after")
-            break
+    except BaseException:
+        worker_pool.stop_pool(terminate=True)
+        telemetry.write_metrics(metrics_file, args.threads, previous_runs)
+        if args.profile:
+            profiling.write_all()
+        raise
+    #the workers' usage is only accounted once they have exited
+    worker_pool.stop_pool()
+    telemetry.write_metrics(metrics_file, args.threads, previous_runs)
 
 
 def _enable_logging(log_file, debug, overwrite):
@@ -602,7 +797,7 @@ def _usage():
             "\t     [--threads int] [--iterations int] [--min-overlap int]\n"
             "\t     [--meta] [--plasmids] [--no-trestle] [--polish-target]\n"
             "\t     [--keep-haplotypes] [--debug] [--version] [--help] \n"
-            "\t     [--resume] [--resume-from] [--stop-after]")
+            "\t     [--resume] [--resume-from] [--stop-after] [--profile]")
 
 
 def _epilog():
@@ -625,7 +820,8 @@ def _epilog():
             "assembly by specifying --asm-coverage option. Typically,\n"
             "30x coverage is enough to produce good disjointigs.\n\n"
             "You can separately run Flye polisher on a target sequence \n"
-            "using --polish-target option.")
+            "using --polish-target option. With --polish-regions, only\n"
+            "the given regions of the target are polished.")
 
 
 def _version():
@@ -708,6 +904,10 @@ def main():
     parser.add_argument("--polish-target", dest="polish_target",
                         metavar="path", required=False,
                         help="run polisher on the target sequence")
+    parser.add_argument("--polish-regions", dest="polish_regions",
+                        metavar="path", required=False,
+                        help="only polish these regions of the target "
+                        "(BED file or list of contig names)")
     parser.add_argument("--resume", action="store_true",
                         dest="resume", default=False,
                         help="resume from the last completed stage")
@@ -721,12 +921,19 @@ def main():
     parser.add_argument("--debug", action="store_true",
                         dest="debug", default=False,
                         help="enable debug output")
+    parser.add_argument("--profile", action="store_true",
+                        dest="profile", default=False,
+                        help="profile the worker processes by sampling "
+                        "their stacks (low overhead), the profiles "
+                        "are saved into the 'profiles' directory")
     parser.add_argument("-v", "--version", action="version", version=_version())
     args = parser.parse_args()
 
     if not args.genome_size and not args.polish_target:
         parser.error("Genome size argument (-g/--genome-size) "
                      "is required for assembly")
+    if args.polish_regions and not args.polish_target:
+        parser.error("--polish-regions requires --polish-target")
 
     if args.pacbio_raw:
         args.reads = args.pacbio_raw
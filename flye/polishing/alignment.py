@@ -9,12 +9,16 @@ Runs Minimap2 and parses its output
 from __future__ import absolute_import
 from __future__ import division
 import os
+import re
 from collections import namedtuple
 import subprocess
 import logging
 
 import flye.utils.fasta_parser as fp
+import flye.config.py_cfg as cfg
 from flye.utils.utils import which
+import flye.utils.telemetry as telemetry
+from flye.utils.bytes2human import bytes2human, human2bytes
 from flye.utils.sam_parser import AlignmentException, preprocess_sam
 from flye.six import iteritems
 from flye.six.moves import range
@@ -23,6 +27,19 @@ from flye.six.moves import range
 logger = logging.getLogger()
 MINIMAP_BIN = "flye-minimap2"
 
+#minimap2 defaults and the lower limits for the memory governor
+MINIMAP_BATCH_SIZE = 500000000
+MINIMAP_INDEX_SIZE = 4000000000
+MINIMAP_MIN_BATCH = 10000000
+MINIMAP_MIN_INDEX = 100000000
+#min secondary-to-primary score ratio and max secondary alignments
+MINIMAP_SECONDARY_RATIO = 0.5
+MINIMAP_MAX_SECONDARY = 10
+
+_GAP_RUN = re.compile(r"-+")
+#reads file (path, size, modification time) -> estimated N50
+_read_n50_cache = {}
+
 
 ContigInfo = namedtuple("ContigInfo", ["id", "length", "type"])
 
@@ -36,28 +53,41 @@ def check_binaries():
 
 def make_alignment(reference_file, reads_file, num_proc,
                    work_dir, platform, out_alignment, reference_mode,
-                   sam_output):
+                   sam_output, stream_sorting=False, group_separator=None):
     """
-    Runs minimap2 and sorts its output
+    Runs minimap2 and sorts its output. If stream_sorting is set,
+    returns SamSorter that will do the sorting while the
+    alignment is being processed (see SynchronizedSamReader).
+    If group_separator is given, the reads are only aligned to the
+    contigs of their own group (see polish.polish_batch)
     """
     minimap_ref_mode = {False: "ava", True: "map"}
     minimap_reads_mode = {"nano": "ont", "pacbio": "pb"}
     mode = minimap_ref_mode[reference_mode] + "-" + minimap_reads_mode[platform]
 
+    num_groups = 1
+    if group_separator is not None:
+        num_groups = len(set(hdr.split(group_separator, 1)[0] for hdr
+                             in fp.read_sequence_lengths(reference_file)))
     _run_minimap(reference_file, reads_file, num_proc, mode,
-                 out_alignment, sam_output)
+                 out_alignment, sam_output, num_groups)
 
     if sam_output:
-        preprocess_sam(out_alignment, work_dir)
+        group_filter = None
+        if group_separator is not None:
+            group_filter = (group_separator, MINIMAP_SECONDARY_RATIO,
+                            MINIMAP_MAX_SECONDARY)
+        return preprocess_sam(out_alignment, work_dir, stream_sorting,
+                              group_filter)
+    return None
 
 
 def get_contigs_info(contigs_file):
     contigs_info = {}
-    contigs_fasta = fp.read_sequence_dict(contigs_file)
-    for ctg_id, ctg_seq in iteritems(contigs_fasta):
+    contigs_lengths = fp.read_sequence_lengths(contigs_file)
+    for ctg_id, ctg_len in iteritems(contigs_lengths):
         contig_type = ctg_id.split("_")[0]
-        contigs_info[ctg_id] = ContigInfo(ctg_id, len(ctg_seq),
-                                          contig_type)
+        contigs_info[ctg_id] = ContigInfo(ctg_id, ctg_len, contig_type)
 
     return contigs_info
 
@@ -67,32 +97,29 @@ def shift_gaps(seq_trg, seq_qry):
     Shifts all ambigious query gaps to the right
     """
     lst_trg, lst_qry = list("$" + seq_trg + "$"), list("$" + seq_qry + "$")
-    is_gap = False
-    gap_start = 0
-    for i in range(len(lst_trg)):
-        if is_gap and lst_qry[i] != "-":
-            is_gap = False
-            swap_left = gap_start - 1
-            swap_right = i - 1
-
-            while (swap_left > 0 and swap_right >= gap_start and
-                   lst_qry[swap_left] == lst_trg[swap_right]):
-                lst_qry[swap_left], lst_qry[swap_right] = \
-                            lst_qry[swap_right], lst_qry[swap_left]
-                swap_left -= 1
-                swap_right -= 1
-
-        if not is_gap and lst_qry[i] == "-":
-            is_gap = True
-            gap_start = i
+    #swaps only touch the positions to the left of the current gap end,
+    #so the gap runs could be found in the original string
+    for gap in _GAP_RUN.finditer(seq_qry):
+        gap_start = gap.start() + 1
+        swap_left = gap_start - 1
+        swap_right = gap.end()
+
+        while (swap_left > 0 and swap_right >= gap_start and
+               lst_qry[swap_left] == lst_trg[swap_right]):
+            lst_qry[swap_left], lst_qry[swap_right] = \
+                        lst_qry[swap_right], lst_qry[swap_left]
+            swap_left -= 1
+            swap_right -= 1
 
     return "".join(lst_qry[1 : -1])
 
 
-def get_uniform_alignments(alignments, seq_len):
+def get_uniform_alignments(alignments, seq_len, region_start=0,
+                           region_end=None):
     """
     Leaves top alignments for each position within contig
-    assuming uniform coverage distribution
+    assuming uniform coverage distribution. If the region is given,
+    only the windows inside the region are considered
     """
     def _get_median(lst):
         if not lst:
@@ -109,13 +136,29 @@ def get_uniform_alignments(alignments, seq_len):
     MIN_COV = 10
     COV_RATE = 1.25
 
+    if region_end is None:
+        region_end = seq_len
+    first_wnd = region_start // WINDOW
+    last_wnd = min(region_end, seq_len) // WINDOW
+    num_windows = last_wnd - first_wnd + 1
+
+    def _windows(aln):
+        windows = range(max(aln.trg_start // WINDOW, first_wnd) - first_wnd,
+                        min(aln.trg_end // WINDOW, last_wnd + 1) - first_wnd)
+        if aln.trg_end <= seq_len:
+            return windows
+        #the part that wraps around the contig origin
+        wrap_end = (aln.trg_end - seq_len) // WINDOW
+        return sorted(set(windows) |
+                      set(range(0, min(wrap_end, last_wnd + 1) - first_wnd)))
+
     #split contig into windows, get median read coverage over all windows and
     #determine the quality threshold cutoffs for each window
-    wnd_primary_cov = [0 for _ in range(seq_len // WINDOW + 1)]
-    wnd_aln_quality = [[] for _ in range(seq_len // WINDOW + 1)]
-    wnd_qual_thresholds = [1.0 for _ in range(seq_len // WINDOW + 1)]
+    wnd_primary_cov = [0 for _ in range(num_windows)]
+    wnd_aln_quality = [[] for _ in range(num_windows)]
+    wnd_qual_thresholds = [1.0 for _ in range(num_windows)]
     for aln in alignments:
-        for i in range(aln.trg_start // WINDOW, aln.trg_end // WINDOW):
+        for i in _windows(aln):
             if not aln.is_secondary:
                 wnd_primary_cov[i] += 1
             wnd_aln_quality[i].append(aln.err_rate)
@@ -132,9 +175,9 @@ def get_uniform_alignments(alignments, seq_len):
     filtered_sequence = 0
     for aln in alignments:
         good_windows = 0
-        total_windows = aln.trg_end // WINDOW - aln.trg_start // WINDOW
+        total_windows = len(_windows(aln))
         total_sequence += aln.trg_end - aln.trg_start
-        for i in range(aln.trg_start // WINDOW, aln.trg_end // WINDOW):
+        for i in _windows(aln):
             if aln.err_rate <= wnd_qual_thresholds[i]:
                 good_windows += 1
 
@@ -167,6 +210,21 @@ def split_into_chunks(fasta_in, chunk_size):
     return out_dict
 
 
+def get_shard_length(contigs_info, num_proc):
+    """
+    Selects the length of contig shards for the parallel processing,
+    so that the work is split into enough pieces to keep all
+    the workers busy. Returns None if sharding is not needed
+    """
+    SHARDS_PER_WORKER = 2
+    if num_proc == 1 or not contigs_info:
+        return None
+
+    total_length = sum(c.length for c in contigs_info.values())
+    return max(cfg.vals["min_shard_length"],
+               total_length // (num_proc * SHARDS_PER_WORKER))
+
+
 def merge_chunks(fasta_in, fold_function=lambda l: "".join(l)):
     """
     Merges sequence chunks. Chunk names are in format `orig_name$chunk_id`.
@@ -196,21 +254,223 @@ def merge_chunks(fasta_in, fold_function=lambda l: "".join(l)):
 
 
 def _run_minimap(reference_file, reads_files, num_proc, mode, out_file,
-                 sam_output):
-    cmdline = [MINIMAP_BIN, reference_file]
-    cmdline.extend(reads_files)
-    cmdline.extend(["-x", mode, "-t", str(num_proc)])
+                 sam_output, num_groups=1):
+    """
+    With several groups of contigs, all secondary alignments (up to the
+    limit per group) are reported, so the best alignment within
+    each group could be selected later (see preprocess_sam)
+    """
+    #all-vs-all mode could split the index into parts, while in the
+    #reference mode the whole reference should be indexed at once
+    split_index = mode.startswith("ava")
+    ref_size = _estimate_num_bases(reference_file)
+    mem_budget = _minimap_memory_budget()
+    read_n50 = (_estimate_read_n50(reads_files) if mem_budget is not None
+                else 0)
+    batch_size, index_size, num_threads = \
+        _fit_minimap_resources(ref_size, read_n50, num_proc, split_index,
+                               sam_output, mem_budget)
+
+    max_retries = cfg.vals["minimap_oom_retries"]
+    for attempt in range(max_retries + 1):
+        cmdline = [MINIMAP_BIN, reference_file]
+        cmdline.extend(reads_files)
+        cmdline.extend(["-x", mode, "-t", str(num_threads)])
+        if batch_size != MINIMAP_BATCH_SIZE:
+            cmdline.extend(["-K", str(batch_size)])
+        if split_index and index_size != MINIMAP_INDEX_SIZE:
+            cmdline.extend(["-I", str(index_size)])
+        if sam_output:
+            #a = SAM output, p = min primary-to-seconday score
+            #N = max secondary alignments
+            if num_groups > 1:
+                max_secondary = (MINIMAP_MAX_SECONDARY + 1) * num_groups - 1
+                cmdline.extend(["-a", "-p", "0", "-N", str(max_secondary)])
+            else:
+                cmdline.extend(["-a", "-p", str(MINIMAP_SECONDARY_RATIO),
+                                "-N", str(MINIMAP_MAX_SECONDARY)])
+
+        try:
+            devnull = open(os.devnull, "wb")
+            #logger.debug("Running: " + " ".join(cmdline))
+            telemetry.check_call(cmdline, stderr=devnull,
+                                 stdout=open(out_file, "wb"))
+            return
+
+        except subprocess.CalledProcessError as e:
+            if e.returncode == -9:
+                logger.error("Looks like the system ran out of memory")
+                if attempt < max_retries:
+                    #shrinking the footprint and trying again
+                    batch_size = max(batch_size // 4, MINIMAP_MIN_BATCH)
+                    num_threads = max(num_threads // 2, 1)
+                    if split_index:
+                        index_size = max(min(index_size, ref_size) // 2,
+                                         MINIMAP_MIN_INDEX)
+                    logger.warning("Restarting minimap2 with %d threads, "
+                                   "batch size %s", num_threads,
+                                   bytes2human(batch_size))
+                    continue
+            raise AlignmentException(str(e))
+
+        except OSError as e:
+            raise AlignmentException(str(e))
+
+
+def _fit_minimap_resources(ref_size, read_n50, num_proc, split_index,
+                           sam_output, mem_budget):
+    """
+    Selects minimap2 batch size, index size and number of threads
+    so that the estimated peak memory fits the budget. The index size
+    is MINIMAP_INDEX_SIZE (the default) unless it had to be reduced
+    """
+    batch_size = MINIMAP_BATCH_SIZE
+    num_threads = num_proc
+    if mem_budget is None:
+        return batch_size, MINIMAP_INDEX_SIZE, num_threads
+
+    full_index = (min(ref_size, MINIMAP_INDEX_SIZE) if split_index
+                  else ref_size)
+    index_size = full_index
+
+    def _estimate():
+        return _estimate_minimap_memory(index_size, read_n50, num_threads,
+                                        batch_size, sam_output)
+
+    #if even the smallest footprint does not fit, reducing
+    #the number of threads will not help
+    min_index = (min(index_size, MINIMAP_MIN_INDEX) if split_index
+                 else index_size)
+    min_footprint = _estimate_minimap_memory(min_index, read_n50, 1,
+                                             MINIMAP_MIN_BATCH, sam_output)
+    if min_footprint > mem_budget:
+        logger.warning("Alignment might not fit into the memory budget: "
+                       "%s estimated, %s available, running minimap2 "
+                       "with 1 thread", bytes2human(min_footprint),
+                       bytes2human(mem_budget))
+        if min_index == full_index:
+            min_index = MINIMAP_INDEX_SIZE
+        return MINIMAP_MIN_BATCH, min_index, 1
+
+    while _estimate() > mem_budget:
+        if batch_size > MINIMAP_MIN_BATCH:
+            batch_size = max(batch_size // 2, MINIMAP_MIN_BATCH)
+        elif split_index and index_size > MINIMAP_MIN_INDEX:
+            index_size = max(index_size // 2, MINIMAP_MIN_INDEX)
+        else:
+            num_threads -= 1
+
+    if (batch_size != MINIMAP_BATCH_SIZE or num_threads != num_proc or
+            index_size != full_index):
+        logger.debug("Minimap2 memory estimate: %s (budget %s), using %d "
+                     "threads, batch size %s, index size %s",
+                     bytes2human(_estimate()), bytes2human(mem_budget),
+                     num_threads, bytes2human(batch_size),
+                     bytes2human(index_size))
+    if index_size == full_index:
+        index_size = MINIMAP_INDEX_SIZE
+    return batch_size, index_size, num_threads
+
+
+def _estimate_minimap_memory(index_size, read_n50, num_threads, batch_size,
+                             sam_output):
+    """
+    Rough estimate of minimap2 peak memory (in bytes)
+    """
+    INDEX_BYTES_PER_BASE = 6        #sequence + minimizers + hash tables
+    BATCHES_IN_FLIGHT = 3           #reading / mapping / output pipeline
+    SAM_OUTPUT_FACTOR = 2           #output records with sequences
+    THREAD_BASE = 64 * 1024 ** 2
+    THREAD_BYTES_PER_READ_BASE = 2000   #chaining / DP buffers
+
+    batch_factor = BATCHES_IN_FLIGHT
     if sam_output:
-        #a = SAM output, p = min primary-to-seconday score
-        #N = max secondary alignments
-        cmdline.extend(["-a", "-p", "0.5", "-N", "10"])
+        batch_factor *= SAM_OUTPUT_FACTOR
+    per_thread = THREAD_BASE + read_n50 * THREAD_BYTES_PER_READ_BASE
+
+    return (index_size * INDEX_BYTES_PER_BASE + batch_size * batch_factor +
+            num_threads * per_thread)
+
+
+def _minimap_memory_budget():
+    """
+    Returns memory budget for minimap2 in bytes, or None if the
+    governor is off (or the available memory is unknown)
+    """
+    budget = cfg.vals["minimap_memory_budget"]
+    if budget is None:
+        return None
+    budget = str(budget)
+    if budget != "auto":
+        if budget.isdigit():
+            return int(budget)
+        return human2bytes(budget.upper())
+
+    available = _get_available_memory()
+    if available is None:
+        return None
+    return int(available * cfg.vals["minimap_memory_fraction"])
+
+
+def _get_available_memory():
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
 
+def _estimate_num_bases(fasta_file):
+    """
+    Approximates number of bases from the file size
+    """
+    GZIP_RATE = 4
+    file_size = os.path.getsize(fasta_file)
+    if fasta_file.endswith(".gz"):
+        file_size *= GZIP_RATE
+    return file_size
+
+
+def _estimate_read_n50(reads_files):
+    """
+    Estimates reads N50 from the first reads of the input. The estimate
+    is computed once per reads file (the same reads are aligned at
+    every polishing iteration)
+    """
+    try:
+        stat = os.stat(reads_files[0])
+        file_key = (os.path.abspath(reads_files[0]), stat.st_size,
+                    stat.st_mtime)
+    except OSError:
+        file_key = None
+    if file_key in _read_n50_cache:
+        return _read_n50_cache[file_key]
+
+    read_n50 = _sample_read_n50(reads_files[0])
+    if file_key is not None:
+        _read_n50_cache[file_key] = read_n50
+    return read_n50
+
+
+def _sample_read_n50(reads_file):
+    SAMPLE_BASES = 100000000
+    read_lengths = []
+    sampled_bases = 0
     try:
-        devnull = open(os.devnull, "wb")
-        #logger.debug("Running: " + " ".join(cmdline))
-        subprocess.check_call(cmdline, stderr=devnull,
-                              stdout=open(out_file, "wb"))
-    except (subprocess.CalledProcessError, OSError) as e:
-        if e.returncode == -9:
-            logger.error("Looks like the system ran out of memory")
-        raise AlignmentException(str(e))
+        for _, seq in fp.stream_sequence(reads_file):
+            read_lengths.append(len(seq))
+            sampled_bases += len(seq)
+            if sampled_bases > SAMPLE_BASES:
+                break
+    except fp.FastaError:
+        return 0
+
+    sum_len = 0
+    for l in sorted(read_lengths, reverse=True):
+        sum_len += l
+        if sum_len > sampled_bases // 2:
+            return l
+    return 0
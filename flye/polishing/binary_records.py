@@ -0,0 +1,164 @@
+#(c) 2020 by Authors
+#This file is a part of Flye program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Compact binary format for the bubbles and consensus files,
+which are passed between the Python code and flye-polish.
+
+A file starts with an 8-byte magic string, followed by the records.
+Each record starts with a one-byte tag, all integers are little-endian:
+
+  bubble:    'B' | u32 header_len | header | i64 position | u32 num_branches |
+             packed consensus | packed branch * num_branches
+  consensus: 'C' | u32 header_len | header | i64 position | u32 num_branches |
+             u32 seq_len | seq
+
+The records are followed by the index with the record offsets:
+  'I' | u64 num_records | u64 offset * num_records
+The index is optional: it is not written into the streams and
+into the files that are appended to (see BinaryRecordsWriter).
+
+Bubble sequences are packed as u32 seq_len | u8 encoding | payload.
+Sequences that only contain ACGT are stored in 2 bits per base
+(base i is in bits 2*(i%4) of byte i/4, A=0 C=1 G=2 T=3), others
+are stored as raw bytes. Consensus sequences are always raw.
+"""
+
+from __future__ import absolute_import
+import struct
+import sys
+from binascii import hexlify, unhexlify
+
+if sys.version_info < (3, 0):
+    _bytes_to_int = lambda x: int(hexlify(x), 16) if x else 0
+    _int_to_bytes = lambda x, length: unhexlify("{0:0{1}x}".format(x, length * 2))
+else:
+    _bytes_to_int = lambda x: int.from_bytes(x, "big")
+    _int_to_bytes = lambda x, length: x.to_bytes(length, "big")
+
+BUBBLES_MAGIC = b"FLYEBUB1"
+CONSENSUS_MAGIC = b"FLYECNS1"
+
+_BUBBLE_TAG = b"B"
+_CONSENSUS_TAG = b"C"
+_INDEX_TAG = b"I"
+
+_RAW = 0
+_TWO_BIT = 1
+
+_LENGTH = struct.Struct("<I")
+_SEQ_HEAD = struct.Struct("<IB")
+_RECORD_HEAD = struct.Struct("<qI")
+_INDEX_HEAD = struct.Struct("<Q")
+
+
+def _two_bit_tables():
+    #a table per base position within a byte
+    tables = []
+    for shift in range(0, 8, 2):
+        table = bytearray(256)
+        for code, nucl in enumerate("ACGT"):
+            table[ord(nucl)] = code << shift
+        tables.append(bytes(table))
+    return tables
+_TWO_BIT_TABLES = _two_bit_tables()
+
+
+class BinaryRecordsWriter(object):
+    """
+    Writes records into a binary file. The magic string and the index
+    are only written if there was at least one record, so the file
+    without records stays empty. In the append mode, the records are
+    added to the existing file and the index is not written
+    """
+    def __init__(self, path, magic, buffering=-1, append=False):
+        self.stream = open(path, "ab" if append else "wb", buffering)
+        self.magic = magic
+        self.append = append
+        self.offsets = []
+        self.file_pos = self.stream.tell()
+
+    def write(self, records):
+        """
+        Writes the list of packed records (with a single write)
+        """
+        if not records:
+            return
+        if self.file_pos == 0:
+            self.stream.write(self.magic)
+            self.file_pos = len(self.magic)
+        for rec in records:
+            self.offsets.append(self.file_pos)
+            self.file_pos += len(rec)
+        self.stream.write(b"".join(records))
+
+    def close(self):
+        if self.offsets and not self.append:
+            self.stream.write(_INDEX_TAG + _INDEX_HEAD.pack(len(self.offsets)) +
+                              struct.pack("<{0}Q".format(len(self.offsets)),
+                                          *self.offsets))
+        self.stream.close()
+
+
+def pack_bubble(contig_id, position, consensus, branches):
+    chunks = [_BUBBLE_TAG, _pack_string(contig_id),
+              _RECORD_HEAD.pack(position, len(branches)),
+              _pack_seq(consensus)]
+    for branch in branches:
+        chunks.append(_pack_seq(branch))
+    return b"".join(chunks)
+
+
+def read_consensus(stream):
+    """
+    Iterates over (contig_id, position, num_branches, sequence)
+    records of the binary consensus stream (following the magic string).
+    Records are read one by one, so the stream could be a pipe
+    """
+    while True:
+        tag = stream.read(1)
+        if not tag or tag == _INDEX_TAG:
+            break
+        if tag != _CONSENSUS_TAG:
+            raise ValueError("Error parsing binary consensus file")
+
+        contig_id = _read_string(stream)
+        ctg_pos, num_branches = \
+            _RECORD_HEAD.unpack(_read_exact(stream, _RECORD_HEAD.size))
+        sequence = _read_string(stream)
+        yield contig_id, ctg_pos, num_branches, sequence
+
+
+def _pack_string(string):
+    encoded = string.encode("ascii")
+    return _LENGTH.pack(len(encoded)) + encoded
+
+
+def _pack_seq(seq):
+    encoded = seq.encode("ascii")
+    if not encoded or encoded.translate(None, b"ACGT"):
+        return _SEQ_HEAD.pack(len(encoded), _RAW) + encoded
+
+    #each of the four interleaved slices is translated into the codes
+    #shifted to its position, so the slices combine into packed bytes
+    #with a bitwise OR of the corresponding big integers
+    padded = encoded + b"A" * (-len(encoded) % 4)
+    num_bytes = len(padded) // 4
+    packed = 0
+    for shift_id, table in enumerate(_TWO_BIT_TABLES):
+        packed |= _bytes_to_int(padded[shift_id::4].translate(table))
+    return (_SEQ_HEAD.pack(len(encoded), _TWO_BIT) +
+            _int_to_bytes(packed, num_bytes))
+
+
+def _read_exact(stream, length):
+    data = stream.read(length)
+    if len(data) != length:
+        raise ValueError("Truncated binary record")
+    return data
+
+
+def _read_string(stream):
+    length, = _LENGTH.unpack(_read_exact(stream, _LENGTH.size))
+    return _read_exact(stream, length).decode("ascii")
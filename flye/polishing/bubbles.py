@@ -9,32 +9,84 @@ Separates alignment into small bubbles for further correction
 from __future__ import absolute_import
 from __future__ import division
 import logging
+import os
+import re
+import fcntl
+import sys
+import uuid
+from binascii import hexlify, unhexlify
+from array import array
 from bisect import bisect
+from itertools import compress
+from collections import defaultdict
+from fractions import Fraction
 from flye.six.moves import range
 
-import multiprocessing
-import signal
-
 import flye.utils.fasta_parser as fp
 import flye.config.py_cfg as cfg
-from flye.polishing.alignment import shift_gaps, get_uniform_alignments
+from flye.polishing.alignment import (shift_gaps, get_uniform_alignments,
+                                      get_shard_length)
 from flye.utils.sam_parser import SynchronizedSamReader
+from flye.utils.worker_pool import task_group, current_worker_id
+from flye.polishing.binary_records import (BinaryRecordsWriter, BUBBLES_MAGIC,
+                                           pack_bubble)
 from flye.six.moves import zip
 
 
 logger = logging.getLogger()
 
-
-class ProfileInfo(object):
+#big integers are used for bitwise operations on whole byte strings
+if sys.version_info < (3, 0):
+    _bytes_to_int = lambda x: int(hexlify(x), 16)
+    _int_to_bytes = lambda x, length: unhexlify("{0:0{1}x}".format(x, length * 2))
+    _array_bytes = lambda x: x.tostring()
+else:
+    _bytes_to_int = lambda x: int.from_bytes(x, "big")
+    _int_to_bytes = lambda x, length: x.to_bytes(length, "big")
+    _array_bytes = lambda x: x.tobytes()
+
+#how far the shard boundary could be moved to reach a simple kmer
+_SHARD_OVERLAP = 1000
+#write buffer for the bubble shards
+_BUBBLES_BUFFER = 1 << 22
+#bubbles output -> id of the make_bubbles call that the worker
+#has written its shard for (the shard is truncated on a new call)
+_worker_shards = {}
+
+_NO_NUCL = b"_"
+_GAP_RUN = re.compile(r"-+")
+#0xff for gaps, zero otherwise
+_GAP_MASK = bytearray(256)
+_GAP_MASK[ord("-")] = 0xff
+_GAP_MASK = bytes(_GAP_MASK)
+_HOMOPOLYMER = re.compile(r"(?=(.)\1)")
+_DINUCL_HOMOPOLYMER = re.compile(r"(?=(..)\1)")
+
+
+class Profile(object):
+    """
+    Array-backed alignment profile: per-position counts are stored
+    in integer arrays, reference nucleotides in a byte array
+    (uncovered positions are marked with _NO_NUCL)
+    """
     __slots__ = ("nucl", "num_inserts", "num_deletions",
                  "num_missmatch", "coverage")
 
-    def __init__(self):
-        self.nucl = ""
-        self.num_inserts = 0
-        self.num_deletions = 0
-        self.num_missmatch = 0
-        self.coverage = 0
+    def __init__(self, length):
+        self.nucl = bytearray(_NO_NUCL) * length
+        self.num_inserts = array("i", [0]) * length
+        self.num_deletions = array("i", [0]) * length
+        self.num_missmatch = array("i", [0]) * length
+        self.coverage = array("i", [0]) * length
+
+    def __len__(self):
+        return len(self.nucl)
+
+    def get_nucl(self, start, end):
+        """
+        Reference sequence of the covered positions within the range
+        """
+        return self.nucl[start : end].replace(_NO_NUCL, b"").decode("ascii")
 
 
 class Bubble(object):
@@ -47,107 +99,153 @@ class Bubble(object):
         self.consensus = ""
 
 
-def _thread_worker(aln_reader, contigs_info, err_mode,
-                   results_queue, error_queue, bubbles_file_handle,
-                   bubbles_file_lock):
+def _thread_worker(aln_reader, shard, region, contig_info, err_mode,
+                   bubbles_out, call_id, bubbles_pipe):
     """
-    Will run in parallel
+    Generates bubbles of a single contig shard (runs in a worker).
+    Bubbles are appended to the shard file of the worker
+    (or written into the shared pipe)
     """
-    try:
-        aln_reader.init_reading()
-        while not aln_reader.is_eof():
-            ctg_id, ctg_aln = aln_reader.get_chunk()
-            if ctg_id is None:
-                break
-
-            #logger.debug("Processing {0}".format(ctg_id))
-            #get top unifom alignments
-            ctg_aln = get_uniform_alignments(ctg_aln, contigs_info[ctg_id].length)
-
-            profile, aln_errors = _compute_profile(ctg_aln, err_mode,
-                                                   contigs_info[ctg_id].length)
-            partition, num_long_bubbles = _get_partition(profile, err_mode)
-            ctg_bubbles = _get_bubble_seqs(ctg_aln, err_mode, profile, partition,
-                                           contigs_info[ctg_id])
-            mean_cov = sum([len(b.branches) for b in ctg_bubbles]) // (len(ctg_bubbles) + 1)
-            ctg_bubbles, num_empty, num_long_branch = \
-                                    _postprocess_bubbles(ctg_bubbles)
-            results_queue.put((ctg_id, len(ctg_bubbles), num_long_bubbles,
-                               num_empty, num_long_branch, aln_errors,
-                               mean_cov))
-            with bubbles_file_lock:
-                _output_bubbles(ctg_bubbles, bubbles_file_handle)
-
-            del profile
-            del ctg_bubbles
-
-        aln_reader.stop_reading()
+    aln_reader.init_reading()
+    ctg_id, _, _, ctg_aln = aln_reader.read_shard(shard)
+    aln_reader.stop_reading()
+    if ctg_id is None:
+        return None
+
+    #shard boundaries are moved to simple kmers of the reference,
+    #so the neighbouring shards agree on them
+    region_start, region_end = region
+    ctg_len = contig_info.length
+
+    #get top unifom alignments
+    ctg_aln = get_uniform_alignments(ctg_aln, ctg_len,
+                                     region_start, region_end)
+
+    profile, aln_errors = _compute_profile(ctg_aln, err_mode, ctg_len,
+                                           region_start, region_end)
+    partition, num_long_bubbles = _get_partition(profile, err_mode)
+    partition = [p + region_start for p in partition]
+    ctg_bubbles = _get_bubble_seqs(ctg_aln, err_mode, profile, partition,
+                                   contig_info, region_start, region_end)
+    del profile
+    num_branches = sum([len(b.branches) for b in ctg_bubbles])
+    num_raw_bubbles = len(ctg_bubbles)
+    ctg_bubbles, num_empty, num_long_branch = \
+                            _postprocess_bubbles(ctg_bubbles)
+
+    bubbles_shard = None
+    if ctg_bubbles:
+        if bubbles_pipe is not None:
+            bubbles_file_handle = bubbles_pipe
+            output_func = (_output_binary_bubbles if cfg.vals["binary_bubbles"]
+                           else _output_bubbles)
+        else:
+            worker_id = current_worker_id()
+            bubbles_shard = _shard_path(bubbles_out, worker_id
+                                        if worker_id is not None
+                                        else os.getpid())
+            append = _worker_shards.get(bubbles_out) == call_id
+            _worker_shards[bubbles_out] = call_id
+            if cfg.vals["binary_bubbles"]:
+                bubbles_file_handle = BinaryRecordsWriter(bubbles_shard,
+                                                          BUBBLES_MAGIC,
+                                                          _BUBBLES_BUFFER,
+                                                          append=append)
+                output_func = _output_binary_bubbles
+            else:
+                bubbles_file_handle = open(bubbles_shard, "a" if append else "w",
+                                           _BUBBLES_BUFFER)
+                output_func = _output_bubbles
+        output_func(ctg_bubbles, bubbles_file_handle)
+        bubbles_file_handle.close()
 
-    except Exception as e:
-        error_queue.put(e)
+    return (ctg_id, len(ctg_bubbles), num_long_bubbles, num_empty,
+            num_long_branch, array("d", aln_errors), num_branches,
+            num_raw_bubbles, bubbles_shard)
 
 
 def make_bubbles(alignment_path, contigs_info, contigs_path,
-                 err_mode, num_proc, bubbles_out):
+                 err_mode, num_proc, bubbles_out, sam_sorter=None,
+                 pipe_path=None, group_separator=None):
     """
-    The main function: takes an alignment and returns bubbles
+    The main function: takes an alignment and returns bubbles.
+    Each worker writes bubbles into its own shard file, and
+    bubbles_out becomes a manifest with the list of (non-empty) shards,
+    which is accepted by the polishing binary. If pipe_path (a named pipe,
+    which is already open for writing by the caller) is given, all tasks
+    write bubbles into it instead, and bubbles_out is not used.
+    If sam_sorter is given, the alignment is sorted while the workers are
+    already processing the sorted contigs. group_separator is passed
+    to the alignment reader (see SynchronizedSamReader)
     """
-    aln_reader = SynchronizedSamReader(alignment_path,
-                                       fp.read_sequence_dict(contigs_path),
+    contigs_fasta = fp.read_sequence_dict(contigs_path)
+    aln_reader = SynchronizedSamReader(alignment_path, contigs_fasta,
                                        cfg.vals["max_read_coverage"],
-                                       use_secondary=True)
-    manager = multiprocessing.Manager()
-    results_queue = manager.Queue()
-    error_queue = manager.Queue()
-
-    #making sure the main process catches SIGINT
-    orig_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    threads = []
-    bubbles_out_lock = multiprocessing.Lock()
-    bubbles_out_handle = open(bubbles_out, "w")
-    for _ in range(num_proc):
-        threads.append(multiprocessing.Process(target=_thread_worker,
-                                               args=(aln_reader, contigs_info,
-                                                     err_mode, results_queue,
-                                                     error_queue, bubbles_out_handle,
-                                                     bubbles_out_lock)))
-    signal.signal(signal.SIGINT, orig_sigint)
-
-    for t in threads:
-        t.start()
-    try:
-        for t in threads:
-            t.join()
-            if t.exitcode == -9:
-                logger.error("Looks like the system ran out of memory")
-            if t.exitcode != 0:
-                raise Exception("One of the processes exited with code: {0}"
-                                .format(t.exitcode))
-    except KeyboardInterrupt:
-        for t in threads:
-            t.terminate()
-        raise
-
-    if not error_queue.empty():
-        raise error_queue.get()
+                                       use_secondary=True,
+                                       sam_sorter=sam_sorter,
+                                       shard_length=get_shard_length(contigs_info,
+                                                                     num_proc),
+                                       shard_overlap=_SHARD_OVERLAP,
+                                       group_separator=group_separator)
+    bubbles_pipe = None
+    if pipe_path is not None:
+        bubbles_pipe = _BubblesPipe(pipe_path)
+        if cfg.vals["binary_bubbles"]:
+            bubbles_pipe.write(BUBBLES_MAGIC)
 
     total_bubbles = 0
     total_long_bubbles = 0
     total_long_branches = 0
     total_empty = 0
     total_aln_errors = []
-    coverage_stats = {}
+    ctg_branches = defaultdict(int)
+    ctg_raw_bubbles = defaultdict(int)
+    bubbles_shards = []
+    #tasks of this call append to the worker shards
+    call_id = uuid.uuid4().hex
+
+    with task_group(num_proc) as tasks:
+        def submit_shard(ctg_id, contig_reader, shard, weight):
+            _, shard_start, shard_end = shard
+            ctg_len = contigs_info[ctg_id].length
+            region_start, region_end = 0, ctg_len
+            if shard_start > 0:
+                region_start = _shard_boundary(contigs_fasta[ctg_id],
+                                               shard_start)
+            if shard_end < ctg_len:
+                region_end = _shard_boundary(contigs_fasta[ctg_id], shard_end)
+
+            tasks.submit_weighted(weight, _thread_worker, contig_reader, shard,
+                                  (region_start, region_end),
+                                  contigs_info[ctg_id], err_mode, bubbles_out,
+                                  call_id, bubbles_pipe)
+        aln_reader.dispatch_shards(submit_shard, sam_sorter)
+
+        for result in tasks.results():
+            if result is None:
+                continue
+            (ctg_id, num_bubbles, num_long_bubbles,
+                num_empty, num_long_branch,
+                aln_errors, num_branches,
+                num_raw_bubbles, bubbles_shard) = result
+            if bubbles_shard is not None and bubbles_shard not in bubbles_shards:
+                bubbles_shards.append(bubbles_shard)
+            total_long_bubbles += num_long_bubbles
+            total_long_branches += num_long_branch
+            total_empty += num_empty
+            total_aln_errors.extend(aln_errors)
+            total_bubbles += num_bubbles
+            ctg_branches[ctg_id] += num_branches
+            ctg_raw_bubbles[ctg_id] += num_raw_bubbles
+        tasks.log_balance("Bubbles")
+
+    if bubbles_pipe is None:
+        _write_manifest(sorted(bubbles_shards), bubbles_out)
 
-    while not results_queue.empty():
-        (ctg_id, num_bubbles, num_long_bubbles,
-            num_empty, num_long_branch,
-            aln_errors, mean_coverage) = results_queue.get()
-        total_long_bubbles += num_long_bubbles
-        total_long_branches += num_long_branch
-        total_empty += num_empty
-        total_aln_errors.extend(aln_errors)
-        total_bubbles += num_bubbles
-        coverage_stats[ctg_id] = mean_coverage
+    coverage_stats = {}
+    for ctg_id in ctg_branches:
+        coverage_stats[ctg_id] = (ctg_branches[ctg_id] //
+                                  (ctg_raw_bubbles[ctg_id] + 1))
 
     mean_aln_error = sum(total_aln_errors) / (len(total_aln_errors) + 1)
     logger.debug("Generated %d bubbles", total_bubbles)
@@ -158,20 +256,101 @@ def make_bubbles(alignment_path, contigs_info, contigs_path,
     return coverage_stats, mean_aln_error
 
 
+def remove_bubbles(bubbles_manifest):
+    """
+    Removes bubble shards along with the manifest
+    """
+    for shard_path in read_manifest(bubbles_manifest):
+        os.remove(shard_path)
+    os.remove(bubbles_manifest)
+
+
+def read_manifest(bubbles_manifest):
+    """
+    Returns the list of bubble shards
+    """
+    manifest_dir = os.path.dirname(bubbles_manifest)
+    with open(bubbles_manifest, "r") as f:
+        return [os.path.join(manifest_dir, line.strip())
+                for line in f if line.strip()]
+
+
+def _shard_path(bubbles_out, shard_id):
+    prefix, ext = os.path.splitext(bubbles_out)
+    return "{0}.{1}{2}".format(prefix, shard_id, ext)
+
+
+def _write_manifest(bubbles_shards, bubbles_out):
+    """
+    Lists non-empty shards (relative to the manifest location),
+    empty shards are removed
+    """
+    with open(bubbles_out, "w") as f:
+        for shard_path in bubbles_shards:
+            if not os.path.exists(shard_path):
+                continue
+            if os.path.getsize(shard_path) == 0:
+                os.remove(shard_path)
+                continue
+            f.write(os.path.basename(shard_path) + "\n")
+
+
+class _BubblesPipe(object):
+    """
+    Bubbles output into a named pipe, shared by all worker tasks. Each write
+    is made under an exclusive lock on the pipe, so the records are not
+    interleaved. The pipe should be kept open for writing by the main
+    process, so the reader does not see EOF between the writes
+    """
+    def __init__(self, pipe_path):
+        self.pipe_path = pipe_path
+
+    def write(self, data):
+        if isinstance(data, list):
+            data = b"".join(data)
+        elif not isinstance(data, bytes):
+            data = data.encode("ascii")
+
+        #fails, rather than blocks, if the reader has exited
+        pipe_fd = os.open(self.pipe_path, os.O_WRONLY | os.O_NONBLOCK)
+        try:
+            flags = fcntl.fcntl(pipe_fd, fcntl.F_GETFL)
+            fcntl.fcntl(pipe_fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+            fcntl.flock(pipe_fd, fcntl.LOCK_EX)
+            view = memoryview(data)
+            while len(view):
+                view = view[os.write(pipe_fd, view):]
+        finally:
+            os.close(pipe_fd)
+
+    def close(self):
+        #the pipe is closed by the owner of the descriptor
+        pass
+
+
 def _output_bubbles(bubbles, out_stream):
     """
-    Outputs list of bubbles into file
+    Outputs list of bubbles into file (with a single write)
     """
+    lines = []
     for bubble in bubbles:
-        out_stream.write(">{0} {1} {2}\n".format(bubble.contig_id,
-                                        bubble.position,
-                                        len(bubble.branches)))
-        out_stream.write(bubble.consensus + "\n")
+        lines.append(">{0} {1} {2}\n".format(bubble.contig_id,
+                                             bubble.position,
+                                             len(bubble.branches)))
+        lines.append(bubble.consensus + "\n")
         for branch_id, branch in enumerate(bubble.branches):
-            out_stream.write(">{0}\n".format(branch_id))
-            out_stream.write(branch + "\n")
+            lines.append(">{0}\n".format(branch_id))
+            lines.append(branch + "\n")
 
-    out_stream.flush()
+    out_stream.write("".join(lines))
+
+
+def _output_binary_bubbles(bubbles, records_writer):
+    """
+    Outputs list of bubbles as binary records
+    """
+    records_writer.write([pack_bubble(b.contig_id, b.position, b.consensus,
+                                      b.branches) for b in bubbles])
 
 
 def _postprocess_bubbles(bubbles):
@@ -219,34 +398,13 @@ def _postprocess_bubbles(bubbles):
     return new_bubbles, empty_bubbles, long_branches
 
 
-def _is_solid_kmer(profile, position, err_mode):
-    """
-    Checks if the kmer at given position is solid
-    """
-    MISSMATCH_RATE = cfg.vals["err_modes"][err_mode]["solid_missmatch"]
-    INS_RATE = cfg.vals["err_modes"][err_mode]["solid_indel"]
-    SOLID_LEN = cfg.vals["solid_kmer_length"]
-
-    for i in range(position, position + SOLID_LEN):
-        if profile[i].coverage == 0:
-            return False
-        local_missmatch = (profile[i].num_missmatch +
-                           profile[i].num_deletions) / profile[i].coverage
-        local_ins = profile[i].num_inserts / profile[i].coverage
-        if local_missmatch > MISSMATCH_RATE or local_ins > INS_RATE:
-            return False
-    return True
-
-
-def _is_simple_kmer(profile, position):
+def _is_simple_seq(nucl_str):
     """
-    Checks if the kmer with center at the given position is simple
+    Checks if the kmer in the middle of the sequence (of double
+    kmer length) is simple
     """
     SIMPLE_LEN = cfg.vals["simple_kmer_length"]
-
     extended_len = SIMPLE_LEN * 2
-    nucl_str = [p.nucl for p in profile[position - extended_len // 2 :
-                                        position + extended_len // 2]]
 
     #single nucleotide homopolymers
     for i in range(extended_len // 2 - SIMPLE_LEN // 2,
@@ -272,48 +430,180 @@ def _is_simple_kmer(profile, position):
     return True
 
 
-def _compute_profile(alignment, platform, genome_len):
+def _shard_boundary(contig_seq, position):
+    """
+    Returns the first position at or after the given one with
+    a simple kmer of the reference in its center
+    """
+    SIMPLE_LEN = cfg.vals["simple_kmer_length"]
+
+    last_pos = min(position + _SHARD_OVERLAP, len(contig_seq) - SIMPLE_LEN)
+    for pos in range(max(position, SIMPLE_LEN), last_pos):
+        if _is_simple_seq(contig_seq[pos - SIMPLE_LEN : pos + SIMPLE_LEN]):
+            return pos
+    return position
+
+
+def _compute_profile(alignment, platform, genome_len, region_start=0,
+                     region_end=None):
     """
-    Computes alignment profile
+    Computes alignment profile (for the given region of the contig).
+    Per-alignment match / error states are computed on whole byte strings,
+    so only the positions with errors are visited individually
     """
+    if region_end is None:
+        region_end = genome_len
+
     max_aln_err = cfg.vals["err_modes"][platform]["max_aln_error"]
     min_aln_len = cfg.vals["min_polish_aln_len"]
     aln_errors = []
     #filtered = 0
-    profile = [ProfileInfo() for _ in range(genome_len)]
+    profile = Profile(region_end - region_start)
+    num_deletions = profile.num_deletions
+    num_missmatch = profile.num_missmatch
+    coverage_diff = array("i", [0]) * (len(profile) + 1)
     for aln in alignment:
         if aln.err_rate > max_aln_err or len(aln.qry_seq) < min_aln_len:
             #filtered += 1
             continue
 
-        aln_errors.append(aln.err_rate)
+        #alignments spanning multiple regions are counted once
+        if aln.trg_start >= region_start or region_start == 0:
+            aln_errors.append(aln.err_rate)
 
         qry_seq = shift_gaps(aln.trg_seq, aln.qry_seq)
         trg_seq = shift_gaps(qry_seq, aln.trg_seq)
+        ref_seq, deletions, missmatches = _ref_states(trg_seq, qry_seq)
+
+        #insertions are assigned to the preceding reference position
+        num_gaps = 0
+        for gap in _GAP_RUN.finditer(trg_seq):
+            ref_pos = aln.trg_start + gap.start() - num_gaps - 1
+            num_gaps += gap.end() - gap.start()
+            if ref_pos >= genome_len:
+                ref_pos -= genome_len
+            if region_start <= ref_pos < region_end:
+                profile.num_inserts[ref_pos - region_start] += gap.end() - gap.start()
+
+        #the covered reference positions form one range
+        #(or two, if the alignment wraps around a circular contig)
+        ref_end = aln.trg_start + len(ref_seq)
+        for seg_start, seg_end in [(aln.trg_start, min(ref_end, genome_len)),
+                                   (genome_len, ref_end)]:
+            shift = 0 if seg_start < genome_len else genome_len
+            left = max(seg_start - shift, region_start)
+            right = min(seg_end - shift, region_end)
+            if left >= right:
+                continue
+            seq_range = slice(left + shift - aln.trg_start,
+                              right + shift - aln.trg_start)
+            prof_range = range(left - region_start, right - region_start)
+
+            profile.nucl[prof_range[0] : prof_range[-1] + 1] = ref_seq[seq_range]
+            coverage_diff[prof_range[0]] += 1
+            coverage_diff[prof_range[-1] + 1] -= 1
+            for prof_pos in compress(prof_range, deletions[seq_range]):
+                num_deletions[prof_pos] += 1
+            for prof_pos in compress(prof_range, missmatches[seq_range]):
+                num_missmatch[prof_pos] += 1
+
+    coverage = profile.coverage
+    running_cov = 0
+    for i in range(len(profile)):
+        running_cov += coverage_diff[i]
+        coverage[i] = running_cov
 
-        trg_pos = aln.trg_start
-        for trg_nuc, qry_nuc in zip(trg_seq, qry_seq):
-            if trg_nuc == "-":
-                trg_pos -= 1
-            if trg_pos >= genome_len:
-                trg_pos -= genome_len
+    #logger.debug("Filtered: {0} out of {1}".format(filtered, len(alignment)))
+    return profile, aln_errors
 
-            prof_elem = profile[trg_pos]
-            if trg_nuc == "-":
-                prof_elem.num_inserts += 1
-            else:
-                prof_elem.nucl = trg_nuc
-                prof_elem.coverage += 1
 
-                if qry_nuc == "-":
-                    prof_elem.num_deletions += 1
-                elif trg_nuc != qry_nuc:
-                    prof_elem.num_missmatch += 1
+def _ref_states(trg_seq, qry_seq):
+    """
+    Given the gapped alignment, returns the reference sequence and
+    two byte strings over the reference positions with non-zero
+    values at deletions and mismatches, respectively
+    """
+    trg_bytes = trg_seq.encode("ascii")
+    qry_bytes = qry_seq.encode("ascii")
+    if not trg_bytes:
+        return b"", b"", b""
+
+    #removing the insertion columns from the query
+    ins_mask = _bytes_to_int(trg_bytes.translate(_GAP_MASK))
+    qry_ref = _int_to_bytes(_bytes_to_int(qry_bytes) | ins_mask,
+                            len(qry_bytes)).replace(b"\xff", b"")
+    ref_seq = trg_bytes.replace(b"-", b"")
+    if not ref_seq:
+        return b"", b"", b""
+
+    del_mask = qry_ref.translate(_GAP_MASK)
+    missmatches = _int_to_bytes((_bytes_to_int(ref_seq) ^ _bytes_to_int(qry_ref)) &
+                                ~_bytes_to_int(del_mask), len(ref_seq))
+    return ref_seq, del_mask, missmatches
+
+
+def _pack_lanes(values, lane_bytes):
+    """
+    Packs an array of non-negative integers into a big integer, one value
+    per lane (the first value is in the most significant lane)
+    """
+    lanes = values[:]
+    if sys.byteorder == "little":
+        lanes.byteswap()
+    raw = _array_bytes(lanes)
+    item_size = values.itemsize
+    if lane_bytes > item_size:
+        wide = bytearray(len(values) * lane_bytes)
+        for i in range(item_size):
+            wide[lane_bytes - item_size + i :: lane_bytes] = raw[i :: item_size]
+        raw = bytes(wide)
+    return _bytes_to_int(raw)
+
+
+def _weak_positions(profile, missmatch_rate, ins_rate):
+    """
+    Flags the positions that could not be a part of a solid kmer: not
+    covered, or with the error rates above the thresholds. The rates are
+    compared as fractions, for all positions at once: the counts are
+    packed into the lanes of big integers (see _pack_lanes). The lanes
+    are widened if the counts are too large for the array item size
+    """
+    prof_len = len(profile)
+    if not prof_len:
+        return bytearray()
+
+    mm_rate = Fraction(str(missmatch_rate)).limit_denominator(1000)
+    ins_rate = Fraction(str(ins_rate)).limit_denominator(1000)
+    max_factor = max(mm_rate.numerator, mm_rate.denominator,
+                     ins_rate.numerator, ins_rate.denominator)
+    counts = [profile.coverage, profile.num_missmatch,
+              profile.num_deletions, profile.num_inserts]
+    for lane_bytes in [profile.coverage.itemsize, 8]:
+        lane_bits = lane_bytes * 8
+        ones = _bytes_to_int((b"\x00" * (lane_bytes - 1) + b"\x01") * prof_len)
+        high_bits = ones << (lane_bits - 1)
+        #counts (multiplied by the rates, or summed) should stay
+        #below the lane high bit
+        max_bits = lane_bits - 2 - max_factor.bit_length()
+        overflow_mask = (ones << lane_bits) - (ones << max_bits)
+        (coverage, num_missmatch, num_deletions, num_inserts) = \
+            [_pack_lanes(c, lane_bytes) for c in counts]
+        if any(c & overflow_mask for c in (coverage, num_missmatch,
+                                           num_deletions, num_inserts)):
+            continue
 
-            trg_pos += 1
+        def _greater(first, second):
+            #high bit of the lane is set where first > second
+            return ((first | high_bits) - (second + ones)) & high_bits
 
-    #logger.debug("Filtered: {0} out of {1}".format(filtered, len(alignment)))
-    return profile, aln_errors
+        weak = ((high_bits & ~_greater(coverage, 0)) |
+                _greater((num_missmatch + num_deletions) * mm_rate.denominator,
+                         coverage * mm_rate.numerator) |
+                _greater(num_inserts * ins_rate.denominator,
+                         coverage * ins_rate.numerator))
+        return bytearray(_int_to_bytes(weak >> (lane_bits - 1),
+                                       prof_len * lane_bytes)
+                         [lane_bytes - 1 :: lane_bytes])
 
 
 def _get_partition(profile, err_mode):
@@ -324,26 +614,49 @@ def _get_partition(profile, err_mode):
     SOLID_LEN = cfg.vals["solid_kmer_length"]
     SIMPLE_LEN = cfg.vals["simple_kmer_length"]
     MAX_BUBBLE = cfg.vals["max_bubble_length"]
+    MISSMATCH_RATE = cfg.vals["err_modes"][err_mode]["solid_missmatch"]
+    INS_RATE = cfg.vals["err_modes"][err_mode]["solid_indel"]
+
+    prof_len = len(profile)
 
-    solid_flags = [False for _ in range(len(profile))]
+    #positions that could not be a part of a solid kmer
+    weak_flags = _weak_positions(profile, MISSMATCH_RATE, INS_RATE)
+
+    solid_flags = bytearray(prof_len)
     prof_pos = 0
-    while prof_pos < len(profile) - SOLID_LEN:
-        if _is_solid_kmer(profile, prof_pos, err_mode):
-            for i in range(prof_pos, prof_pos + SOLID_LEN):
-                solid_flags[i] = True
+    while prof_pos < prof_len - SOLID_LEN:
+        weak_pos = weak_flags.find(b"\x01", prof_pos, prof_pos + SOLID_LEN)
+        if weak_pos == -1:
+            solid_flags[prof_pos : prof_pos + SOLID_LEN] = b"\x01" * SOLID_LEN
             prof_pos += SOLID_LEN
         else:
-            prof_pos += 1
+            #all kmers up to the weak position include it
+            prof_pos = weak_pos + 1
+
+    #single nucleotide and dinucleotide homopolymers. Uncovered positions
+    #are marked with the same placeholder, so they are equal to each other
+    nucl_str = profile.nucl.decode("ascii")
+    homo_flags = bytearray(prof_len)
+    for match in _HOMOPOLYMER.finditer(nucl_str):
+        homo_flags[match.start()] = 1
+    dinucl_flags = bytearray(prof_len)
+    for match in _DINUCL_HOMOPOLYMER.finditer(nucl_str):
+        dinucl_flags[match.start()] = 1
 
     partition = []
     prev_partition = SOLID_LEN
 
     long_bubbles = 0
     prof_pos = SOLID_LEN
-    while prof_pos < len(profile) - SOLID_LEN:
+    while prof_pos < prof_len - SOLID_LEN:
         cur_partition = prof_pos + SIMPLE_LEN // 2
-        landmark = (all(solid_flags[prof_pos : prof_pos + SIMPLE_LEN]) and
-                    _is_simple_kmer(profile, cur_partition))
+        #same checks as in _is_simple_seq with the kmer at cur_partition
+        landmark = (solid_flags.find(b"\x00", prof_pos,
+                                     prof_pos + SIMPLE_LEN) == -1 and
+                    homo_flags.find(b"\x01", cur_partition - SIMPLE_LEN // 2,
+                                    cur_partition + SIMPLE_LEN // 2 - 1) == -1 and
+                    dinucl_flags.find(b"\x01", cur_partition - SIMPLE_LEN,
+                                      cur_partition + SIMPLE_LEN - 3) == -1)
 
         if prof_pos - prev_partition > MAX_BUBBLE:
             long_bubbles += 1
@@ -361,54 +674,117 @@ def _get_partition(profile, err_mode):
     return partition, long_bubbles
 
 
-def _get_bubble_seqs(alignment, platform, profile, partition, contig_info):
+def _get_bubble_seqs(alignment, platform, profile, partition, contig_info,
+                     region_start=0, region_end=None):
     """
     Given genome landmarks, forms bubble sequences
+    (for the given region of the contig, which the profile covers)
     """
     if not partition:
         return []
+    if region_end is None:
+        region_end = contig_info.length
 
     #max_aln_err = cfg.vals["err_modes"][platform]["max_aln_error"]
     bubbles = []
-    ext_partition = [0] + partition + [contig_info.length]
+    ext_partition = [region_start] + partition + [region_end]
     for p_left, p_right in zip(ext_partition[:-1], ext_partition[1:]):
         bubbles.append(Bubble(contig_info.id, p_left))
-        consensus = [p.nucl for p in profile[p_left : p_right]]
-        bubbles[-1].consensus = "".join(consensus)
+        bubbles[-1].consensus = profile.get_nucl(p_left - region_start,
+                                                 p_right - region_start)
 
+    genome_len = contig_info.length
     for aln in alignment:
         #if aln.err_rate > max_aln_err: continue
 
-        bubble_id = bisect(partition, aln.trg_start % contig_info.length)
-        next_bubble_start = ext_partition[bubble_id + 1]
-        chromosome_start = (bubble_id == 0 and
+        bubble_id = bisect(partition, aln.trg_start % genome_len)
+        chromosome_start = (bubble_id == 0 and region_start == 0 and
                             not contig_info.type == "circular")
-        chromosome_end = (aln.trg_end > partition[-1] and not
-                          contig_info.type == "circular")
-
-        branch_start = None
-        first_segment = True
-        trg_pos = aln.trg_start
-        for i, trg_nuc in enumerate(aln.trg_seq):
-            if trg_nuc == "-":
+        chromosome_end = (aln.trg_end > partition[-1] and
+                          region_end == genome_len and
+                          not contig_info.type == "circular")
+
+        #offsets (from the alignment start) of the reference positions
+        #where the branches are cut, and the indexes of the bubbles that
+        #start there (None if the alignment leaves the region)
+        cut_offsets = []
+        cut_bubbles = []
+        ref_len = len(aln.trg_seq) - aln.trg_seq.count("-")
+        in_region = False
+        #covered positions form one range, or two if wrapping around
+        for seg_offset, seg_start, seg_end in \
+                [(0, aln.trg_start, min(aln.trg_start + ref_len, genome_len)),
+                 (genome_len - aln.trg_start, 0,
+                  aln.trg_start + ref_len - genome_len)]:
+            if seg_start >= seg_end:
                 continue
-            if trg_pos >= contig_info.length:
-                trg_pos -= contig_info.length
+            if in_region and seg_start < region_start:
+                cut_offsets.append(seg_offset)
+                cut_bubbles.append(None)
+                break
 
-            if trg_pos >= next_bubble_start or trg_pos == 0:
-                if not first_segment or chromosome_start:
-                    branch_seq = fp.to_acgt(aln.qry_seq[branch_start : i].replace("-", ""))
-                    bubbles[bubble_id].branches.append(branch_seq)
+            left = max(seg_start, region_start)
+            right = min(seg_end, region_end)
+            if left >= right:
+                continue
+            in_region = True
+
+            if left == region_start:
+                cut_offsets.append(seg_offset + left - seg_start)
+                cut_bubbles.append(0)
+            for part_id in range(bisect(partition, left),
+                                 bisect(partition, right - 1)):
+                cut_offsets.append(seg_offset + partition[part_id] - seg_start)
+                cut_bubbles.append(part_id + 1)
+            if right < seg_end:
+                cut_offsets.append(seg_offset + right - seg_start)
+                cut_bubbles.append(None)
+                break
 
-                first_segment = False
-                bubble_id = bisect(partition, trg_pos)
-                next_bubble_start = ext_partition[bubble_id + 1]
-                branch_start = i
+        #branches are cut from the query without gaps
+        qry_seq = fp.to_acgt(aln.qry_seq.replace("-", ""))
+        branch_start = 0
+        prev_column = 0
+        first_segment = True
+        for cut_bubble, column in zip(cut_bubbles,
+                                      _ref_columns(aln.trg_seq, cut_offsets)):
+            branch_end = (branch_start + column - prev_column -
+                          aln.qry_seq.count("-", prev_column, column))
+            if not first_segment or chromosome_start:
+                bubbles[bubble_id].branches.append(qry_seq[branch_start :
+                                                           branch_end])
+
+            #the alignment leaves the region
+            if cut_bubble is None:
+                break
 
-            trg_pos += 1
+            first_segment = False
+            bubble_id = cut_bubble
+            branch_start = branch_end
+            prev_column = column
 
         if chromosome_end:
-            branch_seq = fp.to_acgt(aln.qry_seq[branch_start:].replace("-", ""))
-            bubbles[-1].branches.append(branch_seq)
+            bubbles[-1].branches.append(qry_seq[branch_start:])
 
     return bubbles
+
+
+def _ref_columns(trg_seq, ref_offsets):
+    """
+    Maps (sorted) offsets of the reference positions from
+    the alignment start to the columns of the gapped alignment
+    """
+    columns = []
+    column = -1
+    prev_offset = -1
+    for offset in ref_offsets:
+        #advancing by the number of reference positions,
+        #then again by the number of gaps that were passed
+        to_advance = offset - prev_offset
+        while to_advance > 0:
+            next_column = column + to_advance
+            to_advance = trg_seq.count("-", column + 1, next_column + 1)
+            column = next_column
+        columns.append(column)
+        prev_offset = offset
+    return columns
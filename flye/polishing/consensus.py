@@ -9,96 +9,106 @@ Quick and dirty alignment consensus
 from __future__ import absolute_import
 from __future__ import division
 import logging
+from array import array
 from collections import defaultdict
 from flye.six.moves import range
-from flye.six import itervalues
+from flye.six import itervalues, iteritems
 
-import multiprocessing
-import signal
-
-from flye.polishing.alignment import shift_gaps, get_uniform_alignments
+from flye.polishing.alignment import (shift_gaps, get_uniform_alignments,
+                                      get_shard_length)
 from flye.utils.sam_parser import SynchronizedSamReader
+from flye.utils.worker_pool import task_group
 import flye.config.py_cfg as cfg
 import flye.utils.fasta_parser as fp
 from flye.six.moves import zip
 
 logger = logging.getLogger()
 
-class Profile(object):
-    __slots__ = ("insertions", "matches", "nucl")
+#pileup columns: match / mismatch bases and deletions
+_PILEUP_NUCL = "ACGTN-"
+_NUM_COLUMNS = len(_PILEUP_NUCL)
+_GAP_CODE = ord("-")
+
 
-    def __init__(self):
-        self.insertions = defaultdict(str)
-        self.matches = defaultdict(int)
-        self.nucl = "-"
+def _column_table():
+    #non-ACGT bases go to the N column
+    table = [_PILEUP_NUCL.index("N")] * 256
+    for column_id, nucl in enumerate(_PILEUP_NUCL):
+        table[ord(nucl)] = column_id
+    return table
+_COLUMN_ID = _column_table()
 
-def _thread_worker(aln_reader, contigs_info, platform, results_queue,
-                   error_queue):
-    try:
-        aln_reader.init_reading()
 
-        while not aln_reader.is_eof():
-            ctg_id, ctg_aln = aln_reader.get_chunk()
-            if ctg_id is None:
-                break
+class Pileup(object):
+    """
+    Array-backed alignment profile: match / deletion counts are stored
+    in a flat (positions x columns) integer array, reference nucleotides
+    in a byte array and insertions in a sparse table keyed by position
+    """
+    __slots__ = ("counts", "nucl", "insertions")
 
-            profile, aln_errors = _contig_profile(ctg_aln, platform,
-                                                  contigs_info[ctg_id].length)
-            sequence = _flatten_profile(profile)
-            results_queue.put((ctg_id, sequence, aln_errors))
+    def __init__(self, length):
+        self.counts = array("i", [0]) * (length * _NUM_COLUMNS)
+        self.nucl = bytearray(b"-") * length
+        self.insertions = {}
 
-        aln_reader.stop_reading()
+    def __len__(self):
+        return len(self.nucl)
 
-    except Exception as e:
-        error_queue.put(e)
+
+def _thread_worker(aln_reader, shard, contig_info, platform):
+    """
+    Computes consensus of a single contig shard (runs in a worker).
+    The sequence is returned as bytes, so it is not pickled
+    """
+    aln_reader.init_reading()
+    ctg_id, shard_start, shard_end, ctg_aln = aln_reader.read_shard(shard)
+    aln_reader.stop_reading()
+    if ctg_id is None:
+        return None
+
+    profile, aln_errors = _contig_profile(ctg_aln, platform,
+                                          contig_info.length,
+                                          shard_start, shard_end)
+    sequence = _flatten_profile(profile)
+    return (ctg_id, shard_start, sequence.encode("ascii"),
+            array("d", aln_errors))
 
 
 def get_consensus(alignment_path, contigs_path, contigs_info, num_proc,
-                  platform):
+                  platform, sam_sorter=None):
     """
-    Main function
+    Main function. If sam_sorter is given, the alignment is sorted
+    while the workers are already processing the sorted contigs
     """
     aln_reader = SynchronizedSamReader(alignment_path,
                                        fp.read_sequence_dict(contigs_path),
                                        max_coverage=cfg.vals["max_read_coverage"],
-                                       use_secondary=True)
-    manager = multiprocessing.Manager()
-    results_queue = manager.Queue()
-    error_queue = manager.Queue()
-
-    #making sure the main process catches SIGINT
-    orig_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    threads = []
-    for _ in range(num_proc):
-        threads.append(multiprocessing.Process(target=_thread_worker,
-                                               args=(aln_reader, contigs_info,
-                                                     platform, results_queue,
-                                                     error_queue)))
-    signal.signal(signal.SIGINT, orig_sigint)
-
-    for t in threads:
-        t.start()
-    try:
-        for t in threads:
-            t.join()
-            if t.exitcode == -9:
-                logger.error("Looks like the system ran out of memory")
-            if t.exitcode != 0:
-                raise Exception("One of the processes exited with code: {0}"
-                                .format(t.exitcode))
-    except KeyboardInterrupt:
-        for t in threads:
-            t.terminate()
-        raise
-
-    if not error_queue.empty():
-        raise error_queue.get()
+                                       use_secondary=True,
+                                       sam_sorter=sam_sorter,
+                                       shard_length=get_shard_length(contigs_info,
+                                                                     num_proc))
 
-    out_fasta = {}
+    ctg_shards = defaultdict(list)
     total_aln_errors = []
-    while not results_queue.empty():
-        ctg_id, ctg_seq, aln_errors = results_queue.get()
-        total_aln_errors.extend(aln_errors)
+    with task_group(num_proc) as tasks:
+        def submit_shard(ctg_id, contig_reader, shard, weight):
+            tasks.submit_weighted(weight, _thread_worker, contig_reader, shard,
+                                  contigs_info[ctg_id], platform)
+        aln_reader.dispatch_shards(submit_shard, sam_sorter)
+
+        #stitching contig shards
+        for result in tasks.results():
+            if result is None:
+                continue
+            ctg_id, shard_start, ctg_seq, aln_errors = result
+            total_aln_errors.extend(aln_errors)
+            ctg_shards[ctg_id].append((shard_start, ctg_seq.decode("ascii")))
+        tasks.log_balance("Consensus")
+
+    out_fasta = {}
+    for ctg_id, shards in iteritems(ctg_shards):
+        ctg_seq = "".join(seq for _, seq in sorted(shards))
         if len(ctg_seq) > 0:
             out_fasta[ctg_id] = ctg_seq
 
@@ -108,20 +118,30 @@ def get_consensus(alignment_path, contigs_path, contigs_info, num_proc,
     return out_fasta
 
 
-def _contig_profile(alignment, platform, genome_len):
+def _contig_profile(alignment, platform, genome_len, region_start=0,
+                    region_end=None):
     """
-    Computes alignment profile
+    Computes alignment profile (for the given region of the contig)
     """
+    if region_end is None:
+        region_end = genome_len
 
     #leave the best uniform alignments
-    alignment = get_uniform_alignments(alignment, genome_len)
+    alignment = get_uniform_alignments(alignment, genome_len,
+                                       region_start, region_end)
 
     aln_errors = []
-    profile = [Profile() for _ in range(genome_len)]
+    profile = Pileup(region_end - region_start)
+    counts = profile.counts
+    ref_nucl = profile.nucl
+    insertions = profile.insertions
+    column_id = _COLUMN_ID
     #max_aln_err = cfg.vals["err_modes"][platform]["max_aln_error"]
     for aln in alignment:
         #if aln.err_rate > max_aln_err: continue
-        aln_errors.append(aln.err_rate)
+        #alignments spanning multiple regions are counted once
+        if aln.trg_start >= region_start or region_start == 0:
+            aln_errors.append(aln.err_rate)
 
         #after gap shifting it is possible that
         #two gaps are aligned against each other
@@ -129,19 +149,25 @@ def _contig_profile(alignment, platform, genome_len):
         trg_seq = shift_gaps(qry_seq, aln.trg_seq)
 
         trg_pos = aln.trg_start
-        for trg_nuc, qry_nuc in zip(trg_seq, qry_seq):
-            if trg_nuc == "-":
+        for trg_nuc, qry_nuc in zip(bytearray(trg_seq, "ascii"),
+                                    bytearray(qry_seq, "ascii")):
+            if trg_nuc == _GAP_CODE:
                 trg_pos -= 1
             if trg_pos >= genome_len:
                 trg_pos -= genome_len
+            if trg_pos < region_start or trg_pos >= region_end:
+                trg_pos += 1
+                continue
 
             #total += 1
-            prof_elem = profile[trg_pos]
-            if trg_nuc == "-" and qry_nuc != "-":
-                prof_elem.insertions[aln.qry_id] += qry_nuc
+            prof_pos = trg_pos - region_start
+            if trg_nuc == _GAP_CODE and qry_nuc != _GAP_CODE:
+                pos_insertions = insertions.setdefault(prof_pos, {})
+                pos_insertions[aln.qry_id] = (pos_insertions.get(aln.qry_id, "") +
+                                              chr(qry_nuc))
             else:
-                prof_elem.nucl = trg_nuc
-                prof_elem.matches[qry_nuc] += 1
+                ref_nucl[prof_pos] = trg_nuc
+                counts[prof_pos * _NUM_COLUMNS + column_id[qry_nuc]] += 1
 
             trg_pos += 1
 
@@ -154,31 +180,39 @@ def _contig_profile(alignment, platform, genome_len):
 
 
 def _flatten_profile(profile):
+    """
+    Majority vote for each position (ties are resolved in favor of the
+    reference base, then in the column order), then insertions
+    supported by the majority
+    """
+    counts = profile.counts
+    ref_nucl = profile.nucl
+    insertions = profile.insertions
+
     growing_seq = []
     ins_group = defaultdict(int)
-
-    for elem in profile:
-        pos_matches = elem.matches
-        pos_insertions = elem.insertions
-        pos_nucl = elem.nucl
-
-        ins_group.clear()
-        for ins_str in itervalues(pos_insertions):
-            ins_group[ins_str] += 1
-
-        match_and_del_num = sum(itervalues(pos_matches))
-        num_ins = len(pos_insertions)
-
-        max_match = pos_nucl
-        if len(pos_matches):
-            max_match = max(pos_matches, key=pos_matches.get)
-        max_insert = None
-        if ins_group:
-            max_insert = max(ins_group, key=ins_group.get)
-
+    for pos in range(len(profile)):
+        row = counts[pos * _NUM_COLUMNS : (pos + 1) * _NUM_COLUMNS]
+        match_and_del_num = sum(row)
+
+        if match_and_del_num:
+            max_count = max(row)
+            max_column = _COLUMN_ID[ref_nucl[pos]]
+            if row[max_column] != max_count:
+                max_column = row.index(max_count)
+            max_match = _PILEUP_NUCL[max_column]
+        else:
+            max_match = chr(ref_nucl[pos])
         if max_match != "-":
             growing_seq.append(max_match)
-        if max_insert and max_insert != "-" and num_ins > match_and_del_num // 2:
-            growing_seq.append(max_insert)
+
+        pos_insertions = insertions.get(pos)
+        if pos_insertions and len(pos_insertions) > match_and_del_num // 2:
+            ins_group.clear()
+            for ins_str in itervalues(pos_insertions):
+                ins_group[ins_str] += 1
+            max_insert = max(ins_group, key=ins_group.get)
+            if max_insert != "-":
+                growing_seq.append(max_insert)
 
     return "".join(growing_seq)
@@ -11,20 +11,35 @@ from __future__ import division
 import logging
 import subprocess
 import os
+import errno
+import fcntl
+import threading
+import time
+import shutil
 from collections import defaultdict
+from array import array
+from bisect import bisect_right
 
 from flye.polishing.alignment import (make_alignment, get_contigs_info,
                                       merge_chunks, split_into_chunks)
-from flye.utils.sam_parser import SynchronizedSamReader
-from flye.polishing.bubbles import make_bubbles
+from flye.utils.sam_parser import (SynchronizedSamReader, read_paf,
+                                   read_sam_spans)
+from flye.polishing.bubbles import make_bubbles, remove_bubbles, read_manifest
+from flye.polishing.subsample import subsample_reads
+from flye.polishing.binary_records import read_consensus, CONSENSUS_MAGIC
 import flye.utils.fasta_parser as fp
 from flye.utils.utils import which
+import flye.utils.telemetry as telemetry
+import flye.utils.log_scope as log_scope
+from flye.utils.checkpoint import Checkpoint, write_state, read_state
 import flye.config.py_cfg as cfg
-from flye.six import iteritems
+from flye.six import iteritems, itervalues
 from flye.six.moves import range
 
 
 POLISH_BIN = "flye-polish"
+#separates the group id from the original names in polish_batch
+_BATCH_SEPARATOR = "@"
 
 logger = logging.getLogger()
 
@@ -49,143 +64,773 @@ def check_binaries():
 
 
 def polish(contig_seqs, read_seqs, work_dir, num_iters, num_threads, error_mode,
-           output_progress):
+           output_progress, group_separator=None, liftover=None,
+           checkpoint=None):
     """
-    High-level polisher interface
+    High-level polisher interface. In the incremental mode, the iterations
+    after the first one only re-polish the windows around the regions
+    that were changed by the previous iteration, using the reads that
+    were aligned to these windows at that iteration. If group_separator is
+    given, reads are only used for the contigs of the same group
+    (see polish_batch). liftover is an optional dictionary of
+    intervals (contig_id, start, end, strand) on the input contigs,
+    which are updated in place to the polished contig coordinates.
+    Intervals that could not be lifted are removed.
+    Completed iterations (and, within an iteration, the generated bubbles
+    and polished bubble groups) are recorded in the checkpoint,
+    and polishing continues from there if it was interrupted.
+    Without output_progress, the log output of this call is dropped
+    (other threads, such as concurrent stages, keep logging)
     """
-    logger_state = logger.disabled
-    if not output_progress:
-        logger.disabled = True
+    if checkpoint is None:
+        checkpoint = Checkpoint()
+    with log_scope.quiet(not output_progress):
+        return _polish(contig_seqs, read_seqs, work_dir, num_iters,
+                       num_threads, error_mode, output_progress,
+                       group_separator, liftover, checkpoint)
 
+
+def _polish(contig_seqs, read_seqs, work_dir, num_iters, num_threads,
+            error_mode, output_progress, group_separator, liftover,
+            checkpoint):
     subs_matrix = os.path.join(cfg.vals["pkg_root"],
                                cfg.vals["err_modes"][error_mode]["subs_matrix"])
     hopo_matrix = os.path.join(cfg.vals["pkg_root"],
                                cfg.vals["err_modes"][error_mode]["hopo_matrix"])
     stats_file = os.path.join(work_dir, "contigs_stats.txt")
 
+    MIN_CHANGE_RATE = cfg.vals["polish_min_change_rate"]
+
+    reads_subset = os.path.join(work_dir, "reads_subset.fasta")
+    if subsample_reads(read_seqs, contig_seqs, reads_subset):
+        read_seqs = [reads_subset]
+    else:
+        reads_subset = None
+
     prev_assembly = contig_seqs
     contig_lengths = None
-    coverage_stats = None
-    for i in range(num_iters):
+    contig_coverage = None
+    #regions changed by the previous iteration
+    changed_regions = None
+    first_iter = 0
+    resumed = _load_iteration(checkpoint, liftover)
+    if resumed is not None:
+        (first_iter, prev_assembly, contig_lengths, contig_coverage,
+         changed_regions, stopped) = resumed
+        logger.info("Resuming polishing after iteration %d", first_iter)
+        if stopped:
+            first_iter = num_iters
+
+    for i in range(first_iter, num_iters):
         logger.info("Polishing genome (%d/%d)", i + 1, num_iters)
+        polished_file = os.path.join(work_dir, "polished_{0}.fasta".format(i + 1))
+
+        windows = None
+        iter_reads = read_seqs
+        window_reads = _window_reads_path(work_dir, i + 1)
+        if changed_regions is not None and cfg.vals["incremental_polishing"]:
+            prev_seqs = fp.read_sequence_dict(prev_assembly)
+            windows = _get_polishing_windows(contig_lengths, changed_regions,
+                                             cfg.vals["polish_window_margin"])
+            if not windows:
+                logger.info("No changes at the previous iteration, "
+                            "skipping polishing")
+                if os.path.exists(window_reads):
+                    os.remove(window_reads)
+                fp.write_fasta_dict(prev_seqs, polished_file)
+                prev_assembly = polished_file
+                _save_iteration(checkpoint, work_dir, i + 1, polished_file,
+                                contig_lengths, contig_coverage,
+                                changed_regions, liftover, False)
+                continue
+
+            window_seqs = _extract_windows(prev_seqs, windows)
+            logger.info("Re-polishing %d windows of total length %d",
+                        len(window_seqs),
+                        sum(len(s) for s in window_seqs.values()))
+            #the reads were selected at the previous iteration (the file
+            #could be missing if it was resumed from the bubbles)
+            if os.path.exists(window_reads):
+                iter_reads = [window_reads]
 
         #split into 1Mb chunks to reduce RAM usage
         #slightly vary chunk size between iterations
         CHUNK_SIZE = 1000000 - (i % 2) * 100000
         chunks_file = os.path.join(work_dir, "chunks_{0}.fasta".format(i + 1))
-        chunks = split_into_chunks(fp.read_sequence_dict(prev_assembly),
-                                       CHUNK_SIZE)
-        fp.write_fasta_dict(chunks, chunks_file)
+        chunks_index = _write_chunks(fp.stream_sequence(prev_assembly)
+                                     if windows is None
+                                     else iteritems(window_seqs),
+                                     chunks_file, CHUNK_SIZE)
+
+        #bubbles of this iteration could be already generated
+        bubbles_file = os.path.join(work_dir, "bubbles_{0}.fasta".format(i + 1))
+        resumed_bubbles = None
+        if not cfg.vals["stream_bubbles"]:
+            resumed_bubbles = _load_bubbles(checkpoint, i + 1, bubbles_file)
 
         ####
-        logger.info("Running minimap2")
         alignment_file = os.path.join(work_dir, "minimap_{0}.sam".format(i + 1))
-        make_alignment(chunks_file, read_seqs, num_threads,
-                       work_dir, error_mode, alignment_file,
-                       reference_mode=True, sam_output=True)
+        if resumed_bubbles is None:
+            logger.info("Running minimap2")
+            sam_sorter = make_alignment(chunks_file, iter_reads, num_threads,
+                                        work_dir, error_mode, alignment_file,
+                                        reference_mode=True, sam_output=True,
+                                        stream_sorting=True,
+                                        group_separator=group_separator)
 
         #####
-        logger.info("Separating alignment into bubbles")
         contigs_info = get_contigs_info(chunks_file)
-        bubbles_file = os.path.join(work_dir,
-                                    "bubbles_{0}.fasta".format(i + 1))
-        coverage_stats, mean_aln_error = \
-            make_bubbles(alignment_file, contigs_info, chunks_file,
-                         error_mode, num_threads,
-                         bubbles_file)
-
-        logger.info("Alignment error rate: %f", mean_aln_error)
-        consensus_out = os.path.join(work_dir, "consensus_{0}.fasta".format(i + 1))
-        polished_file = os.path.join(work_dir, "polished_{0}.fasta".format(i + 1))
-        if os.path.getsize(bubbles_file) == 0:
-            logger.info("No reads were aligned during polishing")
-            if not output_progress:
-                logger.disabled = logger_state
-            open(stats_file, "w").write("#seq_name\tlength\tcoverage\n")
-            open(polished_file, "w")
-            return polished_file, stats_file
+        spool_file = os.path.join(work_dir, "consensus_{0}.seq".format(i + 1))
+        if cfg.vals["stream_bubbles"]:
+            logger.info("Separating alignment into bubbles and correcting them")
+            coverage_stats, mean_aln_error, consensus_index = \
+                _polish_streaming(alignment_file, contigs_info, chunks_file,
+                                  error_mode, num_threads, sam_sorter,
+                                  subs_matrix, hopo_matrix, work_dir, i + 1,
+                                  spool_file, group_separator)
+            logger.info("Alignment error rate: %f", mean_aln_error)
+        elif resumed_bubbles is None:
+            logger.info("Separating alignment into bubbles")
+            coverage_stats, mean_aln_error = \
+                make_bubbles(alignment_file, contigs_info, chunks_file,
+                             error_mode, num_threads,
+                             bubbles_file, sam_sorter,
+                             group_separator=group_separator)
+            _save_bubbles(checkpoint, i + 1, bubbles_file, coverage_stats,
+                          mean_aln_error)
+        else:
+            logger.info("Resuming from the previously generated bubbles")
+            coverage_stats, mean_aln_error = resumed_bubbles
 
-        #####
-        logger.info("Correcting bubbles")
-        _run_polish_bin(bubbles_file, subs_matrix, hopo_matrix,
-                        consensus_out, num_threads, output_progress)
-        polished_fasta, polished_lengths = _compose_sequence(consensus_out)
-        merged_chunks = merge_chunks(polished_fasta)
-        fp.write_fasta_dict(merged_chunks, polished_file)
+        if not cfg.vals["stream_bubbles"]:
+
+            logger.info("Alignment error rate: %f", mean_aln_error)
+            consensus_out = os.path.join(work_dir,
+                                         "consensus_{0}.fasta".format(i + 1))
+            consensus_index = {}
+            if os.path.getsize(bubbles_file) > 0:
+                #####
+                logger.info("Correcting bubbles")
+                consensus_files = \
+                    _run_polish_bin(bubbles_file, subs_matrix, hopo_matrix,
+                                    consensus_out, num_threads, output_progress,
+                                    checkpoint)
+                consensus_index = _index_consensus(consensus_files, spool_file)
+                for consensus_file in consensus_files:
+                    os.remove(consensus_file)
+            remove_bubbles(bubbles_file)
+            if os.path.exists(bubbles_file + ".state"):
+                os.remove(bubbles_file + ".state")
+
+        polished_seqs = _compose_sequence(chunks_file, chunks_index,
+                                          consensus_index, spool_file)
+        if windows is not None:
+            #windows without aligned reads remain as they are
+            merged_windows = {}
+            window_changes = {}
+            for window_name, window_seq, regions in polished_seqs:
+                merged_windows[window_name] = window_seq
+                window_changes[window_name] = (len(window_seq), regions)
+            merged_chunks, changed_regions = \
+                _splice_windows(prev_seqs, windows, merged_windows,
+                                window_changes)
+            prev_lengths = {ctg_id: len(seq) for ctg_id, seq
+                            in iteritems(prev_seqs)}
+            contig_lengths = {ctg_id: len(seq) for ctg_id, seq
+                              in iteritems(merged_chunks)}
+            fp.write_fasta_dict(merged_chunks, polished_file)
+            del prev_seqs, window_seqs, merged_chunks
+
+        else:
+            #contigs are written one by one, as they are composed
+            prev_lengths = {ctg_id: ctg_len for ctg_id, (_, _, ctg_len)
+                            in iteritems(chunks_index)}
+            contig_lengths, changed_regions = \
+                _write_polished(polished_seqs, polished_file)
+            if not contig_lengths:
+                logger.info("No reads were aligned during polishing")
+                open(stats_file, "w").write("#seq_name\tlength\tcoverage\n")
+                if os.path.exists(spool_file):
+                    os.remove(spool_file)
+                if reads_subset:
+                    os.remove(reads_subset)
+                return polished_file, stats_file
+
+            contig_coverage = merge_chunks(coverage_stats,
+                                           fold_function=lambda l: sum(l) // len(l))
+        if os.path.exists(spool_file):
+            os.remove(spool_file)
+        if liftover:
+            _update_liftover(liftover, prev_lengths, contig_lengths,
+                             changed_regions)
+
+        #reads for the windows of the next iteration
+        if (cfg.vals["incremental_polishing"] and i + 1 < num_iters and
+                os.path.exists(alignment_file)):
+            next_windows = \
+                _get_polishing_windows(contig_lengths, changed_regions,
+                                       cfg.vals["polish_window_margin"])
+            _select_window_reads(alignment_file, CHUNK_SIZE, windows,
+                                 next_windows, changed_regions, read_seqs,
+                                 _window_reads_path(work_dir, i + 2))
 
         #Cleanup
         os.remove(chunks_file)
-        os.remove(bubbles_file)
-        os.remove(consensus_out)
-        os.remove(alignment_file)
+        if os.path.exists(alignment_file):
+            os.remove(alignment_file)
+        if os.path.exists(window_reads):
+            os.remove(window_reads)
 
-        contig_lengths = polished_lengths
         prev_assembly = polished_file
 
-    #merge information from chunks
-    contig_lengths = merge_chunks(contig_lengths, fold_function=sum)
-    coverage_stats = merge_chunks(coverage_stats,
-                                  fold_function=lambda l: sum(l) // len(l))
+        changed_bases = sum(r[2] for regions in itervalues(changed_regions)
+                            for r in regions)
+        change_rate = changed_bases / max(sum(itervalues(contig_lengths)), 1)
+        logger.info("Changed bases: %d (%f per base)", changed_bases,
+                    change_rate)
+        stop = (MIN_CHANGE_RATE is not None and change_rate < MIN_CHANGE_RATE
+                and i + 1 < num_iters)
+        _save_iteration(checkpoint, work_dir, i + 1, polished_file,
+                        contig_lengths, contig_coverage, changed_regions,
+                        liftover, stop)
+        if stop:
+            logger.info("Change rate is below %f, stopping polishing",
+                        MIN_CHANGE_RATE)
+            break
+
+    if reads_subset:
+        os.remove(reads_subset)
 
     with open(stats_file, "w") as f:
         f.write("#seq_name\tlength\tcoverage\n")
         for ctg_id in contig_lengths:
             f.write("{0}\t{1}\t{2}\n".format(ctg_id,
-                    contig_lengths[ctg_id], coverage_stats[ctg_id]))
-
-    if not output_progress:
-        logger.disabled = logger_state
+                    contig_lengths[ctg_id], contig_coverage[ctg_id]))
 
     return prev_assembly, stats_file
 
 
+def _save_iteration(checkpoint, work_dir, iter_num, polished_file,
+                    contig_lengths, contig_coverage, changed_regions,
+                    liftover, stopped):
+    """
+    Records the completed polishing iteration
+    """
+    state_file = os.path.join(work_dir, "polished_{0}.state".format(iter_num))
+    write_state({"assembly": polished_file,
+                 "contig_lengths": contig_lengths,
+                 "contig_coverage": contig_coverage,
+                 "changed_regions": changed_regions,
+                 "liftover": liftover}, state_file)
+    with checkpoint.lock:
+        prev_iteration = checkpoint.get("iteration")
+        checkpoint.clear("bubbles", "polish_groups")
+        checkpoint.set("iteration", {"number": iter_num, "state": state_file,
+                                     "stopped": stopped})
+    if (prev_iteration is not None and prev_iteration["state"] != state_file
+            and os.path.exists(prev_iteration["state"])):
+        os.remove(prev_iteration["state"])
+
+
+def _load_iteration(checkpoint, liftover):
+    """
+    The last completed iteration (number, assembly, contig lengths and
+    coverage, changed regions, whether polishing was stopped), None if
+    there was no iteration or its output is missing. liftover is
+    updated in place to the state after the iteration
+    """
+    iteration = checkpoint.get("iteration")
+    if iteration is None or not os.path.exists(iteration["state"]):
+        return None
+    state = read_state(iteration["state"])
+    if not os.path.exists(state["assembly"]):
+        return None
+
+    changed_regions = None
+    if state["changed_regions"] is not None:
+        changed_regions = {ctg: [tuple(r) for r in regions]
+                           for ctg, regions in iteritems(state["changed_regions"])}
+    if liftover is not None and state["liftover"] is not None:
+        liftover.clear()
+        for key, interval in iteritems(state["liftover"]):
+            liftover[key] = tuple(interval)
+    return (iteration["number"], state["assembly"], state["contig_lengths"],
+            state["contig_coverage"], changed_regions, iteration["stopped"])
+
+
+def _save_bubbles(checkpoint, iter_num, bubbles_file, coverage_stats,
+                  mean_aln_error):
+    """
+    Records the bubbles generated at the given iteration
+    """
+    state_file = bubbles_file + ".state"
+    write_state({"coverage_stats": coverage_stats,
+                 "mean_aln_error": mean_aln_error}, state_file)
+    checkpoint.set("bubbles", {"iteration": iter_num, "state": state_file})
+
+
+def _load_bubbles(checkpoint, iter_num, bubbles_file):
+    """
+    Coverage stats and alignment error of the previously generated
+    bubbles of the iteration, None if they are not available
+    """
+    bubbles = checkpoint.get("bubbles")
+    if (bubbles is None or bubbles["iteration"] != iter_num or
+            not os.path.exists(bubbles["state"]) or
+            not os.path.exists(bubbles_file)):
+        return None
+    if not all(os.path.exists(f) for f in read_manifest(bubbles_file)):
+        return None
+    state = read_state(bubbles["state"])
+    return state["coverage_stats"], state["mean_aln_error"]
+
+
+def polish_batch(groups, work_dir, num_iters, num_threads, error_mode,
+                 output_progress):
+    """
+    Polishes many small targets at once. Each group is a tuple
+    (contigs file, list of reads files, output directory). Contigs and
+    reads are renamed with the group prefix, so all the groups go through
+    a single alignment and polishing binary run, and the reads
+    are only used for the contigs of their own group. Returns the list
+    of (polished file, stats file) for the groups, same as polish()
+    """
+    batch_contigs = os.path.join(work_dir, "batch_contigs.fasta")
+    batch_reads = os.path.join(work_dir, "batch_reads.fasta")
+    contigs = {}
+    with open(batch_reads, "wb") as reads_out:
+        for group_id, (contigs_file, reads_files, _) in enumerate(groups):
+            prefix = _batch_prefix(group_id)
+            for hdr, seq in iteritems(fp.read_sequence_dict(contigs_file)):
+                contigs[prefix + hdr] = seq
+            prefix_bytes = prefix.encode("ascii")
+            for reads_file in reads_files:
+                for hdr, seq, _ in fp.stream_raw_records(reads_file):
+                    reads_out.write(b">" + prefix_bytes + hdr + b"\n" +
+                                    seq + b"\n")
+    fp.write_fasta_dict(contigs, batch_contigs)
+
+    polished_file, stats_file = \
+        polish(batch_contigs, [batch_reads], work_dir, num_iters, num_threads,
+               error_mode, output_progress, group_separator=_BATCH_SEPARATOR)
+
+    #splitting the output back into groups
+    polished_seqs = fp.read_sequence_dict(polished_file)
+    with open(stats_file, "r") as f:
+        stats_lines = [line for line in f if not line.startswith("#")]
+    for batch_file in set([batch_contigs, batch_reads, polished_file, stats_file]):
+        os.remove(batch_file)
+
+    outputs = []
+    for group_id, (_, _, out_dir) in enumerate(groups):
+        prefix = _batch_prefix(group_id)
+        group_polished = os.path.join(out_dir, os.path.basename(polished_file))
+        group_stats = os.path.join(out_dir, os.path.basename(stats_file))
+        fp.write_fasta_dict({hdr[len(prefix):]: seq for hdr, seq
+                             in iteritems(polished_seqs)
+                             if hdr.startswith(prefix)}, group_polished)
+        with open(group_stats, "w") as f:
+            f.write("#seq_name\tlength\tcoverage\n")
+            for line in stats_lines:
+                if line.startswith(prefix):
+                    f.write(line[len(prefix):])
+        outputs.append((group_polished, group_stats))
+
+    return outputs
+
+
+def _batch_prefix(group_id):
+    return "{0}{1}".format(group_id, _BATCH_SEPARATOR)
+
+
+def polish_regions(contig_seqs, regions_file, read_seqs, work_dir, num_iters,
+                   num_threads, error_mode, output_progress):
+    """
+    Only polishes the given regions of the contigs. The regions
+    (extended by the margin) are extracted along with the reads that
+    are aligned to them, polished, and spliced back into the contigs.
+    The regions file is either in BED format, or a list of contig ids
+    """
+    MARGIN = cfg.vals["polish_window_margin"]
+
+    regions_dir = os.path.join(work_dir, "regions")
+    if not os.path.isdir(regions_dir):
+        os.mkdir(regions_dir)
+
+    contigs = fp.read_sequence_dict(contig_seqs)
+    target_regions = _read_regions(regions_file, contigs)
+    windows = _get_polishing_windows({ctg_id: len(seq) for ctg_id, seq
+                                      in iteritems(contigs)},
+                                     target_regions, MARGIN)
+    window_seqs = _extract_windows(contigs, windows)
+    logger.info("Polishing %d regions of total length %d", len(window_seqs),
+                sum(len(s) for s in window_seqs.values()))
+
+    windows_file = os.path.join(regions_dir, "regions.fasta")
+    region_reads = os.path.join(regions_dir, "regions_reads.fasta")
+    fp.write_fasta_dict(window_seqs, windows_file)
+    _extract_region_reads(windows_file, read_seqs, region_reads, regions_dir,
+                          error_mode, num_threads)
+
+    polished_windows_file, windows_stats = \
+        polish(windows_file, [region_reads], regions_dir, num_iters,
+               num_threads, error_mode, output_progress)
+    polished_windows = fp.read_sequence_dict(polished_windows_file)
+    window_coverage = {}
+    with open(windows_stats, "r") as f:
+        for line in f:
+            if line.startswith("#"): continue
+            window_name, _, coverage = line.strip().split("\t")
+            window_coverage[window_name] = int(coverage)
+    shutil.rmtree(regions_dir)
+
+    #windows without aligned reads remain as they are
+    polished_contigs, _ = \
+        _splice_windows(contigs, windows, polished_windows,
+                        {w: (len(seq), []) for w, seq
+                         in iteritems(polished_windows)})
+    polished_file = os.path.join(work_dir,
+                                 "polished_{0}.fasta".format(num_iters))
+    fp.write_fasta_dict(polished_contigs, polished_file)
+
+    #contigs without polished regions have zero coverage
+    stats_file = os.path.join(work_dir, "contigs_stats.txt")
+    with open(stats_file, "w") as f:
+        f.write("#seq_name\tlength\tcoverage\n")
+        for ctg_id in sorted(polished_contigs):
+            ctg_coverage = [window_coverage[_window_name(ctg_id, w)]
+                            for w in range(len(windows.get(ctg_id, [])))
+                            if _window_name(ctg_id, w) in window_coverage]
+            f.write("{0}\t{1}\t{2}\n".format(ctg_id,
+                    len(polished_contigs[ctg_id]),
+                    sum(ctg_coverage) // max(len(ctg_coverage), 1)))
+
+    return polished_file, stats_file
+
+
+def _read_regions(regions_file, contig_seqs):
+    """
+    Reads the regions to polish in BED format (0-based, end-exclusive),
+    lines with only a contig id select the whole contig
+    """
+    regions = defaultdict(list)
+    with open(regions_file, "r") as f:
+        for line in f:
+            tokens = line.strip().split()
+            if not tokens or tokens[0].startswith("#") or \
+                    tokens[0] in ["track", "browser"]:
+                continue
+            ctg_id = tokens[0]
+            if ctg_id not in contig_seqs:
+                raise PolishException("Region contig {0} is not in the "
+                                      "polishing target".format(ctg_id))
+            if len(tokens) == 1:
+                start, end = 0, len(contig_seqs[ctg_id])
+            else:
+                try:
+                    start, end = int(tokens[1]), int(tokens[2])
+                except (IndexError, ValueError):
+                    raise PolishException("Error parsing regions line: {0}"
+                                          .format(line.strip()))
+            start, end = max(start, 0), min(end, len(contig_seqs[ctg_id]))
+            if start < end:
+                #same format as the changed regions
+                regions[ctg_id].append((start, end, 0, 0))
+    return regions
+
+
+def _extract_region_reads(regions_file, read_seqs, out_file, work_dir,
+                          error_mode, num_threads):
+    """
+    Writes the reads that are aligned to the regions. The alignment
+    is only used to select reads, so the coordinates-only PAF is enough
+    """
+    alignment_file = os.path.join(work_dir, "regions_reads.paf")
+    make_alignment(regions_file, read_seqs, num_threads, work_dir,
+                   error_mode, alignment_file, reference_mode=True,
+                   sam_output=False)
+    aligned_reads = set(hit.query for hit in read_paf(alignment_file))
+    os.remove(alignment_file)
+
+    num_reads = _write_selected_reads(read_seqs, aligned_reads, out_file)
+    logger.info("Selected %d reads aligned to the regions", num_reads)
+
+
+def _write_selected_reads(read_seqs, read_names, out_file):
+    num_reads = 0
+    with open(out_file, "wb") as f:
+        for reads_file in read_seqs:
+            for hdr, seq, _ in fp.stream_raw_records(reads_file):
+                if hdr.decode("ascii") in read_names:
+                    f.write(b">" + hdr + b"\n" + seq + b"\n")
+                    num_reads += 1
+    return num_reads
+
+
+def _window_reads_path(work_dir, iter_num):
+    return os.path.join(work_dir, "window_reads_{0}.fasta".format(iter_num))
+
+
+def _select_window_reads(alignment_file, chunk_size, windows, next_windows,
+                         changed_regions, read_seqs, out_file):
+    """
+    Writes the reads that are aligned (at the current iteration) to the
+    windows of the next iteration, so only these reads are aligned there.
+    The alignment is to the chunks of the current contigs (or windows),
+    so the next windows are mapped back to the current coordinates
+    """
+    #changed regions in the coordinates before the iteration
+    #(same format, see _lift_positions)
+    prev_windows = {}
+    for ctg_id, ctg_windows in iteritems(next_windows):
+        inverse_regions = []
+        shift = 0
+        for start, end, num_changed, orig_len in changed_regions.get(ctg_id,
+                                                                     []):
+            inverse_regions.append((start - shift, start - shift + orig_len,
+                                    num_changed, end - start))
+            shift += end - start - orig_len
+        lifted = _lift_positions([p for w in ctg_windows for p in w],
+                                 inverse_regions)
+        prev_windows[ctg_id] = (lifted[0::2], lifted[1::2])
+
+    selected_reads = set()
+    for read_id, chunk_id, start, end in read_sam_spans(alignment_file):
+        seq_id, chunk_num = chunk_id.rsplit("$chunk_", 1)
+        offset = int(chunk_num) * chunk_size
+        if windows is not None:
+            seq_id, window_id = seq_id.rsplit("$window_", 1)
+            offset += windows[seq_id][int(window_id)][0]
+        if seq_id not in prev_windows:
+            continue
+
+        win_starts, win_ends = prev_windows[seq_id]
+        win_id = bisect_right(win_starts, offset + end - 1) - 1
+        if win_id >= 0 and win_ends[win_id] > offset + start:
+            selected_reads.add(read_id)
+
+    num_reads = _write_selected_reads(read_seqs, selected_reads, out_file)
+    logger.debug("Selected %d reads for the next iteration windows", num_reads)
+
+
+def _get_polishing_windows(contig_lengths, changed_regions, margin):
+    """
+    Extends the changed regions by the margin (so that the reads
+    spanning them are aligned) and merges the overlapping ones
+    """
+    windows = {}
+    for ctg_id, ctg_len in iteritems(contig_lengths):
+        ctg_windows = []
+        for start, end, _, _ in sorted(changed_regions.get(ctg_id, [])):
+            start = max(0, start - margin)
+            end = min(ctg_len, end + margin)
+            if ctg_windows and start <= ctg_windows[-1][1]:
+                ctg_windows[-1][1] = max(ctg_windows[-1][1], end)
+            else:
+                ctg_windows.append([start, end])
+        if ctg_windows:
+            windows[ctg_id] = ctg_windows
+    return windows
+
+
+def _window_name(ctg_id, window_id):
+    #compatible with merge_chunks, so windows can be split into chunks
+    return "{0}$window_{1}".format(ctg_id, window_id)
+
+
+def _extract_windows(contig_seqs, windows):
+    window_seqs = {}
+    for ctg_id, ctg_windows in iteritems(windows):
+        for window_id, (start, end) in enumerate(ctg_windows):
+            window_seqs[_window_name(ctg_id, window_id)] = \
+                contig_seqs[ctg_id][start:end]
+    return window_seqs
+
+
+def _splice_windows(contig_seqs, windows, polished_windows, window_changes):
+    """
+    Replaces the windows of the contigs with their polished versions.
+    Returns the new sequences and the changed regions in their coordinates
+    """
+    out_seqs = {}
+    out_changes = {}
+    for ctg_id, ctg_seq in iteritems(contig_seqs):
+        pieces = []
+        regions = []
+        out_len = 0
+        prev_end = 0
+        for window_id, (start, end) in enumerate(windows.get(ctg_id, [])):
+            window_name = _window_name(ctg_id, window_id)
+            pieces.append(ctg_seq[prev_end:start])
+            out_len += start - prev_end
+            if window_name in polished_windows:
+                window_seq = polished_windows[window_name]
+                regions.extend((s + out_len, e + out_len, n, l)
+                               for s, e, n, l in window_changes[window_name][1])
+            else:
+                window_seq = ctg_seq[start:end]
+            pieces.append(window_seq)
+            out_len += len(window_seq)
+            prev_end = end
+        pieces.append(ctg_seq[prev_end:])
+
+        out_seqs[ctg_id] = "".join(pieces)
+        out_changes[ctg_id] = regions
+    return out_seqs, out_changes
+
+
+def _concat_regions(pieces):
+    """
+    Fold function for merge_chunks: concatenates (length, regions) pieces
+    """
+    regions = []
+    offset = 0
+    for length, piece_regions in pieces:
+        regions.extend((s + offset, e + offset, n, l)
+                       for s, e, n, l in piece_regions)
+        offset += length
+    return offset, regions
+
+
+def _update_liftover(liftover, prev_lengths, new_lengths, changed_regions):
+    """
+    Lifts the intervals to the coordinates of the new sequences,
+    given the sequence lengths before and after the iteration
+    """
+    positions = defaultdict(list)
+    for ctg_id, start, end, _ in itervalues(liftover):
+        positions[ctg_id].extend([start, end])
+
+    lifted = {}
+    for ctg_id, ctg_positions in iteritems(positions):
+        regions = changed_regions.get(ctg_id, [])
+        #the contig could be dropped, or some of its chunks
+        #could remain unpolished - then the regions are incomplete
+        if (ctg_id not in new_lengths or
+                prev_lengths[ctg_id] + sum(e - s - l for s, e, _, l in regions)
+                != new_lengths[ctg_id]):
+            continue
+        lifted[ctg_id] = dict(zip(ctg_positions,
+                                  _lift_positions(ctg_positions, regions)))
+
+    for interval_id, (ctg_id, start, end, strand) in list(iteritems(liftover)):
+        if ctg_id in lifted:
+            liftover[interval_id] = (ctg_id, lifted[ctg_id][start],
+                                     lifted[ctg_id][end], strand)
+        else:
+            del liftover[interval_id]
+
+
+def _lift_positions(positions, regions):
+    """
+    Maps the positions to the new coordinates, given the sorted changed
+    regions (see _changed_regions). Positions inside a changed region
+    are mapped to the same offset from the region start
+    """
+    lifted = [None] * len(positions)
+    shift = 0
+    reg_id = 0
+    for pos_id in sorted(range(len(positions)), key=positions.__getitem__):
+        pos = positions[pos_id]
+        while reg_id < len(regions):
+            start, end, _, orig_len = regions[reg_id]
+            if pos < start - shift + orig_len:
+                break
+            shift += end - start - orig_len
+            reg_id += 1
+
+        lifted[pos_id] = pos + shift
+        if reg_id < len(regions) and pos >= regions[reg_id][0] - shift:
+            lifted[pos_id] = min(lifted[pos_id], regions[reg_id][1])
+    return lifted
+
+
+def locate_edges(edges_file, contigs_file, contigs_stats):
+    """
+    Finds the exact positions of the graph edges in the (unpolished)
+    contigs, following the contig paths from the stats file. Edges
+    that do not occur in the contig exactly once (for example, the repeats
+    that were traversed using read sequences) are not located.
+    Returns the dictionary edge_id -> (contig_id, start, end, strand)
+    """
+    edges_dict = fp.read_sequence_dict(edges_file)
+    contigs_dict = fp.read_sequence_dict(contigs_file)
+    edge_positions = {}
+    ambiguous = set()
+    with open(contigs_stats, "r") as f:
+        for line in f:
+            if line.startswith("#"): continue
+            tokens = line.strip().split("\t")
+            ctg_id, graph_path = tokens[0], tokens[-1]
+            if ctg_id not in contigs_dict: continue
+
+            ctg_seq = contigs_dict[ctg_id]
+            for signed_id in graph_path.split(","):
+                edge_id = "edge_" + signed_id.lstrip("-")
+                if not edges_dict.get(edge_id) or edge_id in ambiguous:
+                    continue
+                if edge_id in edge_positions:
+                    #the edge is a part of multiple contigs
+                    del edge_positions[edge_id]
+                    ambiguous.add(edge_id)
+                    continue
+
+                strand = "-" if signed_id.startswith("-") else "+"
+                edge_seq = edges_dict[edge_id]
+                if strand == "-":
+                    edge_seq = fp.reverse_complement(edge_seq)
+                start = ctg_seq.find(edge_seq)
+                if start < 0 or ctg_seq.find(edge_seq, start + 1) >= 0:
+                    ambiguous.add(edge_id)
+                    continue
+                edge_positions[edge_id] = (ctg_id, start,
+                                           start + len(edge_seq), strand)
+
+    logger.debug("Located %d of %d edges in contigs", len(edge_positions),
+                 len(edges_dict))
+    return edge_positions
+
+
 def generate_polished_edges(edges_file, gfa_file, polished_contigs, work_dir,
-                            error_mode, num_threads):
+                            error_mode, num_threads, edge_positions=None):
     """
     Generate polished graph edges sequences by extracting them from
-    polished contigs
+    polished contigs. If edge_positions (edge_id -> (contig_id, start,
+    end, strand) on the polished contigs, see polish() liftover) are given,
+    the edges are cut directly, and only the remaining edges are aligned
+    to the contigs (PAF, coordinates only)
     """
     logger.debug("Generating polished GFA")
 
-    alignment_file = os.path.join(work_dir, "edges_aln.sam")
     polished_dict = fp.read_sequence_dict(polished_contigs)
-    make_alignment(polished_contigs, [edges_file], num_threads,
-                   work_dir, error_mode, alignment_file,
-                   reference_mode=True, sam_output=True)
-    aln_reader = SynchronizedSamReader(alignment_file,
-                                       polished_dict,
-                                       cfg.vals["max_read_coverage"])
-    aln_reader.init_reading()
-    aln_by_edge = defaultdict(list)
-
-    #getting one best alignment for each contig
-    while not aln_reader.is_eof():
-        _, ctg_aln = aln_reader.get_chunk()
-        for aln in ctg_aln:
-            aln_by_edge[aln.qry_id].append(aln)
-    aln_reader.stop_reading()
+    edges_dict = fp.read_sequence_dict(edges_file)
+    if edge_positions is None:
+        edge_maps = _map_edges_sam(edges_file, polished_contigs, polished_dict,
+                                   work_dir, error_mode, num_threads)
+    else:
+        edge_maps = {edge: pos for edge, pos in iteritems(edge_positions)
+                     if edge in edges_dict and pos[0] in polished_dict}
+        unmapped_edges = {edge: seq for edge, seq in iteritems(edges_dict)
+                          if edge not in edge_maps}
+        logger.debug("%d edges lifted over, %d aligned", len(edge_maps),
+                     len(unmapped_edges))
+        if unmapped_edges:
+            unmapped_file = os.path.join(work_dir, "edges_unmapped.fasta")
+            fp.write_fasta_dict(unmapped_edges, unmapped_file)
+            edge_maps.update(_map_edges_paf(unmapped_file, polished_contigs,
+                                            work_dir, error_mode, num_threads))
+            os.remove(unmapped_file)
 
     MIN_CONTAINMENT = 0.9
     updated_seqs = 0
-    edges_dict = fp.read_sequence_dict(edges_file)
-    for edge in edges_dict:
-        if edge in aln_by_edge:
-            main_aln = aln_by_edge[edge][0]
-            map_start = main_aln.trg_start
-            map_end = main_aln.trg_end
-            for aln in aln_by_edge[edge]:
-                if aln.trg_id == main_aln.trg_id and aln.trg_sign == main_aln.trg_sign:
-                    map_start = min(map_start, aln.trg_start)
-                    map_end = max(map_end, aln.trg_end)
-
-            new_seq = polished_dict[main_aln.trg_id][map_start : map_end]
-            if main_aln.qry_sign == "-":
-                new_seq = fp.reverse_complement(new_seq)
-
-            #print edge, main_aln.qry_len, len(new_seq), main_aln.qry_start, main_aln.qry_end
-            if len(new_seq) / aln.qry_len > MIN_CONTAINMENT:
-                edges_dict[edge] = new_seq
-                updated_seqs += 1
+    for edge, (ctg_id, map_start, map_end, strand) in iteritems(edge_maps):
+        new_seq = polished_dict[ctg_id][map_start : map_end]
+        if strand == "-":
+            new_seq = fp.reverse_complement(new_seq)
+
+        if len(new_seq) / len(edges_dict[edge]) > MIN_CONTAINMENT:
+            edges_dict[edge] = new_seq
+            updated_seqs += 1
 
     #writes fasta file with polished egdes
     #edges_polished = os.path.join(work_dir, "polished_edges.fasta")
@@ -205,7 +850,70 @@ def generate_polished_edges(edges_file, gfa_file, polished_contigs, work_dir,
 
     logger.debug("%d sequences remained unpolished",
                  len(edges_dict) - updated_seqs)
+
+
+def _map_edges_sam(edges_file, polished_contigs, polished_dict, work_dir,
+                   error_mode, num_threads):
+    """
+    Maps edges to the polished contigs using the SAM alignment.
+    Returns the dictionary edge_id -> (contig_id, start, end, strand)
+    """
+    alignment_file = os.path.join(work_dir, "edges_aln.sam")
+    make_alignment(polished_contigs, [edges_file], num_threads,
+                   work_dir, error_mode, alignment_file,
+                   reference_mode=True, sam_output=True)
+    aln_reader = SynchronizedSamReader(alignment_file,
+                                       polished_dict,
+                                       cfg.vals["max_read_coverage"])
+    aln_reader.init_reading()
+    aln_by_edge = defaultdict(list)
+
+    #getting one best alignment for each contig
+    while not aln_reader.is_eof():
+        _, ctg_aln = aln_reader.get_chunk()
+        for aln in ctg_aln:
+            aln_by_edge[aln.qry_id].append(aln)
+    aln_reader.stop_reading()
+    os.remove(alignment_file)
+
+    edge_maps = {}
+    for edge, edge_alns in iteritems(aln_by_edge):
+        main_aln = edge_alns[0]
+        map_start = main_aln.trg_start
+        map_end = main_aln.trg_end
+        for aln in edge_alns:
+            if aln.trg_id == main_aln.trg_id and aln.trg_sign == main_aln.trg_sign:
+                map_start = min(map_start, aln.trg_start)
+                map_end = max(map_end, aln.trg_end)
+        edge_maps[edge] = (main_aln.trg_id, map_start, map_end,
+                           main_aln.qry_sign)
+    return edge_maps
+
+
+def _map_edges_paf(edges_file, polished_contigs, work_dir, error_mode,
+                   num_threads):
+    """
+    Same as _map_edges_sam, but only uses the alignment coordinates
+    from the PAF output
+    """
+    alignment_file = os.path.join(work_dir, "edges_aln.paf")
+    make_alignment(polished_contigs, [edges_file], num_threads,
+                   work_dir, error_mode, alignment_file,
+                   reference_mode=True, sam_output=False)
+
+    #minimap2 outputs the primary alignment of each query first
+    edge_maps = {}
+    for hit in read_paf(alignment_file):
+        if hit.query not in edge_maps:
+            edge_maps[hit.query] = (hit.target, hit.target_start,
+                                    hit.target_end, hit.strand)
+        else:
+            ctg_id, map_start, map_end, strand = edge_maps[hit.query]
+            if hit.target == ctg_id and hit.strand == strand:
+                edge_maps[hit.query] = (ctg_id, min(map_start, hit.target_start),
+                                        max(map_end, hit.target_end), strand)
     os.remove(alignment_file)
+    return edge_maps
 
 
 def filter_by_coverage(args, stats_in, contigs_in, stats_out, contigs_out):
@@ -262,52 +970,374 @@ def filter_by_coverage(args, stats_in, contigs_in, stats_out, contigs_out):
                     ctg_stats[ctg_id][0], ctg_stats[ctg_id][1]))
 
 
+def _polish_streaming(alignment_file, contigs_info, chunks_file, error_mode,
+                      num_threads, sam_sorter, subs_matrix, hopo_matrix,
+                      work_dir, iter_id, spool_file, group_separator=None):
+    """
+    Generates bubbles and corrects them at the same time: bubbles are
+    passed to the polishing binary through a named pipe, and the
+    consensus is read back from another pipe while it is being produced
+    and indexed (see _index_consensus)
+    """
+    bubbles_pipe = os.path.join(work_dir, "bubbles_{0}.fifo".format(iter_id))
+    consensus_pipe = os.path.join(work_dir, "consensus_{0}.fifo".format(iter_id))
+    for pipe_path in [bubbles_pipe, consensus_pipe]:
+        if os.path.exists(pipe_path):
+            os.remove(pipe_path)
+        os.mkfifo(pipe_path)
+
+    cmdline = _polish_cmdline(bubbles_pipe, subs_matrix, hopo_matrix,
+                              consensus_pipe, num_threads, False) + ["--stream"]
+    polished = []
+    consensus_reader = \
+        threading.Thread(target=lambda: polished.append(
+                                            _index_consensus([consensus_pipe],
+                                                             spool_file)))
+    consensus_reader.daemon = True
+
+    polish_proc = None
+    try:
+        try:
+            polish_proc = telemetry.popen(cmdline)
+        except OSError as e:
+            raise PolishException(str(e))
+        consensus_reader.start()
+
+        #keeps the pipe open while the worker tasks write into it
+        pipe_fd = _open_pipe_writer(bubbles_pipe, polish_proc)
+        try:
+            coverage_stats, mean_aln_error = \
+                make_bubbles(alignment_file, contigs_info, chunks_file,
+                             error_mode, num_threads, None, sam_sorter,
+                             pipe_path=bubbles_pipe,
+                             group_separator=group_separator)
+        finally:
+            os.close(pipe_fd)
+
+        telemetry.wait(polish_proc)
+        if polish_proc.returncode == -9:
+            logger.error("Looks like the system ran out of memory")
+        if polish_proc.returncode != 0:
+            raise PolishException("Polishing binary exited with code: {0}"
+                                  .format(polish_proc.returncode))
+        consensus_reader.join()
+        if not polished:
+            raise PolishException("Error reading consensus from the pipe")
+    finally:
+        if polish_proc is not None and polish_proc.poll() is None:
+            polish_proc.kill()
+            polish_proc.wait()
+        for pipe_path in [bubbles_pipe, consensus_pipe]:
+            os.remove(pipe_path)
+
+    return coverage_stats, mean_aln_error, polished[0]
+
+
+def _open_pipe_writer(pipe_path, reader_proc):
+    """
+    Opens the named pipe for writing, once the reader process opens it.
+    Fails if the reader has exited before that, rather than waiting forever
+    """
+    while True:
+        try:
+            pipe_fd = os.open(pipe_path, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+        if reader_proc.poll() is not None:
+            raise PolishException("Polishing binary exited with code: {0}"
+                                  .format(reader_proc.returncode))
+        time.sleep(0.01)
+
+    flags = fcntl.fcntl(pipe_fd, fcntl.F_GETFL)
+    fcntl.fcntl(pipe_fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+    return pipe_fd
+
+
 def _run_polish_bin(bubbles_in, subs_matrix, hopo_matrix,
-                    consensus_out, num_threads, output_progress):
+                    consensus_out, num_threads, output_progress,
+                    checkpoint=None):
     """
-    Invokes polishing binary
+    Invokes polishing binary. If "polish_bin_shards" is more than one,
+    the bubble shards are split into balanced groups, which are polished
+    by separate processes (each with a part of the threads). Failed
+    groups are restarted on their own, and the completed groups are
+    recorded in the checkpoint (and skipped if polishing is resumed).
+    Returns the list of consensus files
     """
+    if checkpoint is None:
+        checkpoint = Checkpoint()
+    NUM_SHARDS = cfg.vals["polish_bin_shards"]
+    MAX_RETRIES = cfg.vals["polish_bin_retries"]
+
+    bubble_files = read_manifest(bubbles_in)
+    if NUM_SHARDS <= 1 or len(bubble_files) <= 1:
+        try:
+            telemetry.check_call(_polish_cmdline(bubbles_in, subs_matrix,
+                                                 hopo_matrix, consensus_out,
+                                                 num_threads,
+                                                 not output_progress))
+        except subprocess.CalledProcessError as e:
+            if e.returncode == -9:
+                logger.error("Looks like the system ran out of memory")
+            raise PolishException(str(e))
+        except OSError as e:
+            raise PolishException(str(e))
+        return [consensus_out]
+
+    groups = _balance_shards(bubble_files, NUM_SHARDS)
+    threads_per_group = max(num_threads // len(groups), 1)
+    logger.debug("Polishing %d bubble shards in %d processes with %d threads",
+                 len(bubble_files), len(groups), threads_per_group)
+    prefix, ext = os.path.splitext(consensus_out)
+    group_manifests = []
+    group_outputs = []
+    for group_id, group_files in enumerate(groups):
+        manifest = "{0}.group_{1}".format(bubbles_in, group_id)
+        with open(manifest, "w") as f:
+            for bubbles_file in group_files:
+                f.write(os.path.basename(bubbles_file) + "\n")
+        group_manifests.append(manifest)
+        group_outputs.append("{0}.{1}{2}".format(prefix, group_id, ext))
+
+    #consensus file -> bubble shards
+    completed = checkpoint.get("polish_groups", {})
+    pending = [group_id for group_id in range(len(groups))
+               if completed.get(group_outputs[group_id]) != groups[group_id] or
+               not os.path.exists(group_outputs[group_id])]
+    if len(pending) < len(groups):
+        logger.info("Skipping %d previously polished bubble groups",
+                    len(groups) - len(pending))
+
+    for attempt in range(MAX_RETRIES + 1):
+        if not pending:
+            break
+        if attempt > 0:
+            logger.warning("Restarting %d failed polishing processes",
+                           len(pending))
+        processes = []
+        try:
+            for group_id in pending:
+                cmdline = _polish_cmdline(group_manifests[group_id], subs_matrix,
+                                          hopo_matrix, group_outputs[group_id],
+                                          threads_per_group, True)
+                processes.append((group_id, telemetry.popen(cmdline)))
+        except OSError as e:
+            for _, proc in processes:
+                proc.kill()
+                proc.wait()
+            raise PolishException(str(e))
+
+        failed = []
+        for group_id, proc in processes:
+            telemetry.wait(proc)
+            if proc.returncode != 0:
+                if proc.returncode == -9:
+                    logger.error("Looks like the system ran out of memory")
+                logger.warning("Polishing process %d exited with code %d",
+                               group_id, proc.returncode)
+                failed.append(group_id)
+            else:
+                checkpoint.add("polish_groups", group_outputs[group_id],
+                               groups[group_id])
+        pending = failed
+        if not pending:
+            break
+
+    for manifest in group_manifests:
+        os.remove(manifest)
+    if pending:
+        raise PolishException("Polishing binary failed on {0} bubble groups"
+                              .format(len(pending)))
+    return group_outputs
+
+
+def _polish_cmdline(bubbles_in, subs_matrix, hopo_matrix, consensus_out,
+                    num_threads, quiet):
     cmdline = [POLISH_BIN, "--bubbles", bubbles_in, "--subs-mat", subs_matrix,
                "--hopo-mat", hopo_matrix, "--out", consensus_out,
                "--threads", str(num_threads)]
-    if not output_progress:
+    if quiet:
         cmdline.append("--quiet")
+    return cmdline
 
-    try:
-        subprocess.check_call(cmdline)
-    except subprocess.CalledProcessError as e:
-        if e.returncode == -9:
-            logger.error("Looks like the system ran out of memory")
-        raise PolishException(str(e))
-    except OSError as e:
-        raise PolishException(str(e))
+
+def _balance_shards(bubble_files, num_groups):
+    """
+    Splits the bubble files into groups of similar total size
+    (the largest files go first, each to the currently smallest group)
+    """
+    groups = [[] for _ in range(min(num_groups, len(bubble_files)))]
+    group_sizes = [0] * len(groups)
+    for bubbles_file in sorted(bubble_files, key=os.path.getsize,
+                               reverse=True):
+        group_id = group_sizes.index(min(group_sizes))
+        groups[group_id].append(bubbles_file)
+        group_sizes[group_id] += os.path.getsize(bubbles_file)
+    return groups
 
 
-def _compose_sequence(consensus_file):
+def _read_consensus(consensus_file):
     """
-    Concatenates bubbles consensuses into genome
+    Reads consensus records in the text or binary format. The file
+    is read sequentially, so it could be a pipe
     """
-    consensuses = defaultdict(list)
-    coverage = defaultdict(list)
-    with open(consensus_file, "r") as f:
+    with open(consensus_file, "rb") as f:
+        first_byte = f.read(1)
+        if first_byte == CONSENSUS_MAGIC[:1]:
+            if first_byte + f.read(len(CONSENSUS_MAGIC) - 1) != CONSENSUS_MAGIC:
+                raise PolishException("Error parsing consensus file")
+            for record in read_consensus(f):
+                yield record
+            return
+
         header = True
         for line in f:
+            if first_byte:
+                line = first_byte + line
+                first_byte = None
             if header:
-                tokens = line.strip().split(" ")
+                tokens = line.decode("ascii").strip().split(" ")
                 ctg_id = tokens[0][1:]
                 ctg_pos = int(tokens[1])
-                coverage[ctg_id].append(int(tokens[2]))
+                num_branches = int(tokens[2])
             else:
-                consensuses[ctg_id].append((ctg_pos, line.strip()))
+                yield ctg_id, ctg_pos, num_branches, line.decode("ascii").strip()
             header = not header
 
-    polished_fasta = {}
-    polished_stats = {}
-    for ctg_id, seqs in iteritems(consensuses):
-        sorted_seqs = [p[1] for p in sorted(seqs, key=lambda p: p[0])]
-        concat_seq = "".join(sorted_seqs)
-        #mean_coverage = sum(coverage[ctg_id]) / len(coverage[ctg_id])
-        polished_fasta[ctg_id] = concat_seq
-        polished_stats[ctg_id] = len(concat_seq)
 
-    return polished_fasta, polished_stats
+def _write_chunks(sequences, chunks_file, chunk_size):
+    """
+    Splits the (header, sequence) pairs into chunks (see split_into_chunks)
+    and writes them contig by contig, one line per sequence. Returns
+    the index: contig_id -> (file offset, number of chunks, contig length)
+    """
+    def chunk_num(hdr):
+        return int(hdr.rsplit("_", 1)[1])
+
+    chunks_index = {}
+    with open(chunks_file, "wb") as f:
+        for ctg_id, ctg_seq in sequences:
+            ctg_chunks = split_into_chunks({ctg_id: ctg_seq}, chunk_size)
+            #empty sequences can not be polished
+            chunk_hdrs = [h for h in sorted(ctg_chunks, key=chunk_num)
+                          if ctg_chunks[h]]
+            chunks_index[ctg_id] = (f.tell(), len(chunk_hdrs), len(ctg_seq))
+            for chunk_hdr in chunk_hdrs:
+                f.write(">{0}\n{1}\n".format(chunk_hdr, ctg_chunks[chunk_hdr])
+                        .encode("ascii"))
+    return chunks_index
+
+
+def _index_consensus(consensus_files, spool_file):
+    """
+    Reads the consensus records (which come in arbitrary order), stores
+    their sequences in the spool file and returns the position index:
+    chunk_id -> (positions, offsets in the spool, lengths)
+    """
+    consensus_index = {}
+    offset = 0
+    with open(spool_file, "wb") as spool:
+        for consensus_file in consensus_files:
+            for ctg_id, ctg_pos, _, seq in _read_consensus(consensus_file):
+                if ctg_id not in consensus_index:
+                    consensus_index[ctg_id] = (array("l"), array("l"),
+                                               array("l"))
+                positions, offsets, lengths = consensus_index[ctg_id]
+                positions.append(ctg_pos)
+                offsets.append(offset)
+                lengths.append(len(seq))
+                spool.write(seq.encode("ascii"))
+                offset += len(seq)
+    return consensus_index
+
+
+def _compose_sequence(chunks_file, chunks_index, consensus_index, spool_file):
+    """
+    Concatenates bubbles consensuses into genome. Yields
+    (contig_id, polished sequence, changed regions) for each contig
+    with polished chunks, so only one contig is kept in memory
+    """
+    if not consensus_index:
+        return
+
+    with open(chunks_file, "rb") as chunks_in, open(spool_file, "rb") as spool:
+        for ctg_id in sorted(chunks_index):
+            offset, num_chunks, _ = chunks_index[ctg_id]
+            chunks_in.seek(offset)
+            polished_chunks = []
+            for _ in range(num_chunks):
+                chunk_id = chunks_in.readline()[1:].rstrip().decode("ascii")
+                chunk_seq = chunks_in.readline().rstrip().decode("ascii")
+                if chunk_id not in consensus_index:
+                    continue
+
+                positions, offsets, lengths = consensus_index[chunk_id]
+                consensuses = []
+                for rec_id in sorted(range(len(positions)),
+                                     key=positions.__getitem__):
+                    spool.seek(offsets[rec_id])
+                    consensuses.append((positions[rec_id],
+                                        spool.read(lengths[rec_id])
+                                        .decode("ascii")))
+                polished_seq = "".join(c[1] for c in consensuses)
+                polished_chunks.append((polished_seq,
+                                        _changed_regions(chunk_seq,
+                                                         consensuses)))
+
+            if polished_chunks:
+                _, regions = \
+                    _concat_regions([(len(seq), chunk_regions)
+                                     for seq, chunk_regions in polished_chunks])
+                yield ctg_id, "".join(p[0] for p in polished_chunks), regions
+
+
+def _write_polished(polished_seqs, polished_file):
+    """
+    Writes the polished contigs as they are composed,
+    returns their lengths and changed regions
+    """
+    contig_lengths = {}
+    changed_regions = {}
+    with open(polished_file, "w") as f:
+        for ctg_id, ctg_seq, regions in polished_seqs:
+            fp.write_fasta_record(f, ctg_id, ctg_seq)
+            contig_lengths[ctg_id] = len(ctg_seq)
+            changed_regions[ctg_id] = regions
+    return contig_lengths, changed_regions
+
+
+def _changed_regions(chunk_seq, consensuses):
+    """
+    Each bubble replaces the chunk sequence up to the next bubble
+    (parts not covered by bubbles are dropped). Returns the regions
+    (in the polished coordinates) where the replacement differs,
+    along with the number of changed bases and the length of
+    the replaced chunk sequence. Outside of these regions,
+    the polished sequence is identical to the chunk
+    """
+    regions = []
+    if consensuses and consensuses[0][0] > 0:
+        regions.append((0, 0, consensuses[0][0], consensuses[0][0]))
+
+    out_pos = 0
+    for bubble_id, (position, seq) in enumerate(consensuses):
+        end = (consensuses[bubble_id + 1][0] if bubble_id + 1 < len(consensuses)
+               else len(chunk_seq))
+        orig_seq = chunk_seq[position:end]
+        if seq != orig_seq:
+            #the common prefix and suffix are not counted
+            max_common = min(len(seq), len(orig_seq))
+            prefix = 0
+            while prefix < max_common and seq[prefix] == orig_seq[prefix]:
+                prefix += 1
+            suffix = 0
+            while (suffix < max_common - prefix and
+                   seq[-suffix - 1] == orig_seq[-suffix - 1]):
+                suffix += 1
+            regions.append((out_pos + prefix, out_pos + len(seq) - suffix,
+                            max(len(seq), len(orig_seq)) - prefix - suffix,
+                            len(orig_seq) - prefix - suffix))
+        out_pos += len(seq)
+    return regions
@@ -0,0 +1,88 @@
+#(c) 2020 by Authors
+#This file is a part of Flye program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Selects a subset of reads of the target coverage before the alignment
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import logging
+from array import array
+from flye.six.moves import range
+
+import flye.utils.fasta_parser as fp
+import flye.config.py_cfg as cfg
+
+logger = logging.getLogger()
+
+
+def subsample_reads(reads_files, contigs_file, out_file):
+    """
+    If the estimated read coverage (of the contigs) is sufficiently higher than
+    the target ("polish_subsample_coverage"), writes the best reads
+    (the longest, or with the highest mean quality) of the target
+    coverage into out_file (fasta) and returns True. The reads are
+    streamed twice: first to rank them, then to output the selected ones
+    """
+    TARGET_COV = cfg.vals["polish_subsample_coverage"]
+    MIN_RATIO = cfg.vals["polish_subsample_min_ratio"]
+    ORDER = cfg.vals["polish_subsample_order"]
+    if TARGET_COV is None:
+        return False
+    genome_size = sum(fp.read_sequence_lengths(contigs_file).values())
+    if genome_size == 0:
+        return False
+
+    lengths = array("l")
+    mean_quals = array("d")
+    for reads_file in reads_files:
+        for _, seq, qual in fp.stream_raw_records(reads_file):
+            lengths.append(len(seq))
+            if ORDER == "quality":
+                mean_quals.append(_mean_quality(qual))
+
+    total_bases = sum(lengths)
+    est_coverage = total_bases / genome_size
+    if est_coverage < TARGET_COV * MIN_RATIO:
+        logger.debug("Estimated read coverage: %d, no subsampling",
+                     est_coverage)
+        return False
+
+    #the sort is stable, so ties are resolved by the read order
+    #and the selection is deterministic
+    rank_key = (mean_quals if ORDER == "quality" else lengths).__getitem__
+    target_bases = TARGET_COV * genome_size
+    selected = bytearray(len(lengths))
+    selected_bases = 0
+    for read_id in sorted(range(len(lengths)), key=rank_key, reverse=True):
+        if selected_bases >= target_bases:
+            break
+        selected[read_id] = 1
+        selected_bases += lengths[read_id]
+    del mean_quals
+
+    num_selected = 0
+    read_id = 0
+    with open(out_file, "wb") as f:
+        for reads_file in reads_files:
+            for hdr, seq, _ in fp.stream_raw_records(reads_file):
+                if selected[read_id]:
+                    f.write(b">" + hdr + b"\n" + seq + b"\n")
+                    num_selected += 1
+                read_id += 1
+
+    logger.info("Subsampled reads from %dx to %dx coverage (%d of %d reads)",
+                est_coverage, selected_bases / genome_size,
+                num_selected, len(lengths))
+    return True
+
+
+def _mean_quality(qual):
+    """
+    Mean Phred quality (zero for reads without qualities)
+    """
+    if not qual:
+        return 0
+    return sum(bytearray(qual)) / len(qual) - 33
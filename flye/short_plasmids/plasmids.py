@@ -102,6 +102,32 @@ def assemble_short_plasmids(args, work_dir, contigs_path):
     return plasmids_with_coverage
 
 
+def write_plasmids(plasmids_dict, fasta_file, stats_file):
+    """
+    Saves the sequences and the coverage of the assembled plasmids
+    """
+    fp.write_fasta_dict({seq_id: seq for seq_id, (seq, _)
+                         in plasmids_dict.items()}, fasta_file)
+    with open(stats_file, "w") as f:
+        f.write("#seq_name\tlength\tcoverage\n")
+        for seq_id, (seq, coverage) in plasmids_dict.items():
+            f.write("{0}\t{1}\t{2}\n".format(seq_id, len(seq), coverage))
+
+
+def read_plasmids(fasta_file, stats_file):
+    """
+    Loads the plasmids saved with write_plasmids
+    """
+    sequences = fp.read_sequence_dict(fasta_file)
+    plasmids_dict = {}
+    with open(stats_file, "r") as f:
+        for line in f:
+            if line.startswith("#"): continue
+            seq_id, _, coverage = line.strip().split("\t")
+            plasmids_dict[seq_id] = sequences[seq_id], int(coverage)
+    return plasmids_dict
+
+
 def update_graph(repeat_graph, plasmids_dict):
     for num, (plasmid, coverage) in enumerate(plasmids_dict.values()):
         new_seq_name = "plasmid_{0}".format(num)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+#(c) 2020 by Authors
+#This file is a part of the Flye package.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Measures bubbles._compute_profile on a simulated 1 Mb chunk and checks
+the counts against the straightforward per-base pileup
+"""
+
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                os.pardir, os.pardir))
+from flye.polishing.bubbles import _compute_profile
+from flye.polishing.alignment import shift_gaps
+from flye.utils.sam_parser import Alignment
+
+
+CHUNK_LEN = 1000000
+READ_LEN = 10000
+COVERAGE = 10
+#mismatch, deletion, insertion rates
+ERROR_RATES = (0.04, 0.04, 0.04)
+
+
+def _simulate_alignments(chunk_seq):
+    alignments = []
+    for read_id in range(CHUNK_LEN * COVERAGE // READ_LEN):
+        start = random.randint(0, CHUNK_LEN - READ_LEN)
+        trg_seq, qry_seq = [], []
+        ref_pos = start
+        while ref_pos < start + READ_LEN:
+            event = random.random()
+            if event < ERROR_RATES[0]:
+                trg_seq.append(chunk_seq[ref_pos])
+                qry_seq.append(random.choice("ACGT"))
+                ref_pos += 1
+            elif event < sum(ERROR_RATES[:2]):
+                trg_seq.append(chunk_seq[ref_pos])
+                qry_seq.append("-")
+                ref_pos += 1
+            elif event < sum(ERROR_RATES):
+                trg_seq.append("-")
+                qry_seq.append(random.choice("ACGT"))
+            else:
+                trg_seq.append(chunk_seq[ref_pos])
+                qry_seq.append(chunk_seq[ref_pos])
+                ref_pos += 1
+
+        alignments.append(Alignment("read_{0}".format(read_id), "chunk",
+                                    0, READ_LEN, "+", READ_LEN,
+                                    start, ref_pos, "+", CHUNK_LEN,
+                                    "".join(qry_seq), "".join(trg_seq),
+                                    0.1, False))
+    return alignments
+
+
+def _per_base_profile(alignment, genome_len):
+    """
+    Reference implementation: visits every alignment column
+    """
+    nucl = ["_"] * genome_len
+    counts = [[0, 0, 0, 0] for _ in range(genome_len)]
+    for aln in alignment:
+        qry_seq = shift_gaps(aln.trg_seq, aln.qry_seq)
+        trg_seq = shift_gaps(qry_seq, aln.trg_seq)
+
+        trg_pos = aln.trg_start
+        for trg_nuc, qry_nuc in zip(trg_seq, qry_seq):
+            if trg_nuc == "-":
+                trg_pos -= 1
+            if trg_pos >= genome_len:
+                trg_pos -= genome_len
+
+            if trg_nuc == "-":
+                counts[trg_pos][3] += 1
+            else:
+                nucl[trg_pos] = trg_nuc
+                counts[trg_pos][0] += 1
+                if qry_nuc == "-":
+                    counts[trg_pos][2] += 1
+                elif trg_nuc != qry_nuc:
+                    counts[trg_pos][1] += 1
+            trg_pos += 1
+    return nucl, counts
+
+
+def bench_bubble_profile():
+    random.seed(42)
+    chunk_seq = "".join(random.choice("ACGT") for _ in range(CHUNK_LEN))
+    alignments = _simulate_alignments(chunk_seq)
+    print("Simulated {0} alignments on a {1} bp chunk"
+          .format(len(alignments), CHUNK_LEN))
+
+    start = time.time()
+    profile, _ = _compute_profile(alignments, "pacbio", CHUNK_LEN)
+    print("Array profile: {0:.2f} s".format(time.time() - start))
+
+    start = time.time()
+    nucl, counts = _per_base_profile(alignments, CHUNK_LEN)
+    print("Per-base profile: {0:.2f} s".format(time.time() - start))
+
+    for pos in range(CHUNK_LEN):
+        if (chr(profile.nucl[pos]) != nucl[pos] or
+                counts[pos] != [profile.coverage[pos], profile.num_missmatch[pos],
+                                profile.num_deletions[pos],
+                                profile.num_inserts[pos]]):
+            sys.exit("Profiles differ at position {0}".format(pos))
+    print("Profiles are identical")
+
+
+def main():
+    bench_bubble_profile()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+#(c) 2020 by Authors
+#This file is a part of the Flye package.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Measures result transfer throughput from the worker processes
+to the main process: Manager queues vs the worker pool transport
+(results of the pool tasks are sent with result_channel.send_message)
+"""
+
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import multiprocessing
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                os.pardir, os.pardir))
+from flye.utils.worker_pool import task_group
+
+
+NUM_WORKERS = [1, 8, 64]
+TOTAL_MB = 512
+ITEM_MB = 4
+
+
+def _queue_worker(num_items, item_len, results_queue):
+    payload = array("i", [1]) * item_len
+    for i in range(num_items):
+        results_queue.put((i, payload))
+
+
+def _pool_task(item_id, item_len):
+    return item_id, array("i", [1]) * item_len
+
+
+def _run_queue(num_workers, num_items, item_len):
+    manager = multiprocessing.Manager()
+    results_queue = manager.Queue()
+    workers = [multiprocessing.Process(target=_queue_worker,
+                                       args=(num_items, item_len, results_queue))
+               for _ in range(num_workers)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    #the queue is not bounded, so it is safe to wait for the workers
+    for w in workers:
+        w.join()
+    received = 0
+    while not results_queue.empty():
+        results_queue.get()
+        received += 1
+    elapsed = time.time() - start
+    manager.shutdown()
+    return received, elapsed
+
+
+def _run_pool(num_workers, num_items, item_len):
+    start = time.time()
+    with task_group(num_workers) as tasks:
+        for i in range(num_items * num_workers):
+            tasks.submit(_pool_task, i, item_len)
+        received = sum(1 for _ in tasks.results())
+    elapsed = time.time() - start
+    return received, elapsed
+
+
+def bench_result_channel():
+    item_len = ITEM_MB * 1024 * 1024 // 4
+    print("{0:>8}{1:>10}{2:>16}{3:>16}".format("Workers", "Items",
+                                               "Manager MB/s", "Pool MB/s"))
+    for num_workers in NUM_WORKERS:
+        num_items = max(TOTAL_MB // ITEM_MB // num_workers, 1)
+        total_mb = num_items * num_workers * ITEM_MB
+
+        throughput = []
+        for run_func in [_run_queue, _run_pool]:
+            received, elapsed = run_func(num_workers, num_items, item_len)
+            if received != num_items * num_workers:
+                sys.exit("Lost results: {0} out of {1}"
+                         .format(received, num_items * num_workers))
+            throughput.append(total_mb / elapsed)
+
+        print("{0:>8}{1:>10}{2:>16.1f}{3:>16.1f}"
+              .format(num_workers, num_items * num_workers, *throughput))
+
+
+def main():
+    bench_result_channel()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+#(c) 2020 by Authors
+#This file is a part of the Flye package.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Checks that in the batched polishing alignment, a read that is shared
+by two groups keeps its best alignment within each group
+"""
+
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                os.pardir, os.pardir))
+from flye.utils.sam_parser import preprocess_sam
+
+
+READ_SEQ = "ACGTACGTAC"
+
+#the same read (r1) in groups 0 and 1, both copies have the primary
+#alignment to the contig of group 1, and a secondary one to group 0
+SAM_RECORDS = [
+    ["0@r1", 0, "1@ctg", 1, 100],
+    ["0@r1", 256, "0@ctg", 5, 90],
+    ["0@r1", 256, "0@ctg", 50, 20],
+    ["1@r1", 0, "1@ctg", 1, 100],
+    ["1@r1", 256, "0@ctg", 5, 90],
+]
+
+
+def _write_sam(sam_file):
+    with open(sam_file, "w") as f:
+        f.write("@HD\tVN:1.6\tSO:unsorted\n")
+        f.write("@SQ\tSN:0@ctg\tLN:100\n")
+        f.write("@SQ\tSN:1@ctg\tLN:100\n")
+        for read_id, flags, ctg_id, pos, score in SAM_RECORDS:
+            seq = READ_SEQ if not flags & 0x100 else "*"
+            f.write("\t".join([read_id, str(flags), ctg_id, str(pos), "60",
+                               "{0}M".format(len(READ_SEQ)), "*", "0", "0",
+                               seq, "*", "AS:i:{0}".format(score)]) + "\n")
+
+
+def _read_sam(sam_file):
+    alignments = []
+    with open(sam_file, "r") as f:
+        for line in f:
+            if line.startswith("@"):
+                continue
+            tokens = line.split("\t")
+            alignments.append((tokens[0], int(tokens[1]), tokens[2],
+                               int(tokens[3]), tokens[9]))
+    return sorted(alignments)
+
+
+def test_shared_read():
+    work_dir = tempfile.mkdtemp()
+    try:
+        sam_file = os.path.join(work_dir, "batch.sam")
+        _write_sam(sam_file)
+        preprocess_sam(sam_file, work_dir, group_filter=("@", 0.5, 10))
+        alignments = _read_sam(sam_file)
+    finally:
+        shutil.rmtree(work_dir)
+
+    #out-of-group alignments are removed, the best in-group alignment
+    #becomes primary and the weak secondary one is filtered out
+    expected = [("0@r1", 0, "0@ctg", 5, READ_SEQ),
+                ("1@r1", 0, "1@ctg", 1, READ_SEQ)]
+    assert alignments == expected, alignments
+
+
+def main():
+    test_shared_read()
+    print("TEST SUCCESSFUL")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+#(c) 2020 by Authors
+#This file is a part of the Flye package.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Checks how the consensus majority vote resolves ties: the reference
+base wins, otherwise the first column (in ACGTN- order) is taken
+"""
+
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                os.pardir, os.pardir))
+from flye.polishing.consensus import (Pileup, _flatten_profile,
+                                      _PILEUP_NUCL, _NUM_COLUMNS)
+
+
+#reference base and the column counts at each position -> consensus
+POSITIONS = [
+    ("C", {"A": 2, "C": 2}, "C"),       #reference base beats another base
+    ("G", {"G": 1, "-": 1}, "G"),       #reference base beats a deletion
+    ("T", {"A": 2, "C": 2, "T": 1}, "A"),   #no reference base in the tie
+    ("A", {"G": 1, "-": 3}, ""),        #no tie: deletion wins
+    ("A", {}, "A"),                     #no coverage: reference base
+]
+
+
+def _make_profile(positions):
+    profile = Pileup(len(positions))
+    for pos, (ref_nucl, counts, _) in enumerate(positions):
+        profile.nucl[pos] = ord(ref_nucl)
+        for nucl, count in counts.items():
+            column_id = _PILEUP_NUCL.index(nucl)
+            profile.counts[pos * _NUM_COLUMNS + column_id] = count
+    return profile
+
+
+def test_consensus_ties():
+    expected = "".join(cons for _, _, cons in POSITIONS)
+    assert _flatten_profile(_make_profile(POSITIONS)) == expected
+    for position in POSITIONS:
+        assert _flatten_profile(_make_profile([position])) == position[2], \
+            position
+
+
+def main():
+    test_consensus_ties()
+    print("TEST SUCCESSFUL")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+#(c) 2020 by Authors
+#This file is a part of the Flye package.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Checks the thread shares of the concurrent pipeline stages: with
+--plasmids, the repeat analysis and the short plasmids assembly are
+started together, and the repeat analysis (critical path) should
+keep the whole thread budget
+"""
+
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                os.pardir, os.pardir))
+import flye.main as flye_main
+from flye.utils.job_scheduler import JobScheduler
+
+
+NUM_THREADS = 16
+
+
+def _run_pipeline():
+    args = argparse.Namespace(reads=["reads.fasta"], out_dir="out",
+                              threads=NUM_THREADS, read_type="raw",
+                              no_trestle=False, meta=False, plasmids=True,
+                              num_iters=1, platform="nano")
+    jobs = flye_main._create_job_list(args, "out", "out/flye.log")
+
+    #stage name -> threads given to the stage
+    shares = {}
+    repeat_started = threading.Event()
+    def make_run(job):
+        def run():
+            shares[job.name] = job.args.threads
+            if job.name == "repeat":
+                repeat_started.set()
+            #plasmids are assembled while the repeat analysis is running
+            if job.name == "plasmids":
+                assert repeat_started.wait(10)
+        return run
+    for job in jobs:
+        job.run = make_run(job)
+
+    JobScheduler(jobs, NUM_THREADS).run()
+    return shares
+
+
+def test_plasmids_threads():
+    shares = _run_pipeline()
+    plasmids_threads = flye_main.JobShortPlasmidsAssembly.max_threads
+    assert shares["repeat"] == NUM_THREADS, shares
+    assert shares["plasmids"] == plasmids_threads, shares
+    assert shares["trestle"] == NUM_THREADS, shares
+    for name in ["contigger", "polishing", "finalize"]:
+        assert shares[name] == NUM_THREADS, shares
+
+
+def main():
+    test_plasmids_threads()
+    print("TEST SUCCESSFUL")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
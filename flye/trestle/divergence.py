@@ -11,21 +11,27 @@ Created on Wed Jan  4 03:50:31 2017
 from __future__ import absolute_import
 from __future__ import division
 import logging
+from array import array
 from collections import defaultdict
 from flye.six.moves import range
 
-import multiprocessing
-import signal
 import os.path
 
 from flye.polishing.alignment import shift_gaps
 from flye.utils.sam_parser import SynchronizedSamReader
+from flye.utils.worker_pool import task_group
 import flye.utils.fasta_parser as fp
 import flye.config.py_cfg as config
 from flye.six.moves import zip
 
 logger = logging.getLogger()
 
+#per-position counts (see _count_freqs) are passed from the
+#workers as columns: arrays of counts and byte strings of bases
+_COUNT_FIELDS = ["cov", "mat_ct", "sub_ct", "del_ct", "ins_ct"]
+_BASE_FIELDS = ["mat_base", "sub_base", "ins_base"]
+_NO_BASE = b"\0"
+
 class Profile(object):
     __slots__ = ("insertions", "matches", "nucl")
 
@@ -35,25 +41,21 @@ class Profile(object):
         self.nucl = "-"
 
 
-def _thread_worker(aln_reader, contigs_info, platform, results_queue,
-                   error_queue):
-    try:
-        aln_reader.init_reading()
-
-        while not aln_reader.is_eof():
-            ctg_id, ctg_aln = aln_reader.get_chunk()
-            if ctg_id is None:
-                break
-
-            profile, aln_errors = _contig_profile(ctg_aln, platform,
-                                                  contigs_info[ctg_id].length)
-            #sequence = _flatten_profile(profile)
-            results_queue.put((ctg_id, profile, aln_errors))
-
-        aln_reader.stop_reading()
+def _thread_worker(aln_reader, contig_range, contig_info, platform):
+    """
+    Computes profile of a single contig (runs in a worker), returns
+    the per-position counts as columns (see _count_columns)
+    """
+    aln_reader.init_reading()
+    ctg_id, _, _, ctg_aln = aln_reader.read_shard(contig_range)
+    aln_reader.stop_reading()
+    if ctg_id is None:
+        return None
 
-    except Exception as e:
-        error_queue.put(e)
+    profile, aln_errors = _contig_profile(ctg_aln, platform,
+                                          contig_info.length)
+    #sequence = _flatten_profile(profile)
+    return (ctg_id, array("d", aln_errors)) + _count_columns(profile)
 
 
 def _contig_profile(alignment, platform, genome_len):
@@ -128,6 +130,41 @@ def _count_freqs(elem):
                             'ins_base':max_ins_key, 'ins_ct':max_ins_ct}
 
 
+def _count_columns(profile):
+    """
+    Counts of all profile positions as columns, which are not pickled
+    when sent from a worker (unlike the profile elements)
+    """
+    counts = [array("i", [0]) * len(profile) for _ in _COUNT_FIELDS]
+    bases = [bytearray(_NO_BASE) * len(profile) for _ in _BASE_FIELDS]
+    for index, elem in enumerate(profile):
+        freqs = _count_freqs(elem)
+        for column, field in zip(counts, _COUNT_FIELDS):
+            column[index] = freqs[field]
+        for column, field in zip(bases, _BASE_FIELDS):
+            base = freqs[field].lstrip("^")
+            if base:
+                column[index] = ord(base)
+    return tuple(counts) + tuple(bytes(column) for column in bases)
+
+
+def _iter_freqs(columns):
+    """
+    Yields the per-position counts (same as _count_freqs) from the columns
+    """
+    counts = columns[:len(_COUNT_FIELDS)]
+    bases = columns[len(_COUNT_FIELDS):]
+    for index in range(len(counts[0])):
+        freqs = {"del_base": "-"}
+        for column, field in zip(counts, _COUNT_FIELDS):
+            freqs[field] = column[index]
+        for column, field in zip(bases, _BASE_FIELDS):
+            base = column[index : index + 1]
+            freqs[field] = base.decode("ascii") if base != _NO_BASE else ""
+        freqs["ins_base"] = "^" + freqs["ins_base"]
+        yield freqs
+
+
 def _call_position(ind, counts, pos, sub_thresh, del_thresh, ins_thresh):
     over_thresh = False
     if counts['cov']:
@@ -155,8 +192,7 @@ def find_divergence(alignment_path, contigs_path, contigs_info,
     Main function: takes in an alignment and finds the divergent positions
     """
     if not os.path.isfile(alignment_path) or not os.path.isfile(contigs_path):
-        ctg_profile = []
-        positions = _write_frequency_path(frequency_path, ctg_profile,
+        positions = _write_frequency_path(frequency_path, [],
                                           sub_thresh, del_thresh, ins_thresh)
         total_header = "".join(["Total_positions_{0}_".format(len(positions["total"])),
                               "with_thresholds_sub_{0}".format(sub_thresh),
@@ -173,43 +209,26 @@ def find_divergence(alignment_path, contigs_path, contigs_info,
         window_len = 1000
         sum_header = "Tentative Divergent Position Summary"
         _write_div_summary(div_sum_path, sum_header, positions,
-                          len(ctg_profile), window_len)
+                          0, window_len)
         return
 
     aln_reader = SynchronizedSamReader(alignment_path,
                                        fp.read_sequence_dict(contigs_path),
                                        config.vals["max_read_coverage"])
-    manager = multiprocessing.Manager()
-    results_queue = manager.Queue()
-    error_queue = manager.Queue()
-
-    #making sure the main process catches SIGINT
-    orig_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    threads = []
-    for _ in range(num_proc):
-        threads.append(multiprocessing.Process(target=_thread_worker,
-                                               args=(aln_reader, contigs_info,
-                                                     platform, results_queue,
-                                                     error_queue)))
-    signal.signal(signal.SIGINT, orig_sigint)
-
-    for t in threads:
-        t.start()
-    try:
-        for t in threads:
-            t.join()
-    except KeyboardInterrupt:
-        for t in threads:
-            t.terminate()
-
-    if not error_queue.empty():
-        raise error_queue.get()
+    with task_group(num_proc) as tasks:
+        def submit_contig(ctg_id, contig_reader, contig_range, weight):
+            tasks.submit_weighted(weight, _thread_worker, contig_reader,
+                                  contig_range, contigs_info[ctg_id], platform)
+        aln_reader.dispatch_shards(submit_contig)
+        results = [r for r in tasks.results() if r is not None]
+        tasks.log_balance("Divergence")
 
     total_aln_errors = []
-    while not results_queue.empty():
-        _, ctg_profile, aln_errors = results_queue.get()
+    for result in results:
+        aln_errors, columns = result[1], result[2:]
+        ctg_len = len(columns[0])
 
-        positions = _write_frequency_path(frequency_path, ctg_profile,
+        positions = _write_frequency_path(frequency_path, _iter_freqs(columns),
                                           sub_thresh, del_thresh, ins_thresh)
         total_header = "".join(["Total_positions_{0}_".format(len(positions["total"])),
                               "with_thresholds_sub_{0}".format(sub_thresh),
@@ -226,7 +245,7 @@ def find_divergence(alignment_path, contigs_path, contigs_info,
         window_len = 1000
         sum_header = "Tentative Divergent Position Summary"
         _write_div_summary(div_sum_path, sum_header, positions,
-                          len(ctg_profile), window_len)
+                          ctg_len, window_len)
 
         logger.debug("Total positions: %d", len(positions["total"]))
         total_aln_errors.extend(aln_errors)
@@ -235,14 +254,13 @@ def find_divergence(alignment_path, contigs_path, contigs_info,
     logger.debug("Alignment error rate: %f", mean_aln_error)
 
 
-def _write_frequency_path(frequency_path, ctg_profile, sub_thresh,
+def _write_frequency_path(frequency_path, ctg_freqs, sub_thresh,
                           del_thresh, ins_thresh):
     #The set of called positions for each category
     positions = {"total":[], "sub":[], "del":[], "ins":[]}
     with open(frequency_path, 'w') as f:
         f.write("Index\tCov\tMatch\tCount\tSub\tCount\tDel\tCount\tIns\tCount\n")
-        for index, elem in enumerate(ctg_profile):
-            counts = _count_freqs(elem)
+        for index, counts in enumerate(ctg_freqs):
             f.write("{0}\t{c[cov]}\t{c[mat_base]}\t{c[mat_ct]}\t".format(index,c=counts))
             f.write("{c[sub_base]}\t{c[sub_ct]}\t{c[del_base]}\t".format(c=counts))
             f.write("{c[del_ct]}\t{c[ins_base]}\t{c[ins_ct]}\n".format(c=counts))
@@ -12,15 +12,18 @@ from __future__ import absolute_import
 from __future__ import division
 import os
 import logging
+import signal
+import multiprocessing
 from itertools import combinations, product
 import copy
-import multiprocessing, signal
 
 import flye.polishing.alignment as flye_aln
 from flye.utils.sam_parser import SynchronizedSamReader, Alignment
 import flye.utils.fasta_parser as fp
 import flye.config.py_cfg as config
 import flye.polishing.polish as pol
+from flye.utils.worker_pool import task_group
+from flye.utils.checkpoint import Checkpoint, write_state, read_state
 
 import flye.trestle.divergence as div
 import flye.trestle.trestle_config as trestle_config
@@ -31,7 +34,14 @@ logger = logging.getLogger()
 
 
 def resolve_repeats(args, trestle_dir, repeats_info, summ_file,
-                    resolved_repeats_seqs):
+                    resolved_repeats_seqs, checkpoint=None):
+    """
+    Resolves the repeats in parallel. The results of each resolved
+    repeat are saved, and recorded in the checkpoint, so the repeats
+    are not resolved again if the stage is resumed
+    """
+    if checkpoint is None:
+        checkpoint = Checkpoint()
     all_file_names = define_file_names()
     all_labels, initial_file_names = all_file_names[0], all_file_names[2]
 
@@ -50,67 +60,36 @@ def resolve_repeats(args, trestle_dir, repeats_info, summ_file,
     #if not repeat_list:
     #    return
 
-    #Resolve every repeat in a separate thread
-    def _thread_worker(func_args, log_file, results_queue, error_queue):
-        try:
-            #each thred logs to a separate file
-            log_formatter = \
-                logging.Formatter("[%(asctime)s] %(name)s: %(levelname)s: "
-                                  "%(message)s", "%Y-%m-%d %H:%M:%S")
-            file_handler = logging.FileHandler(log_file, mode="a")
-            file_handler.setFormatter(log_formatter)
-            for handler in logger.handlers[:]:
-                logger.removeHandler(handler)
-            logger.addHandler(file_handler)
-
-            result = resolve_each_repeat(*func_args)
-            results_queue.put(result)
-
-        except Exception as e:
-            error_queue.put(e)
-
-    job_chunks = [repeat_list[i:i + args.threads]
-              for i in range(0, len(repeat_list), args.threads)]
-
-    for job_chunk in job_chunks:
-        manager = multiprocessing.Manager()
-        results_queue = manager.Queue()
-        error_queue = manager.Queue()
-
-        repeat_threads = max(1, args.threads // len(job_chunk))
-        orig_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
-        threads = []
-        for rep_id in sorted(job_chunk):
+    #repeats resolved before the stage was interrupted
+    unresolved = []
+    resolved_files = checkpoint.get("resolved_repeats", {})
+    for rep_id in sorted(repeat_list):
+        results_file = resolved_files.get(str(rep_id))
+        if results_file is None or not os.path.exists(results_file):
+            unresolved.append(rep_id)
+            continue
+        resolved_dict, summary_list = read_state(results_file)
+        all_resolved_reps_dict.update(resolved_dict)
+        all_summaries.extend(summary_list)
+    if len(unresolved) < len(repeat_list):
+        logger.info("Resuming: %d repeats were already resolved",
+                    len(repeat_list) - len(unresolved))
+
+    #Resolve every repeat in a separate worker task
+    repeat_threads = max(1, args.threads // max(len(unresolved), 1))
+    with task_group(args.threads) as tasks:
+        for rep_id in unresolved:
             func_args = (rep_id, repeat_edges, all_edge_headers, args, trestle_dir,
                          repeats_info, all_file_names, repeat_threads)
             log_file = os.path.join(trestle_dir,
                                     "repeat_{0}".format(rep_id), "log.txt")
-            threads.append(multiprocessing.Process(target=_thread_worker,
-                                        args=(func_args, log_file,
-                                              results_queue, error_queue)))
-        signal.signal(signal.SIGINT, orig_sigint)
+            tasks.submit(_resolve_repeat_worker, func_args, log_file)
 
-        for t in threads:
-            t.start()
-        try:
-            for t in threads:
-                t.join()
-                if t.exitcode == -9:
-                    logger.error("Looks like the system ran out of memory")
-                if t.exitcode != 0:
-                    raise Exception("One of the processes exited with code: {0}"
-                                    .format(t.exitcode))
-
-        except KeyboardInterrupt:
-            for t in threads:
-                t.terminate()
-            raise
-
-        if not error_queue.empty():
-            raise error_queue.get()
-
-        while not results_queue.empty():
-            resolved_dict, summary_list = results_queue.get()
+        for rep_id, resolved_dict, summary_list in tasks.results():
+            results_file = os.path.join(trestle_dir, "repeat_{0}".format(rep_id),
+                                        "resolved.json")
+            write_state([resolved_dict, summary_list], results_file)
+            checkpoint.add("resolved_repeats", str(rep_id), results_file)
             all_resolved_reps_dict.update(resolved_dict)
             all_summaries.extend(summary_list)
 
@@ -123,6 +102,33 @@ def resolve_repeats(args, trestle_dir, repeats_info, summ_file,
     logger.info("Resolved: %d", num_resolved)
 
 
+def _resolve_repeat_worker(func_args, log_file):
+    """
+    Resolves a single repeat (runs in a worker),
+    returns the repeat id with the results
+    """
+    #each repeat logs to a separate file
+    log_formatter = \
+        logging.Formatter("[%(asctime)s] %(name)s: %(levelname)s: "
+                          "%(message)s", "%Y-%m-%d %H:%M:%S")
+    file_handler = logging.FileHandler(log_file, mode="a")
+    file_handler.setFormatter(log_formatter)
+    orig_handlers = logger.handlers[:]
+    for handler in orig_handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(file_handler)
+
+    #the worker is reused by the next tasks, so the logging is restored
+    try:
+        resolved_dict, summary_list = resolve_each_repeat(*func_args)
+        return func_args[0], resolved_dict, summary_list
+    finally:
+        logger.removeHandler(file_handler)
+        file_handler.close()
+        for handler in orig_handlers:
+            logger.addHandler(handler)
+
+
 def resolve_each_repeat(rep_id, repeat_edges, all_edge_headers, args,
                         trestle_dir, repeats_info, all_file_names,
                         num_threads):
@@ -177,31 +183,34 @@ def resolve_each_repeat(rep_id, repeat_edges, all_edge_headers, args,
 
         #2. Polish template and extended templates
         logger.debug("Polishing templates")
+        #the template and all extended templates are polished in one batch
         pol_temp_dir = os.path.join(orient_dir, pol_temp_name)
         if not os.path.isdir(pol_temp_dir):
             os.mkdir(pol_temp_dir)
-        polished_template, _ = \
-            pol.polish(template, [repeat_reads], pol_temp_dir, NUM_POL_ITERS,
-                       num_threads, args.platform, output_progress=False)
-
+        pol_groups = [(template, [repeat_reads], pol_temp_dir)]
+        pol_ext_dir = os.path.join(orient_dir, pol_ext_name)
+        ext_edges = [(side, edge_id) for side in side_labels
+                     for edge_id in repeat_edges[rep][side]]
+        for side, edge_id in ext_edges:
+            if not os.path.isdir(pol_ext_dir.format(side, edge_id)):
+                os.mkdir(pol_ext_dir.format(side, edge_id))
+            pol_groups.append((extended.format(side, edge_id), [repeat_reads],
+                               pol_ext_dir.format(side, edge_id)))
+        pol_outputs = pol.polish_batch(pol_groups, pol_temp_dir, NUM_POL_ITERS,
+                                       num_threads, args.platform,
+                                       output_progress=False)
+
+        polished_template, _ = pol_outputs[0]
         if not os.path.getsize(polished_template):
             for side in side_labels:
                 term_bool[side] = True
 
         polished_extended = {}
-        pol_ext_dir = os.path.join(orient_dir, pol_ext_name)
-        for side in side_labels:
-            for edge_id in repeat_edges[rep][side]:
-                if not os.path.isdir(pol_ext_dir.format(side, edge_id)):
-                    os.mkdir(pol_ext_dir.format(side, edge_id))
-                pol_output, _ = \
-                    pol.polish(extended.format(side, edge_id), [repeat_reads],
-                               pol_ext_dir.format(side, edge_id), NUM_POL_ITERS,
-                               num_threads, args.platform,
-                               output_progress=False)
-                polished_extended[(side, edge_id)] = pol_output
-                if not os.path.getsize(pol_output):
-                    term_bool[side] = True
+        for (side, edge_id), (pol_output, _) in zip(ext_edges,
+                                                     pol_outputs[1:]):
+            polished_extended[(side, edge_id)] = pol_output
+            if not os.path.getsize(pol_output):
+                term_bool[side] = True
 
         #3. Find divergent positions
         logger.debug("Estimating divergence")
@@ -296,8 +305,11 @@ def resolve_each_repeat(rep_id, repeat_edges, all_edge_headers, args,
                 else:
                     logger.debug("Iteration %d, '%s'", it, side)
                     both_break = False
-                for edge_id in sorted(repeat_edges[rep][side]):
-                    #7a. Call consensus on partitioned reads
+                #7a. Call consensus on partitioned reads
+                #(all edges of the side are polished in one batch)
+                side_edges = sorted(repeat_edges[rep][side])
+                pol_groups = []
+                for edge_id in side_edges:
                     pol_con_dir = polishing_dir.format(
                                 it, side, edge_id)
                     curr_reads = edge_reads.format(it, side, edge_id)
@@ -306,15 +318,18 @@ def resolve_each_repeat(rep_id, repeat_edges, all_edge_headers, args,
                                 repeat_reads,
                                 partitioning.format(it - 1, side),
                                 curr_reads)
-                    curr_extended = polished_extended[(side, edge_id)]
-                    logger.debug("\tPolishing '%s %s' reads", side, edge_id)
-
                     if not os.path.isdir(pol_con_dir):
                         os.mkdir(pol_con_dir)
-                    pol_con_out, _ = \
-                        pol.polish(curr_extended, [curr_reads], pol_con_dir,
-                                   NUM_POL_ITERS, num_threads, args.platform,
-                                   output_progress=False)
+                    pol_groups.append((polished_extended[(side, edge_id)],
+                                       [curr_reads], pol_con_dir))
+                logger.debug("\tPolishing '%s' edge reads", side)
+                pol_outputs = pol.polish_batch(pol_groups, pol_groups[0][2],
+                                               NUM_POL_ITERS, num_threads,
+                                               args.platform,
+                                               output_progress=False)
+
+                for edge_id, (pol_con_out, _) in zip(side_edges, pol_outputs):
+                    curr_reads = edge_reads.format(it, side, edge_id)
                     #7b. Cut consensus where coverage drops
                     cutpoint = locate_consensus_cutpoint(
                                     side, read_endpoints,
@@ -533,33 +548,44 @@ def process_repeats(reads, repeats_dict, work_dir, all_labels,
 
     #creates a separate process to make sure that
     #read dictionary is released after the function exits
-    manager = multiprocessing.Manager()
-    return_queue = manager.Queue()
-
-    orig_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    thread = multiprocessing.Process(target=_process_repeats_impl,
-                                        args=(reads, repeats_dict,
-                                              work_dir, all_labels,
-                                              initial_file_names,
-                                              return_queue))
-    signal.signal(signal.SIGINT, orig_sigint)
-    thread.start()
+    #(the pool workers are persistent, so they are not used here)
+    result_in, result_out = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_process_repeats_main,
+                                      args=(result_out, reads, repeats_dict,
+                                            work_dir, all_labels,
+                                            initial_file_names))
+    process.start()
+    result_out.close()
     try:
-        thread.join()
-        if thread.exitcode == -9:
+        try:
+            result = result_in.recv()
+        except EOFError:
+            result = None
+        process.join()
+        if process.exitcode == -9:
             logger.error("Looks like the system ran out of memory")
-        if thread.exitcode != 0:
+        if process.exitcode != 0:
             raise Exception("One of the processes exited with code: {0}"
-                                .format(thread.exitcode))
-    except KeyboardInterrupt:
-        thread.terminate()
+                                .format(process.exitcode))
+    except BaseException:
+        if process.is_alive():
+            process.terminate()
         raise
+    finally:
+        result_in.close()
+
+    return result
+
 
-    return return_queue.get()
+def _process_repeats_main(result_out, *args):
+    #interrupts are handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    result_out.send(_process_repeats_impl(*args))
+    result_out.close()
 
 
 def _process_repeats_impl(reads, repeats_dict, work_dir, all_labels,
-                          initial_file_names, return_queue):
+                          initial_file_names):
     """
     This function is called in a separate process
     """
@@ -838,7 +864,7 @@ def _process_repeats_impl(reads, repeats_dict, work_dir, all_labels,
                         "Empty partitioning file {0}".format(
                             partitioning_path.format(side)))
 
-    return_queue.put((repeat_list, repeat_edges, all_edge_headers))
+    return repeat_list, repeat_edges, all_edge_headers
 
 
 def _write_partitioning_file(part_list, part_path):
@@ -0,0 +1,70 @@
+#(c) 2020 by Authors
+#This file is a part of Flye program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Checkpoints within a pipeline stage
+"""
+
+from __future__ import absolute_import
+import os
+import json
+import threading
+
+
+class Checkpoint(object):
+    """
+    Progress within a stage (for example, completed polishing iterations
+    or resolved repeats), that is saved with the run state, so an
+    interrupted stage could continue from the last completed unit.
+    The state is a JSON-compatible dictionary; save_func is called after
+    each update (with the lock held). Without save_func, the progress is
+    only kept in memory
+    """
+    def __init__(self, state=None, save_func=None, lock=None):
+        self.state = state if state is not None else {}
+        self.save_func = save_func
+        self.lock = lock if lock is not None else threading.RLock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.state.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.state[key] = value
+            self._save()
+
+    def add(self, key, item_id, item):
+        """
+        Records the item in the dictionary under the key
+        """
+        with self.lock:
+            self.state.setdefault(key, {})[item_id] = item
+            self._save()
+
+    def clear(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.state.pop(key, None)
+            self._save()
+
+    def _save(self):
+        if self.save_func is not None:
+            self.save_func()
+
+
+def write_state(state, out_file):
+    """
+    Writes the (bulky) part of a checkpoint into a separate JSON file,
+    which replaces the old one only once completely written
+    """
+    temp_file = out_file + ".tmp"
+    with open(temp_file, "w") as f:
+        json.dump(state, f)
+    os.rename(temp_file, out_file)
+
+
+def read_state(in_file):
+    with open(in_file, "r") as f:
+        return json.load(f)
@@ -54,15 +54,7 @@ def read_sequence_lengths(filename):
 
 def stream_sequence(filename):
     try:
-        gzipped, fastq = _is_fastq(filename)
-
-        if not gzipped:
-            handle = open(filename, "rb")
-        else:
-            #handle = os.popen("gunzip -c {0}".format(filename))
-            gz = gzip.open(filename, "rb")
-            handle = io.BufferedReader(gz)
-
+        handle, fastq = _open_sequence_file(filename)
         if fastq:
             for hdr, seq, _ in _read_fastq(handle):
                 if not _validate_seq(seq):
@@ -80,16 +72,41 @@ def stream_sequence(filename):
         raise FastaError(e)
 
 
+def stream_raw_records(filename):
+    """
+    Streams (header, sequence, quality) records as bytes, without
+    validation or conversion (quality is None for fasta).
+    Used for the fast processing of large read files
+    """
+    try:
+        handle, fastq = _open_sequence_file(filename)
+        if fastq:
+            for record in _read_fastq(handle):
+                yield record
+        else:
+            for hdr, seq in _read_fasta(handle):
+                yield hdr, seq, None
+
+    except IOError as e:
+        raise FastaError(e)
+
+
 def write_fasta_dict(fasta_dict, filename):
     """
     Writes dictionary with fasta to file
     """
     with open(filename, "w") as f:
         for header in sorted(fasta_dict):
-            f.write(">{0}\n".format(header))
+            write_fasta_record(f, header, fasta_dict[header])
+
 
-            for i in range(0, len(fasta_dict[header]), 60):
-                f.write(fasta_dict[header][i:i + 60] + "\n")
+def write_fasta_record(handle, header, sequence):
+    """
+    Writes a single fasta record into the open file
+    """
+    handle.write(">{0}\n".format(header))
+    for i in range(0, len(sequence), 60):
+        handle.write(sequence[i:i + 60] + "\n")
 
 
 def reverse_complement(unicode_str):
@@ -108,6 +125,17 @@ def to_acgt(unicode_str):
 
 #Internal functions: use bytes for faster operations
 
+def _open_sequence_file(filename):
+    gzipped, fastq = _is_fastq(filename)
+    if not gzipped:
+        handle = open(filename, "rb")
+    else:
+        #handle = os.popen("gunzip -c {0}".format(filename))
+        gz = gzip.open(filename, "rb")
+        handle = io.BufferedReader(gz)
+    return handle, fastq
+
+
 def _is_fastq(filename):
     suffix = filename.rsplit(".")[-1]
     without_gz = filename
@@ -0,0 +1,153 @@
+#(c) 2020 by Authors
+#This file is a part of Flye program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Runs the pipeline jobs as a dependency graph
+"""
+
+from __future__ import absolute_import
+import sys
+import logging
+import threading
+
+from flye.six import reraise
+from flye.six.moves import queue, range
+
+logger = logging.getLogger()
+
+#how often (in seconds) the waiting thread wakes up,
+#so it could be interrupted
+_WAIT_INTERVAL = 1.0
+
+
+class JobScheduler(object):
+    """
+    Runs independent jobs concurrently. A job depends on the jobs
+    whose out_files it reads (listed in its in_files), so the jobs
+    should be given in a valid execution order (as in the linear pipeline).
+    The jobs share the global thread budget: the free threads are divided
+    between the jobs that are ready to start, and a job is given its
+    share through set_threads() before it is started. A job keeps its
+    share until it is finished, so short side jobs (with max_threads set)
+    are given at most max_threads on top of the budget, and do not
+    take the threads of the jobs on the critical path. Jobs run in
+    background threads, while the calling thread starts them and
+    handles their completion.
+    """
+    def __init__(self, jobs, num_threads):
+        self.jobs = jobs
+        self.num_threads = num_threads
+        self.dependencies = _get_dependencies(jobs)
+
+    def run(self, on_finish=None, job_context=None):
+        """
+        Runs all jobs, on_finish(job) is called (from the calling thread)
+        once a job is completed. If given, job_context(job) returns a
+        context manager that wraps the job (in the job's thread).
+        If a job fails, no new jobs are started, the running jobs
+        are completed and then the error is re-raised
+        """
+        finished = set()
+        started = set()
+        #job id -> number of threads (taken from the budget)
+        running = {}
+        done_queue = queue.Queue()
+        error = None
+
+        while True:
+            if error is None:
+                self._start_ready(finished, started, running, done_queue,
+                                  job_context)
+            if not running:
+                break
+
+            job_id, exc_info = _wait_for(done_queue)
+            del running[job_id]
+            if exc_info is not None:
+                if error is None:
+                    error = exc_info
+                    if running:
+                        logger.info("Waiting for the running stages to finish")
+                else:
+                    logger.debug("Stage %s also failed: %s",
+                                 self.jobs[job_id].name, str(exc_info[1]))
+                continue
+
+            finished.add(job_id)
+            if on_finish is not None:
+                on_finish(self.jobs[job_id])
+
+        if error is not None:
+            reraise(*error)
+
+    def _start_ready(self, finished, started, running, done_queue,
+                     job_context):
+        ready = [job_id for job_id in range(len(self.jobs))
+                 if job_id not in started and
+                 self.dependencies[job_id] <= finished]
+        side_jobs = [job_id for job_id in ready
+                     if self.jobs[job_id].max_threads is not None]
+        main_jobs = [job_id for job_id in ready if job_id not in side_jobs]
+
+        to_start = []
+        for job_id in side_jobs:
+            to_start.append((job_id, min(self.jobs[job_id].max_threads,
+                                         self.num_threads), 0))
+        free_threads = self.num_threads - sum(running.values())
+        for num, job_id in enumerate(main_jobs):
+            if free_threads <= 0:
+                break
+            num_threads = max(1, free_threads // (len(main_jobs) - num))
+            free_threads -= num_threads
+            to_start.append((job_id, num_threads, num_threads))
+
+        for job_id, num_threads, budget_threads in to_start:
+            job = self.jobs[job_id]
+            job.set_threads(num_threads)
+            if running or len(to_start) > 1:
+                logger.debug("Running stage %s concurrently, %d threads",
+                             job.name, num_threads)
+            started.add(job_id)
+            running[job_id] = budget_threads
+            thread = threading.Thread(target=_run_job,
+                                      args=(job, job_id, done_queue,
+                                            job_context))
+            thread.daemon = True
+            thread.start()
+
+
+def _get_dependencies(jobs):
+    """
+    For each job, the set of earlier jobs that produce its inputs
+    """
+    producers = {}
+    dependencies = []
+    for job_id, job in enumerate(jobs):
+        dependencies.append(set(producers[path]
+                                for path in job.in_files.values()
+                                if path in producers))
+        for path in job.out_files.values():
+            producers[path] = job_id
+    return dependencies
+
+
+def _run_job(job, job_id, done_queue, job_context):
+    try:
+        if job_context is not None:
+            with job_context(job):
+                job.run()
+        else:
+            job.run()
+        done_queue.put((job_id, None))
+    except BaseException:
+        done_queue.put((job_id, sys.exc_info()))
+
+
+def _wait_for(done_queue):
+    #waiting with timeout, so KeyboardInterrupt is not delayed
+    while True:
+        try:
+            return done_queue.get(timeout=_WAIT_INTERVAL)
+        except queue.Empty:
+            pass
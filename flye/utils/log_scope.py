@@ -0,0 +1,45 @@
+#(c) 2020 by Authors
+#This file is a part of Flye program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Silencing the log output of a single call
+"""
+
+from __future__ import absolute_import
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+_local = threading.local()
+
+
+class _QuietFilter(logging.Filter):
+    """
+    Drops the records that are logged by a quiet thread
+    """
+    def filter(self, record):
+        return not is_quiet()
+
+
+logger.addFilter(_QuietFilter())
+
+
+def is_quiet():
+    return getattr(_local, "quiet", False)
+
+
+@contextmanager
+def quiet(enabled=True):
+    """
+    Drops the log records of the current thread within the block
+    (if enabled), the other threads are not affected
+    """
+    prev_state = is_quiet()
+    _local.quiet = prev_state or enabled
+    try:
+        yield
+    finally:
+        _local.quiet = prev_state
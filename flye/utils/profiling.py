@@ -0,0 +1,216 @@
+#(c) 2020 by Authors
+#This file is a part of Flye program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Profiling of the worker pool tasks (--profile). The tasks are profiled
+by sampling their stacks on a CPU time timer, so the overhead does not
+depend on the number of function calls. The samples are stored in the
+pstats format: call counts are the numbers of samples, and times
+are the sampled CPU times
+"""
+
+from __future__ import absolute_import
+import os
+import sys
+import signal
+import time
+import pstats
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger()
+
+#number of functions in the stage summary
+_SUMMARY_LINES = 50
+#CPU time (in seconds) between the stack samples
+_SAMPLE_INTERVAL = 0.005
+
+try:
+    _cpu_clock = time.process_time
+except AttributeError:
+    _cpu_clock = time.clock
+
+#output directory, None if profiling is off
+_out_dir = None
+_lock = threading.Lock()
+#stage name -> {worker id -> pstats.Stats}
+_stage_stats = {}
+
+
+class _StackSampler(object):
+    """
+    Samples the stack of the main thread (below the frame that started
+    the sampling) on the ITIMER_PROF signal. Each sample is weighted by
+    the CPU time since the previous one, as the signals that arrive
+    during a long call into C code are merged
+    """
+    def __init__(self, base_frame):
+        self.base_frame = base_frame
+        #stack of code objects (innermost first) -> [samples, seconds]
+        self.stacks = defaultdict(lambda: [0, 0.0])
+        self.last_time = None
+        self.prev_handler = None
+
+    def start(self):
+        self.prev_handler = signal.signal(signal.SIGPROF, self._sample)
+        self.last_time = _cpu_clock()
+        signal.setitimer(signal.ITIMER_PROF, _SAMPLE_INTERVAL,
+                         _SAMPLE_INTERVAL)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.prev_handler or signal.SIG_DFL)
+
+    def _sample(self, _signum, frame):
+        cur_time = _cpu_clock()
+        stack = []
+        while frame is not None and frame is not self.base_frame:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        counts = self.stacks[tuple(stack)]
+        counts[0] += 1
+        counts[1] += cur_time - self.last_time
+        self.last_time = cur_time
+
+    def stats(self):
+        """
+        Converts the samples into the pstats dictionary:
+        function -> (samples, samples, own time, cumulative time, callers)
+        """
+        def _key(code):
+            return code.co_filename, code.co_firstlineno, code.co_name
+
+        funcs = defaultdict(lambda: [0, 0.0, 0.0])
+        callers = defaultdict(lambda: defaultdict(lambda: [0, 0.0, 0.0]))
+        for stack, (num_samples, seconds) in self.stacks.items():
+            keys = [_key(code) for code in stack]
+            if not keys:
+                continue
+            funcs[keys[0]][1] += seconds
+            #recursive functions are counted once per sample
+            seen = set()
+            for pos, key in enumerate(keys):
+                if key in seen:
+                    continue
+                seen.add(key)
+                funcs[key][0] += num_samples
+                funcs[key][2] += seconds
+                if pos + 1 < len(keys):
+                    edge = callers[key][keys[pos + 1]]
+                    edge[0] += num_samples
+                    edge[1] += seconds if pos == 0 else 0.0
+                    edge[2] += seconds
+
+        return {key: (samples, samples, own_time, cum_time,
+                      {caller: (n, n, tt, ct) for caller, (n, tt, ct)
+                       in callers[key].items()})
+                for key, (samples, own_time, cum_time) in funcs.items()}
+
+
+class _RawStats(object):
+    """
+    Stats received from a worker, in the form accepted by pstats.Stats
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def enable(out_dir):
+    """
+    Turns on profiling of the tasks that run in the worker processes,
+    should be called before the workers are started
+    """
+    global _out_dir
+    _out_dir = out_dir
+
+
+def init_worker():
+    """
+    Called in a new worker: forgets the parent's stats
+    """
+    _stage_stats.clear()
+
+
+def start_task():
+    """
+    Starts profiling a task in a worker (None if profiling is off).
+    Should be called from the main thread, the frames of the caller
+    and above are not included
+    """
+    if _out_dir is None:
+        return None
+    profiler = _StackSampler(sys._getframe(1))
+    profiler.start()
+    return profiler
+
+
+def finish_task(profiler):
+    """
+    Returns the raw (picklable) stats of the task
+    """
+    if profiler is None:
+        return None
+    profiler.stop()
+    return profiler.stats()
+
+
+def add_task_stats(stage_name, worker_id, raw_stats):
+    """
+    Adds the stats of a task that was run by the given worker
+    """
+    with _lock:
+        stage_name = stage_name or "other"
+        workers = _stage_stats.setdefault(stage_name, {})
+        if worker_id in workers:
+            workers[worker_id].add(_RawStats(raw_stats))
+        else:
+            workers[worker_id] = pstats.Stats(_RawStats(raw_stats))
+
+
+def write_stage(stage_name):
+    """
+    Writes the per-worker profiles of the stage (that can be opened
+    with pstats), the merged profile and its summary
+    """
+    with _lock:
+        workers = _stage_stats.pop(stage_name, None)
+    if not workers:
+        return
+
+    stage_dir = os.path.join(_out_dir, stage_name)
+    if not os.path.isdir(stage_dir):
+        os.makedirs(stage_dir)
+    merged = None
+    for worker_id, stats in sorted(workers.items()):
+        stats.dump_stats(os.path.join(stage_dir,
+                                      "worker_{0}.prof".format(worker_id)))
+        if merged is None:
+            merged = pstats.Stats(_RawStats(dict(stats.stats)))
+        else:
+            merged.add(stats)
+    merged.dump_stats(os.path.join(stage_dir, "merged.prof"))
+
+    summary_file = os.path.join(stage_dir, "summary.txt")
+    with open(summary_file, "w") as f:
+        merged.stream = f
+        f.write("Merged profile of {0} worker(s), sampled every {1} ms of "
+                "CPU time (ncalls are the numbers of samples)\n"
+                .format(len(workers), int(_SAMPLE_INTERVAL * 1000)))
+        merged.sort_stats("cumulative").print_stats(_SUMMARY_LINES)
+        merged.sort_stats("tottime").print_stats(_SUMMARY_LINES)
+    logger.debug("Profile of stage %s: %s", stage_name, summary_file)
+
+
+def write_all():
+    """
+    Writes the profiles of all stages that were not written yet
+    """
+    with _lock:
+        stage_names = list(_stage_stats.keys())
+    for stage_name in stage_names:
+        write_stage(stage_name)
@@ -0,0 +1,64 @@
+#(c) 2020 by Authors
+#This file is a part of Flye program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Passes messages between the main process and the worker processes
+(see WorkerPool). Top-level fields of the result tuples that are
+arrays (or long byte strings) are not pickled: they are written to
+the pipe directly from their memory and received into a preallocated array
+"""
+
+from __future__ import absolute_import
+from array import array
+
+#byte fields smaller than this are pickled together with the rest
+_MIN_RAW_BYTES = 1 << 16
+
+
+def send_message(connection, header, payload):
+    """
+    Sends the message (picklable header and payload) through the
+    connection. If the payload is a tuple, its array fields (and long byte
+    strings) are not pickled, but written directly from their memory
+    """
+    if not isinstance(payload, tuple):
+        connection.send((header, payload, None))
+        return
+
+    fields = list(payload)
+    raw_fields = []
+    for field_id, field in enumerate(fields):
+        if isinstance(field, array):
+            raw_fields.append((field_id, field.typecode, len(field)))
+        elif isinstance(field, bytes) and len(field) >= _MIN_RAW_BYTES:
+            raw_fields.append((field_id, None, len(field)))
+        else:
+            continue
+        fields[field_id] = None
+
+    connection.send((header, fields, raw_fields))
+    for field_id, _, _ in raw_fields:
+        connection.send_bytes(payload[field_id])
+
+
+def recv_message(connection):
+    """
+    Receives the message sent with send_message,
+    returns the header and the payload
+    """
+    header, payload, raw_fields = connection.recv()
+    if raw_fields is None:
+        return header, payload
+
+    for field_id, typecode, length in raw_fields:
+        if typecode is None:
+            payload[field_id] = connection.recv_bytes()
+        else:
+            buffer = array(typecode, [0]) * length
+            if length > 0:
+                connection.recv_bytes_into(buffer)
+            else:
+                connection.recv_bytes()
+            payload[field_id] = buffer
+    return header, tuple(payload)
@@ -17,6 +17,10 @@ import subprocess
 import logging
 import multiprocessing
 import ctypes
+import copy
+import time
+from array import array
+from bisect import bisect_left
 
 #In Python2, everything is bytes (=str)
 #In Python3, we are doing IO in bytes, but everywhere else strngs = unicode
@@ -33,9 +37,21 @@ from flye.six.moves import range
 from flye.six import iteritems
 
 import flye.utils.fasta_parser as fp
+import flye.utils.telemetry as telemetry
 
 logger = logging.getLogger()
 
+#polling interval (in seconds) for readers waiting on the SAM sorter
+_INDEX_WAIT = 0.1
+#window (in bases) for the read coverage limit (see _CoverageLimit)
+_COVERAGE_WINDOW = 1000
+_SPAN_PARSER = re.compile(b"([0-9]+)[MDN=X]")
+#SynchronizedSamReader fields that are not passed to the worker tasks
+_INDEX_FIELDS = ["lock", "eof", "ctg_start", "ctg_end", "ctg_length",
+                 "ctg_shards", "ctg_alignments", "num_indexed", "next_contig",
+                 "next_shard", "index_done", "ctg_names", "shard_callback",
+                 "shard_ranges", "aln_file"]
+
 Alignment = namedtuple("Alignment", ["qry_id", "trg_id", "qry_start", "qry_end",
                                      "qry_sign", "qry_len", "trg_start",
                                      "trg_end", "trg_sign", "trg_len",
@@ -52,7 +68,8 @@ class PafHit(object):
     Stores paf alignment
     """
     __slots__ = ("query", "query_length", "query_start", "query_end",
-                 "target", "target_length", "target_start", "target_end")
+                 "strand", "target", "target_length", "target_start",
+                 "target_end")
     def __init__(self, raw_hit):
         hit = raw_hit.split()
 
@@ -61,6 +78,8 @@ class PafHit(object):
         self.query_start = int(hit[2])
         self.query_end = int(hit[3])
 
+        self.strand = hit[4]
+
         self.target = hit[5]
         self.target_length = int(hit[6])
         self.target_start = int(hit[7])
@@ -94,6 +113,23 @@ def read_paf(filename):
             yield PafHit(_STR(raw_hit))
 
 
+def read_sam_spans(filename):
+    """
+    Streams out (read id, contig id, start, end) of the mapped alignments
+    (0-based reference coordinates, end exclusive)
+    """
+    with open(filename, "rb") as f:
+        for line in f:
+            if _is_sam_header(line):
+                continue
+            tokens = line.split(None, 6)
+            if int(tokens[1]) & 0x4:
+                continue
+            start = int(tokens[3]) - 1
+            span = sum(int(x) for x in _SPAN_PARSER.findall(tokens[5]))
+            yield _STR(tokens[0]), _STR(tokens[2]), start, start + span
+
+
 def read_paf_grouped(filename):
     """
     Outputs chunks of alignments for each (query, target)pair.
@@ -118,9 +154,26 @@ def read_paf_grouped(filename):
 class SynchronizedSamReader(object):
     """
     Parses SAM file in multiple threads.
+    The file is split into per-contig byte ranges (the index) that are
+    dispatched to the worker tasks (see dispatch_shards). If a SamSorter
+    is given, the index is filled by the sorter while the sorted file is
+    being written, so the contigs could be processed as soon as their
+    alignments are sorted. If shard_length is set, long contigs are
+    additionally split into shards (position windows) of approximately
+    this length, which are processed independently (see read_shard).
+    Each shard only reads the byte ranges of the alignments that
+    overlap it (see _shard_byte_ranges).
+    If max_coverage is set, a contig that is read whole stops once
+    its aligned read bases exceed max_coverage times the contig length.
+    Within a shard, the coverage is limited per window instead
+    (see _CoverageLimit), so that every part of the shard keeps reads.
+    If group_separator is set, read and contig names start with a group
+    name followed by the separator, and only the alignments of reads
+    to the contigs of the same group are used.
     """
     def __init__(self, sam_alignment, reference_fasta,
-                 max_coverage=None, use_secondary=False):
+                 max_coverage=None, use_secondary=False, sam_sorter=None,
+                 shard_length=None, shard_overlap=0, group_separator=None):
         #will not be changed during exceution, each process has its own copy
         self.aln_path = sam_alignment
         self.aln_file = None
@@ -132,6 +185,11 @@ class SynchronizedSamReader(object):
         self.use_secondary = use_secondary
         self.cigar_parser = None
         self.processed_contigs = None
+        self.shard_length = shard_length
+        self.shard_overlap = shard_overlap
+        self.group_separator = (_BYTES(group_separator)
+                                if group_separator is not None else None)
+        self.span_parser = _SPAN_PARSER
 
         #reading SAM header
         if not os.path.exists(self.aln_path):
@@ -153,9 +211,40 @@ class SynchronizedSamReader(object):
                         self.seq_lengths[_STR(seq_name)] = seq_len
 
         #will be shared between processes
+        #each contig appears in the index at most once (file is sorted)
+        max_contigs = max(len(self.ref_fasta), len(self.seq_lengths), 1)
         self.lock = multiprocessing.Lock()
         self.eof = multiprocessing.Value(ctypes.c_bool, False)
-        self.position = multiprocessing.Value(ctypes.c_longlong, 0)
+        self.ctg_start = multiprocessing.Array(ctypes.c_longlong, max_contigs,
+                                               lock=False)
+        self.ctg_end = multiprocessing.Array(ctypes.c_longlong, max_contigs,
+                                             lock=False)
+        self.ctg_length = multiprocessing.Array(ctypes.c_longlong, max_contigs,
+                                                lock=False)
+        self.ctg_shards = multiprocessing.Array(ctypes.c_int, max_contigs,
+                                                lock=False)
+        self.ctg_alignments = multiprocessing.Array(ctypes.c_longlong,
+                                                    max_contigs, lock=False)
+        self.num_indexed = multiprocessing.Value(ctypes.c_int, 0, lock=False)
+        self.next_contig = multiprocessing.Value(ctypes.c_int, 0, lock=False)
+        self.next_shard = multiprocessing.Value(ctypes.c_int, 0, lock=False)
+        self.index_done = multiprocessing.Value(ctypes.c_bool, False,
+                                                lock=False)
+        #only used in the main process
+        self.ctg_names = []
+        self.shard_callback = None
+        #contig id -> byte ranges of each shard (see _shard_byte_ranges)
+        self.shard_ranges = {}
+
+        if sam_sorter is None:
+            self._build_index()
+
+    def __getstate__(self):
+        #the index is not passed to the worker tasks
+        state = self.__dict__.copy()
+        for field in _INDEX_FIELDS:
+            state[field] = None
+        return state
 
     def init_reading(self):
         """
@@ -174,6 +263,254 @@ class SynchronizedSamReader(object):
     def is_eof(self):
         return self.eof.value
 
+    def _contig_length(self, contig_name):
+        #In rare cases minimap2 does not output SQ tag, so need to check
+        contig_length = self.seq_lengths.get(_STR(contig_name))
+        if contig_length is None:
+            contig_length = len(self.ref_fasta.get(contig_name, b""))
+        return contig_length
+
+    def line_span(self, line):
+        """
+        Reference coordinates (0-based, end exclusive) of a SAM record
+        """
+        tokens = line.split(None, 6)
+        start = int(tokens[3]) - 1
+        return start, start + self._reference_span(tokens[5])
+
+    def add_contig(self, start_offset, end_offset, contig_name,
+                   num_alignments=0, positions=None):
+        """
+        Registers byte range of the alignments of a single contig.
+        positions is a tuple of arrays (start, end, byte offset) with
+        the coordinates of each alignment (see line_span), which are
+        used to select the byte ranges of the contig shards
+        """
+        contig_length = self._contig_length(contig_name)
+        num_shards = 1
+        if self.shard_length:
+            num_shards = max(contig_length // self.shard_length, 1)
+        shard_ranges = None
+        if positions is not None and num_shards > 1:
+            shard_ranges = self._shard_byte_ranges(positions, contig_length,
+                                                   num_shards, end_offset)
+
+        with self.lock:
+            num_indexed = self.num_indexed.value
+            if num_indexed >= len(self.ctg_start):
+                raise AlignmentException("Alignment file is not sorted")
+            self.ctg_start[num_indexed] = start_offset
+            self.ctg_end[num_indexed] = end_offset
+            self.ctg_length[num_indexed] = contig_length
+            self.ctg_shards[num_indexed] = num_shards
+            self.ctg_alignments[num_indexed] = num_alignments
+            self.num_indexed.value = num_indexed + 1
+            self.ctg_names.append(contig_name)
+            if shard_ranges is not None:
+                self.shard_ranges[num_indexed] = shard_ranges
+
+        if self.shard_callback is not None:
+            self._dispatch_contig(num_indexed, self.shard_callback)
+
+    def _shard_byte_ranges(self, positions, contig_length, num_shards,
+                           end_offset):
+        """
+        For each shard, selects the byte ranges of the alignments that
+        overlap it: the alignments that start within the longest alignment
+        span before the shard, plus the ones at the contig end that wrap
+        around the origin (if the shard is covered by such alignments).
+        If the alignments are not sorted by position, they are selected
+        in the position order, and each shard gets the byte ranges of its
+        lines (in the file order)
+        """
+        starts, ends, offsets = positions
+        num_lines = len(starts)
+        order = None
+        if any(starts[i] > starts[i + 1] for i in range(num_lines - 1)):
+            order = sorted(range(num_lines), key=starts.__getitem__)
+            starts = [starts[i] for i in order]
+            ends = [ends[i] for i in order]
+        max_span = max(e - s for s, e in zip(starts, ends))
+        max_wrap = max(ends) - contig_length
+        tail_first = bisect_left(starts, contig_length - max_span)
+
+        def _offset(line_id):
+            return offsets[line_id] if line_id < num_lines else end_offset
+
+        shard_ranges = []
+        for shard_id in range(num_shards):
+            shard_start, shard_end = _shard_coords(contig_length, num_shards,
+                                                   shard_id)
+            first = bisect_left(starts, shard_start - max_span)
+            last = bisect_left(starts, shard_end + self.shard_overlap)
+            line_ranges = [(first, last)]
+            if max_wrap > shard_start:
+                if tail_first <= last:
+                    line_ranges = [(min(first, tail_first), num_lines)]
+                else:
+                    line_ranges.append((tail_first, num_lines))
+            if order is None:
+                shard_ranges.append(tuple((_offset(f), _offset(l))
+                                          for f, l in line_ranges if f < l))
+                continue
+
+            byte_ranges = []
+            line_ids = sorted(order[i] for f, l in line_ranges
+                              for i in range(f, l))
+            for line_id in line_ids:
+                if byte_ranges and byte_ranges[-1][1] == offsets[line_id]:
+                    byte_ranges[-1][1] = _offset(line_id + 1)
+                else:
+                    byte_ranges.append([offsets[line_id],
+                                        _offset(line_id + 1)])
+            shard_ranges.append(tuple((start, end)
+                                      for start, end in byte_ranges))
+        return shard_ranges
+
+    def finish_index(self):
+        """
+        Called when all contigs were added to the index
+        """
+        with self.lock:
+            self.index_done.value = True
+
+    def _build_index(self):
+        """
+        Scans the (already sorted) alignment file and records contig ranges
+        """
+        seen_contigs = set()
+        current_contig = None
+        contig_start = 0
+        num_alignments = 0
+        positions = None
+        position = 0
+        with open(self.aln_path, "rb") as f:
+            for line in f:
+                line_start = position
+                position += len(line)
+                if _is_sam_header(line):
+                    continue
+                tokens = line.split(None, 3)
+                if len(tokens) < 4:
+                    continue
+
+                read_contig = tokens[2]
+                if read_contig != current_contig:
+                    if current_contig is not None:
+                        self.add_contig(contig_start, line_start,
+                                        current_contig, num_alignments,
+                                        positions)
+                    if read_contig in seen_contigs:
+                        raise AlignmentException("Alignment file is not sorted")
+                    seen_contigs.add(read_contig)
+                    current_contig = read_contig
+                    contig_start = line_start
+                    num_alignments = 0
+                    positions = _new_positions() if self.shard_length else None
+                num_alignments += 1
+                if positions is not None:
+                    _add_position(positions, self.line_span(line), line_start)
+
+        if current_contig is not None:
+            self.add_contig(contig_start, position, current_contig,
+                            num_alignments, positions)
+        self.finish_index()
+
+    def _next_range(self):
+        """
+        Returns the byte range of the next unprocessed contig (shard)
+        and the shard coordinates. If the index is still being filled,
+        waits until the next contig is ready.
+        """
+        while True:
+            with self.lock:
+                if self.next_contig.value < self.num_indexed.value:
+                    contig_id = self.next_contig.value
+                    shard_id = self.next_shard.value
+                    num_shards = self.ctg_shards[contig_id]
+                    if shard_id + 1 < num_shards:
+                        self.next_shard.value += 1
+                    else:
+                        self.next_contig.value += 1
+                        self.next_shard.value = 0
+
+                    return self._shard_range(contig_id, shard_id)
+                if self.index_done.value:
+                    self.eof.value = True
+                    return None
+            time.sleep(_INDEX_WAIT)
+
+    def _shard_range(self, contig_id, shard_id):
+        """
+        Returns the byte ranges of the shard alignments (the whole contig
+        range, if the shard ranges are not known) and the shard coordinates
+        """
+        shard_start, shard_end = _shard_coords(self.ctg_length[contig_id],
+                                               self.ctg_shards[contig_id],
+                                               shard_id)
+        if self.shard_ranges and contig_id in self.shard_ranges:
+            byte_ranges = self.shard_ranges[contig_id][shard_id]
+        else:
+            byte_ranges = ((self.ctg_start[contig_id], self.ctg_end[contig_id]),)
+        return byte_ranges, shard_start, shard_end
+
+    def _shard_weight(self, contig_id, shard_id):
+        """
+        Expected processing time of the shard: its length times the number
+        of alignments (assuming they are evenly spread along the contig)
+        """
+        _, shard_start, shard_end = self._shard_range(contig_id, shard_id)
+        shard_length = shard_end - shard_start
+        contig_length = max(self.ctg_length[contig_id], 1)
+        return (shard_length * self.ctg_alignments[contig_id] *
+                shard_length // contig_length)
+
+    def dispatch_shards(self, submit_func, sam_sorter=None):
+        """
+        Calls submit_func(contig_id, contig_reader, shard, weight) for every
+        shard of the alignment. contig_reader is a picklable copy of the
+        reader with the reference of that contig only, which should be used
+        to read the shard in a worker task (see read_shard). weight is the
+        expected processing time of the shard (see _shard_weight).
+        If sam_sorter is given, it is run, and the shards are dispatched
+        as soon as their contig is sorted. Otherwise, the largest
+        contigs are dispatched first
+        """
+        if sam_sorter is not None:
+            self.shard_callback = submit_func
+            try:
+                sam_sorter.run(self)
+            finally:
+                self.shard_callback = None
+            return
+
+        contig_ids = list(range(self.num_indexed.value))
+        contig_ids.sort(key=lambda c: self._shard_weight(c, 0), reverse=True)
+        for contig_id in contig_ids:
+            self._dispatch_contig(contig_id, submit_func)
+
+    def _dispatch_contig(self, contig_id, submit_func):
+        contig_name = self.ctg_names[contig_id]
+        #copying drops the index (see __getstate__)
+        contig_reader = copy.copy(self)
+        contig_reader.ref_fasta = {}
+        contig_reader.seq_lengths = {}
+        if contig_name in self.ref_fasta:
+            contig_reader.ref_fasta[contig_name] = self.ref_fasta[contig_name]
+        if _STR(contig_name) in self.seq_lengths:
+            contig_reader.seq_lengths[_STR(contig_name)] = \
+                self.seq_lengths[_STR(contig_name)]
+        for shard_id in range(self.ctg_shards[contig_id]):
+            submit_func(_STR(contig_name), contig_reader,
+                        self._shard_range(contig_id, shard_id),
+                        self._shard_weight(contig_id, shard_id))
+
+    def _reference_span(self, cigar_str):
+        """
+        Number of reference bases covered by the alignment
+        """
+        return sum(int(x) for x in self.span_parser.findall(cigar_str))
+
     def parse_cigar(self, cigar_str, read_str, ctg_name, ctg_pos):
         ctg_str = self.ref_fasta[ctg_name]
         trg_seq = []
@@ -243,69 +580,106 @@ class SynchronizedSamReader(object):
         """
         Alignment file is expected to be sorted!
         """
-
-        chunk_buffer = []
-        parsed_contig = None
-
-        with self.lock:
-            self.aln_file.seek(self.position.value)
-            if self.eof.value:
+        while True:
+            contig_range = self._next_range()
+            if contig_range is None:
                 return None, []
 
-            current_contig = None
-            while True:
-                self.position.value = self.aln_file.tell()
+            byte_ranges, _, _ = contig_range
+            ctg_id, alignments = self._parse_range(byte_ranges)
+            if alignments:
+                return ctg_id, alignments
+
+    def read_shard(self, shard):
+        """
+        Returns contig id, shard start and end, and the alignments
+        overlapping the shard (extended by shard_overlap to the right).
+        Alignments are not trimmed to the shard boundaries. If the reader
+        has no shard_length, the shard is the whole contig
+        """
+        byte_ranges, shard_start, shard_end = shard
+        region = None
+        if self.shard_length:
+            region = (shard_start, shard_end + self.shard_overlap)
+        ctg_id, alignments = self._parse_range(byte_ranges, region)
+        return ctg_id, shard_start, shard_end, alignments
+
+    def _read_lines(self, byte_ranges):
+        for start_offset, end_offset in byte_ranges:
+            self.aln_file.seek(start_offset)
+            position = start_offset
+            while position < end_offset:
                 line = self.aln_file.readline()
                 if not line: break
-                if _is_sam_header(line): continue
-
-                tokens = line.strip().split()
-                if len(tokens) < 11:
-                    continue
-                    #raise AlignmentException("Error reading SAM file")
-
-                read_contig = tokens[2]
-                flags = int(tokens[1])
-                is_unmapped = flags & 0x4
-                is_secondary = flags & 0x100
-                is_supplementary = flags & 0x800    #allow supplementary
-
-                #if is_unmapped or is_secondary: continue
-                if is_unmapped: continue
-                if is_secondary and not self.use_secondary: continue
-                if read_contig in self.processed_contigs:
-                    raise AlignmentException("Alignment file is not sorted")
+                position += len(line)
+                yield line
 
-                if read_contig != current_contig:
-                    prev_contig = current_contig
-                    current_contig = read_contig
+    def _parse_range(self, byte_ranges, region=None):
+        """
+        Parses alignments from the given byte ranges (single contig).
+        If region is given, only alignments that overlap it are parsed
+        (including the ones that wrap around the contig origin).
+        """
+        parsed_contig = None
+        coverage_limit = None
+        #contig length for the whole contig coverage limit
+        limit_length = None
+        sequence_length = 0
+        alignments = []
 
-                    if prev_contig is not None:
-                        self.processed_contigs.add(prev_contig)
-                        parsed_contig = prev_contig
-                        break
-                    else:
-                        chunk_buffer = [tokens]
-                else:
-                    chunk_buffer.append(tokens)
+        for line in self._read_lines(byte_ranges):
+            if _is_sam_header(line): continue
 
-            if not parsed_contig:
-                self.eof.value = True
-                parsed_contig = current_contig
-        #end with
+            tokens = line.strip().split()
+            if len(tokens) < 11:
+                continue
+                #raise AlignmentException("Error reading SAM file")
 
-        sequence_length = 0
-        alignments = []
-        for tokens in chunk_buffer:
             read_id = tokens[0]
             read_contig = tokens[2]
             cigar_str = tokens[5]
             read_str = tokens[9]
             ctg_pos = int(tokens[3])
             flags = int(tokens[1])
+            is_unmapped = flags & 0x4
             is_reversed = flags & 0x16
             is_secondary = flags & 0x100
 
+            #if is_unmapped or is_secondary: continue
+            if is_unmapped: continue
+            if is_secondary and not self.use_secondary: continue
+            if (self.group_separator is not None and
+                    read_id.split(self.group_separator, 1)[0] !=
+                    read_contig.split(self.group_separator, 1)[0]):
+                continue
+            if parsed_contig is None:
+                parsed_contig = read_contig
+                contig_length = self._contig_length(read_contig)
+                if region is None:
+                    if read_contig in self.processed_contigs:
+                        raise AlignmentException("Alignment file is not sorted")
+                    self.processed_contigs.add(read_contig)
+                if region is None or (region[0] <= 0 and
+                                      region[1] >= contig_length):
+                    #In rare cases minimap2 does not output SQ tag,
+                    #then the coverage is not limited
+                    if (self.max_coverage is not None and
+                            self.seq_lengths.get(_STR(read_contig))):
+                        limit_length = self.seq_lengths[_STR(read_contig)]
+                else:
+                    coverage_limit = _CoverageLimit(self.max_coverage,
+                                                    region, contig_length)
+
+            aln_segments = None
+            if coverage_limit is not None:
+                aln_start = ctg_pos - 1
+                aln_end = aln_start + self._reference_span(cigar_str)
+                aln_segments = coverage_limit.clip(aln_start, aln_end)
+                if region is not None and not aln_segments:
+                    continue
+                if coverage_limit.is_saturated(aln_segments):
+                    continue
+
             if read_str == b"*":
                 raise Exception("Error parsing SAM: record without read sequence")
 
@@ -322,42 +696,200 @@ class SynchronizedSamReader(object):
                             _STR(qry_seq), _STR(trg_seq),
                             err_rate, is_secondary)
             alignments.append(aln)
+            if aln_segments:
+                coverage_limit.add(aln_segments)
 
-            sequence_length += qry_end - qry_start
-            #In rare cases minimap2 does not output SQ tag, so need to check
-            if _STR(parsed_contig) in self.seq_lengths:
-                contig_length = self.seq_lengths[_STR(parsed_contig)]
-                if sequence_length // contig_length > self.max_coverage:
+            if limit_length is not None:
+                sequence_length += qry_end - qry_start
+                if sequence_length // limit_length > self.max_coverage:
                     break
 
-        if parsed_contig is None:
+        if not alignments:
             return None, []
         return _STR(parsed_contig), alignments
 
 
-def preprocess_sam(sam_file, work_dir):
+def _shard_coords(contig_length, num_shards, shard_id):
+    shard_start = shard_id * (contig_length // num_shards)
+    shard_end = (shard_start + contig_length // num_shards
+                 if shard_id + 1 < num_shards else contig_length)
+    return shard_start, shard_end
+
+
+def _new_positions():
+    return array("q"), array("q"), array("q")
+
+
+def _add_position(positions, span, offset):
+    positions[0].append(span[0])
+    positions[1].append(span[1])
+    positions[2].append(offset)
+
+
+class _CoverageLimit(object):
+    """
+    Limits the read coverage of a shard region: an alignment is skipped
+    if every window it covers already has max_coverage. Alignments are
+    clipped to the region (the part that wraps around the origin
+    of the contig is counted from the contig start)
+    """
+    def __init__(self, max_coverage, region, contig_length):
+        self.region = region
+        self.contig_length = contig_length
+        self.max_bases = (max_coverage * _COVERAGE_WINDOW
+                          if max_coverage is not None else None)
+        num_windows = (region[1] - region[0]) // _COVERAGE_WINDOW + 1
+        self.window_bases = [0] * num_windows
+
+    def clip(self, aln_start, aln_end):
+        """
+        Parts of the alignment within the region
+        """
+        segments = []
+        for seg_start, seg_end in [(aln_start, aln_end),
+                                   (0, aln_end - self.contig_length)]:
+            seg_start = max(seg_start, self.region[0])
+            seg_end = min(seg_end, self.region[1])
+            if seg_start < seg_end:
+                segments.append((seg_start, seg_end))
+        return segments
+
+    def _windows(self, segments):
+        for seg_start, seg_end in segments:
+            offset = seg_start - self.region[0]
+            while seg_start < seg_end:
+                wnd_end = min(seg_end, seg_start - offset % _COVERAGE_WINDOW +
+                              _COVERAGE_WINDOW)
+                yield offset // _COVERAGE_WINDOW, wnd_end - seg_start
+                offset += wnd_end - seg_start
+                seg_start = wnd_end
+
+    def is_saturated(self, segments):
+        if self.max_bases is None or not segments:
+            return False
+        return all(self.window_bases[w] >= self.max_bases
+                   for w, _ in self._windows(segments))
+
+    def add(self, segments):
+        for wnd, num_bases in self._windows(segments):
+            self.window_bases[wnd] += num_bases
+
+
+class SamSorter(object):
+    """
+    Sorts the expanded alignment file by reference sequence id
+    and appends it to the final SAM file (that already contains headers).
+    Optionally, reports each contig to a reader as soon as its
+    alignments are sorted and written (in this case, the alignments of
+    each contig are also sorted by position, so the reader could
+    select the alignments of the contig shards).
+    """
+    def __init__(self, sam_file, expanded_sam, headers, work_dir):
+        self.sam_file = sam_file
+        self.expanded_sam = expanded_sam
+        self.work_dir = work_dir
+
+        #puting SAM headers to the final postprocessed file first
+        with open(self.sam_file, "wb") as fout:
+            for line in headers:
+                fout.write(line)
+
+    def run(self, aln_reader=None):
+        """
+        Runs UNIX sort and streams its output into the final file.
+        If aln_reader is given, its index is filled on the fly.
+        """
+        #logger.debug("Sorting alignment file")
+        env = os.environ.copy()
+        env["LC_ALL"] = "C"
+        try:
+            sort_keys = ["-k", "3,3"]
+            if aln_reader is not None:
+                sort_keys += ["-k", "4,4n"]
+            sort_proc = telemetry.popen(["sort"] + sort_keys +
+                                        ["-T", self.work_dir,
+                                         self.expanded_sam],
+                                        stdout=subprocess.PIPE, env=env)
+        except OSError as e:
+            raise AlignmentException(str(e))
+
+        #appending to the final file, that already contains headers
+        with open(self.sam_file, "ab") as fout:
+            position = fout.tell()
+            current_contig = None
+            contig_start = position
+            num_alignments = 0
+            positions = None
+            index_positions = aln_reader is not None and aln_reader.shard_length
+            for line in sort_proc.stdout:
+                if _is_sam_header(line):
+                    continue
+
+                read_contig = line.split(None, 3)[2]
+                if read_contig != current_contig:
+                    if current_contig is not None and aln_reader is not None:
+                        fout.flush()
+                        aln_reader.add_contig(contig_start, position,
+                                              current_contig, num_alignments,
+                                              positions)
+                    current_contig = read_contig
+                    contig_start = position
+                    num_alignments = 0
+                    positions = _new_positions() if index_positions else None
+
+                if positions is not None:
+                    _add_position(positions, aln_reader.line_span(line),
+                                  position)
+                fout.write(line)
+                position += len(line)
+                num_alignments += 1
+
+            fout.flush()
+            if current_contig is not None and aln_reader is not None:
+                aln_reader.add_contig(contig_start, position, current_contig,
+                                      num_alignments, positions)
+
+        sort_proc.stdout.close()
+        if telemetry.wait(sort_proc) != 0:
+            raise AlignmentException("Error sorting alignment file, "
+                                     "sort returned {0}"
+                                     .format(sort_proc.returncode))
+        if aln_reader is not None:
+            aln_reader.finish_index()
+
+        #don't need the expanded file anymore
+        os.remove(self.expanded_sam)
+
+
+def preprocess_sam(sam_file, work_dir, stream_sorting=False,
+                   group_filter=None):
     """
     Proprocesses minimap2 output by adding SEQ
     to secondary alignments, removing
     unaligned reads and then sorting
-    file by reference sequence id
+    file by reference sequence id.
+    If stream_sorting is set, the sorting is not performed here,
+    instead SamSorter is returned, which should be passed to
+    SynchronizedSamReader and then run.
+    group_filter is a tuple (group separator, min secondary-to-primary
+    score ratio, max secondary alignments), see _filter_group_alignments
     """
     expanded_sam = sam_file + "_expanded"
-    merged_file = sam_file + "_merged"
-    sorted_file = sam_file + "_sorted"
 
-    #puting SAM headers to the final postprocessed file first
-    with open(sam_file, "rb") as hdr_in, open(merged_file, "wb") as fout:
+    headers = []
+    with open(sam_file, "rb") as hdr_in:
         for line in hdr_in:
             if not _is_sam_header(line):
                 break
-            fout.write(line)
+            headers.append(line)
 
     #adding SEQ fields to secondary alignments 
     with open(sam_file, "rb") as fin, open(expanded_sam, "wb") as fout:
         prev_id = None
         prev_seq = None
         primary_reversed = None
+        #alignments of the current read (with group_filter)
+        read_alignments = []
         for line in fin:
             if _is_sam_header(line):
                 continue
@@ -400,28 +932,67 @@ def preprocess_sam(sam_file, work_dir):
                 prev_seq = read_seq
                 primary_reversed = is_reversed
 
-            fout.write(b"\t".join(tokens) + b"\n")
+            if group_filter is None:
+                fout.write(b"\t".join(tokens) + b"\n")
+                continue
+
+            if read_alignments and read_alignments[0][0] != read_id:
+                _filter_group_alignments(read_alignments, fout, *group_filter)
+                read_alignments = []
+            read_alignments.append(tokens)
+
+        if read_alignments:
+            _filter_group_alignments(read_alignments, fout, *group_filter)
 
     #don't need the original SAM anymore, cleaning up space
     os.remove(sam_file)
 
-    #logger.debug("Sorting alignment file")
-    env = os.environ.copy()
-    env["LC_ALL"] = "C"
-    subprocess.check_call(["sort", "-k", "3,3", "-T", work_dir, expanded_sam],
-                          stdout=open(sorted_file, "wb"), env=env)
+    sorter = SamSorter(sam_file, expanded_sam, headers, work_dir)
+    if stream_sorting:
+        return sorter
 
-    #don't need the expanded file anymore
-    os.remove(expanded_sam)
+    sorter.run()
+    return None
 
-    #appending to the final file, that already contains headers
-    with open(sorted_file, "rb") as sort_in, open(merged_file, "ab") as fout:
-        for line in sort_in:
-            if not _is_sam_header(line):
-                fout.write(line)
 
-    os.remove(sorted_file)
-    os.rename(merged_file, sam_file)
+def _filter_group_alignments(alignments, fout, group_separator,
+                             secondary_ratio, max_secondary):
+    """
+    Writes the alignments of a single read that are to the contigs of the
+    read's own group (read and contig names start with the group id
+    followed by the separator, see polish.polish_batch). The groups are
+    aligned together, so the best alignment within the group could be
+    reported as secondary (if the primary is to a similar contig of
+    another group): in this case, it becomes primary. Secondary alignments
+    are then selected relative to the group primary, the same way as
+    minimap2 does (by the alignment score)
+    """
+    separator = _BYTES(group_separator)
+    def _group(name):
+        return name.split(separator, 1)[0]
+
+    def _score(tokens):
+        for tag in tokens[11:]:
+            if tag.startswith(b"AS:i:"):
+                return int(tag[5:])
+        return 0
+
+    read_group = _group(alignments[0][0])
+    in_group = [t for t in alignments if _group(t[2]) == read_group]
+    #primary alignment and the secondary ones, best first
+    chain = sorted([t for t in in_group if not int(t[1]) & 0x800],
+                   key=lambda t: (int(t[1]) & 0x100 != 0, -_score(t)))
+    supplementary = [t for t in in_group if int(t[1]) & 0x800]
+
+    if chain:
+        primary = chain[0]
+        primary[1] = _BYTES(str(int(primary[1]) & ~0x100))
+        min_score = _score(primary) * secondary_ratio
+        chain = [primary] + [t for t in chain[1:]
+                             if _score(t) >= min_score][:max_secondary]
+
+    for tokens in chain + supplementary:
+        fout.write(b"\t".join(tokens) + b"\n")
 
 
 def _is_sam_header(line):
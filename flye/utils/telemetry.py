@@ -0,0 +1,385 @@
+#(c) 2020 by Authors
+#This file is a part of Flye program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Resource usage of the pipeline stages and the external binaries
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+import os
+import sys
+import json
+import time
+import errno
+import logging
+import resource
+import threading
+import subprocess
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+_IO_FIELDS = ["rchar", "wchar", "read_bytes", "write_bytes"]
+#ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+_RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+
+_lock = threading.Lock()
+#stage of the current thread
+_local = threading.local()
+_running_stages = []
+_finished_stages = []
+#binaries that were not run within a stage (for example, in a worker)
+_unattributed = []
+_run_start = None
+_run_usage = None
+
+
+class Usage(object):
+    """
+    Resource usage: CPU time, peak memory and I/O counters
+    """
+    def __init__(self, wall_time=0.0, user_time=0.0, sys_time=0.0,
+                 max_rss=0, io=None):
+        self.wall_time = wall_time
+        self.user_time = user_time
+        self.sys_time = sys_time
+        self.max_rss = max_rss
+        self.io = io if io is not None else dict((f, 0) for f in _IO_FIELDS)
+
+    def add(self, other):
+        self.user_time += other.user_time
+        self.sys_time += other.sys_time
+        self.max_rss = max(self.max_rss, other.max_rss)
+        for field in _IO_FIELDS:
+            self.io[field] += other.io.get(field, 0)
+
+    def to_dict(self):
+        record = {"wall_time": round(self.wall_time, 3),
+                  "user_time": round(self.user_time, 3),
+                  "sys_time": round(self.sys_time, 3),
+                  "max_rss": self.max_rss}
+        record.update(self.io)
+        return record
+
+
+class StageMetrics(object):
+    """
+    Usage of a single stage: the thread that runs it in the main
+    process, the worker pool tasks and the external binaries
+    """
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.status = "running"
+        self.thread = Usage()
+        self.workers = Usage()
+        self.num_tasks = 0
+        self.binaries = []
+
+    def to_dict(self):
+        total = Usage(self.thread.wall_time)
+        total.add(self.thread)
+        total.add(self.workers)
+        for binary in self.binaries:
+            total.add(binary["usage"])
+
+        workers = self.workers.to_dict()
+        del workers["wall_time"]
+        workers["tasks"] = self.num_tasks
+        binaries = []
+        for binary in self.binaries:
+            record = {"binary": binary["binary"],
+                      "exit_code": binary["exit_code"]}
+            record.update(binary["usage"].to_dict())
+            binaries.append(record)
+
+        return {"stage": self.name, "status": self.status,
+                "start": round(self.start - (_run_start or self.start), 3),
+                "total": total.to_dict(), "main_thread": self.thread.to_dict(),
+                "workers": workers, "binaries": binaries}
+
+
+def start_run():
+    """
+    Starts measuring the run (called in the main process)
+    """
+    global _run_start, _run_usage
+    _run_start = time.time()
+    _run_usage = (resource.getrusage(resource.RUSAGE_SELF),
+                  resource.getrusage(resource.RUSAGE_CHILDREN),
+                  _read_io("self"))
+    del _finished_stages[:]
+
+
+def reset_process():
+    """
+    Forgets the stages inherited from the parent (called in a new worker)
+    """
+    _local.stage = None
+    del _running_stages[:]
+    del _finished_stages[:]
+    del _unattributed[:]
+
+
+@contextmanager
+def stage(name):
+    """
+    Measures the stage that runs in the current thread
+    """
+    metrics = StageMetrics(name)
+    start_usage = resource.getrusage(_RUSAGE_THREAD)
+    start_io = _read_io("thread-self")
+    with _lock:
+        _running_stages.append(metrics)
+    _local.stage = metrics
+    try:
+        yield metrics
+        metrics.status = "completed"
+    except BaseException:
+        metrics.status = "failed"
+        raise
+    finally:
+        _local.stage = None
+        end_usage = resource.getrusage(_RUSAGE_THREAD)
+        metrics.thread = Usage(time.time() - metrics.start,
+                               end_usage.ru_utime - start_usage.ru_utime,
+                               end_usage.ru_stime - start_usage.ru_stime,
+                               end_usage.ru_maxrss * _MAXRSS_UNIT,
+                               _io_delta(start_io, _read_io("thread-self")))
+        with _lock:
+            _running_stages.remove(metrics)
+            _finished_stages.append(metrics)
+
+
+def current_stage():
+    """
+    The stage of the current thread. Threads that were started by
+    the stage are not tracked, so if only one stage is running,
+    it is returned for any thread
+    """
+    metrics = getattr(_local, "stage", None)
+    if metrics is not None:
+        return metrics
+    with _lock:
+        if len(_running_stages) == 1:
+            return _running_stages[0]
+    return None
+
+
+def add_worker_usage(metrics, usage, binaries):
+    """
+    Adds the usage of a worker pool task, which was submitted by the
+    given stage (None if it is not known)
+    """
+    with _lock:
+        if metrics is None:
+            _unattributed.extend(binaries)
+            return
+        metrics.workers.add(usage)
+        metrics.num_tasks += 1
+        metrics.binaries.extend(binaries)
+
+
+def take_unattributed():
+    """
+    Returns and forgets the binaries that were run outside of a stage
+    """
+    with _lock:
+        binaries = _unattributed[:]
+        del _unattributed[:]
+    return binaries
+
+
+class TaskMeter(object):
+    """
+    Measures the usage of a single task in a worker process
+    (including the processes it starts) and
+    collects the binaries it runs
+    """
+    def __init__(self):
+        _reset_peak_rss()
+        self.start = time.time()
+        self.start_self = resource.getrusage(resource.RUSAGE_SELF)
+        self.start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.start_io = _read_io("self")
+
+    def finish(self):
+        end_self = resource.getrusage(resource.RUSAGE_SELF)
+        end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        user_time = (end_self.ru_utime - self.start_self.ru_utime +
+                     end_children.ru_utime - self.start_children.ru_utime)
+        sys_time = (end_self.ru_stime - self.start_self.ru_stime +
+                    end_children.ru_stime - self.start_children.ru_stime)
+        usage = Usage(time.time() - self.start, user_time, sys_time,
+                      _peak_rss(end_self),
+                      _io_delta(self.start_io, _read_io("self")))
+
+        #the binaries are reported separately
+        binaries = take_unattributed()
+        for binary in binaries:
+            usage.user_time -= binary["usage"].user_time
+            usage.sys_time -= binary["usage"].sys_time
+            for field in _IO_FIELDS:
+                usage.io[field] -= binary["usage"].io[field]
+        return usage, binaries
+
+
+def popen(cmdline, **kwargs):
+    """
+    Starts the binary with subprocess.Popen, use wait() to
+    wait for it and record its usage
+    """
+    proc = subprocess.Popen(cmdline, **kwargs)
+    proc.telemetry_start = time.time()
+    proc.telemetry_binary = os.path.basename(cmdline[0])
+    return proc
+
+
+def wait(proc):
+    """
+    Same as proc.wait(), but also records the usage of the process
+    (if it was started with popen()) in the current stage. Note that
+    the peak memory of a binary also includes the memory of the process
+    that started it (as the kernel counts it before exec)
+    """
+    start = getattr(proc, "telemetry_start", None)
+    if start is None or proc.returncode is not None:
+        return proc.wait()
+
+    io = None
+    try:
+        #the counters are still available until the process is reaped
+        if hasattr(os, "waitid"):
+            os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+            io = _read_io(str(proc.pid))
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except OSError as e:
+        #was reaped by Popen.poll() in the meantime
+        if e.errno != errno.ECHILD:
+            raise
+        return proc.wait()
+
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    usage = Usage(time.time() - start, rusage.ru_utime, rusage.ru_stime,
+                  rusage.ru_maxrss * _MAXRSS_UNIT, io)
+    record = {"binary": proc.telemetry_binary,
+              "exit_code": proc.returncode, "usage": usage}
+    metrics = current_stage()
+    with _lock:
+        if metrics is not None:
+            metrics.binaries.append(record)
+        else:
+            _unattributed.append(record)
+    return proc.returncode
+
+
+def check_call(cmdline, **kwargs):
+    """
+    subprocess.check_call that records the usage of the binary
+    """
+    returncode = wait(popen(cmdline, **kwargs))
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmdline)
+    return 0
+
+
+def write_metrics(out_file, num_threads, previous_runs=()):
+    """
+    Writes the stages of this run (after the previous runs, if resumed)
+    as JSON. Resource usage of the child processes (workers and binaries)
+    is only complete once they have exited
+    """
+    end_self = resource.getrusage(resource.RUSAGE_SELF)
+    end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_self, start_children, start_io = _run_usage
+    process = Usage(time.time() - _run_start,
+                    end_self.ru_utime - start_self.ru_utime,
+                    end_self.ru_stime - start_self.ru_stime,
+                    end_self.ru_maxrss * _MAXRSS_UNIT,
+                    _io_delta(start_io, _read_io("self")))
+    children = Usage(process.wall_time,
+                     end_children.ru_utime - start_children.ru_utime,
+                     end_children.ru_stime - start_children.ru_stime,
+                     end_children.ru_maxrss * _MAXRSS_UNIT)
+    process_dict = process.to_dict()
+    children_dict = children.to_dict()
+    for field in _IO_FIELDS:
+        del children_dict[field]
+
+    with _lock:
+        stages = [m.to_dict() for m in _finished_stages + _running_stages]
+        other = [dict(binary=b["binary"], exit_code=b["exit_code"],
+                      **b["usage"].to_dict()) for b in _unattributed]
+    run = {"start": time.strftime("%Y-%m-%d %H:%M:%S",
+                                  time.localtime(_run_start)),
+           "threads": num_threads, "process": process_dict,
+           "children": children_dict, "stages": stages,
+           "other_binaries": other}
+
+    with open(out_file, "w") as f:
+        json.dump({"runs": list(previous_runs) + [run]}, f, indent=2)
+
+
+def read_previous_runs(metrics_file):
+    """
+    Runs recorded in an existing metrics file
+    """
+    try:
+        with open(metrics_file, "r") as f:
+            return json.load(f)["runs"]
+    except (IOError, OSError, ValueError, KeyError):
+        return []
+
+
+def _read_io(pid):
+    """
+    I/O counters from /proc (zeros if not available)
+    """
+    counters = dict((f, 0) for f in _IO_FIELDS)
+    try:
+        with open(os.path.join("/proc", pid, "io"), "r") as f:
+            for line in f:
+                field, value = line.split(":")
+                if field in counters:
+                    counters[field] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return counters
+
+
+def _io_delta(start, end):
+    return dict((f, end[f] - start[f]) for f in _IO_FIELDS)
+
+
+def _reset_peak_rss():
+    """
+    Resets the peak memory of this process, so it could be
+    measured for a single task (Linux only)
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        pass
+
+
+def _peak_rss(rusage):
+    """
+    Peak memory since the last reset, or the lifetime
+    peak if it can't be reset
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return rusage.ru_maxrss * _MAXRSS_UNIT
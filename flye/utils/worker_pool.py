@@ -0,0 +1,516 @@
+#(c) 2020 by Authors
+#This file is a part of Flye program.
+#Released under the BSD license (see LICENSE file)
+
+"""
+Pipeline-wide pool of worker processes
+"""
+
+from __future__ import absolute_import
+import os
+import time
+import errno
+import fcntl
+import heapq
+import select
+import signal
+import logging
+import threading
+import traceback
+import itertools
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+
+from flye.six.moves import queue, range
+from flye.utils.result_channel import send_message, recv_message
+import flye.utils.telemetry as telemetry
+import flye.utils.profiling as profiling
+import flye.utils.log_scope as log_scope
+
+logger = logging.getLogger()
+
+_RESULT = 0
+_ERROR = 1
+#how often (in seconds) the waiting threads wake up,
+#so they could be interrupted
+_WAIT_INTERVAL = 1.0
+
+#the pool started by start_pool()
+_pipeline_pool = None
+#set in the worker processes
+_worker_process = False
+_worker_id = None
+
+
+class WorkerPool(object):
+    """
+    A set of worker processes that are forked once and then run the tasks
+    (module-level functions with picklable arguments) of all parallel
+    stages. Tasks are submitted through task groups (see TaskGroup), which
+    receive the results and the errors. A dispatcher thread in the main
+    process hands out the tasks to idle workers (heaviest first, see
+    TaskGroup.submit_weighted) and receives the results.
+    Workers ignore SIGINT, so KeyboardInterrupt is only raised in the main
+    process, which then cancels the tasks of the interrupted stage.
+    A worker that exited unexpectedly fails its task and is not restarted,
+    since the main process is multithreaded at that point and forking
+    from the dispatcher thread is not safe. Once all workers have
+    exited, the pool is closed and the remaining tasks fail.
+    Task groups opened within a worker task run inline (see task_group)
+    """
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.lock = threading.Lock()
+        #heap of (-weight, task number, group, func, args)
+        self.pending = []
+        self.task_counter = itertools.count()
+        self.closed = False
+        self.workers = [None] * num_workers
+        self.connections = [None] * num_workers
+        #task group of the task that the worker is running
+        self.running = [None] * num_workers
+        #workers that have not exited
+        self.alive = [True] * num_workers
+
+        #wakes up the dispatcher when new tasks are submitted
+        self.wakeup_in, self.wakeup_out = os.pipe()
+        flags = fcntl.fcntl(self.wakeup_out, fcntl.F_GETFL)
+        fcntl.fcntl(self.wakeup_out, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        for worker_id in range(num_workers):
+            self._start_worker(worker_id)
+        self.dispatcher = threading.Thread(target=self._dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def close(self, terminate=False):
+        """
+        Stops the workers. Unless terminate is set,
+        the running tasks are completed first
+        """
+        with self.lock:
+            self.closed = True
+            self.pending = []
+        self._wakeup()
+        self.dispatcher.join()
+
+        for worker, connection in zip(self.workers, self.connections):
+            if terminate:
+                worker.terminate()
+                continue
+            try:
+                connection.send(None)
+            except (IOError, OSError):
+                pass
+        for worker, connection in zip(self.workers, self.connections):
+            worker.join()
+            connection.close()
+        os.close(self.wakeup_in)
+        os.close(self.wakeup_out)
+
+    def _start_worker(self, worker_id):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self.connections[worker_id] = parent_conn
+        worker = multiprocessing.Process(target=_worker_main,
+                                         args=(child_conn, self, worker_id))
+        worker.start()
+        child_conn.close()
+        self.workers[worker_id] = worker
+
+    def _release_inherited(self):
+        """
+        Called in a new worker: closes the main process ends of the pipes,
+        so the workers see EOF once the main process has exited
+        """
+        for connection in self.connections:
+            if connection is not None:
+                connection.close()
+        os.close(self.wakeup_in)
+        os.close(self.wakeup_out)
+
+    def _submit(self, group, weight, func, args):
+        with self.lock:
+            if self.closed:
+                raise Exception("Worker pool is closed")
+            group.num_submitted += 1
+            heapq.heappush(self.pending, (-weight, next(self.task_counter),
+                                          group, func, args))
+        self._wakeup()
+
+    def _cancel(self, group):
+        """
+        Removes the pending tasks of the group
+        and terminates its running tasks
+        """
+        with self.lock:
+            group.cancelled = True
+            self.pending = [t for t in self.pending if t[2] is not group]
+            heapq.heapify(self.pending)
+            for worker_id, running_group in enumerate(self.running):
+                if running_group is group:
+                    self.workers[worker_id].terminate()
+
+    def _wakeup(self):
+        try:
+            os.write(self.wakeup_out, b"x")
+        except OSError as e:
+            #the pipe is full, so the dispatcher will wake up anyway
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _dispatch(self):
+        """
+        If the dispatcher fails, the pool is closed and all
+        running and pending task groups receive the error
+        """
+        try:
+            self._dispatch_loop()
+        except Exception as e:
+            logger.error("Worker pool dispatcher failed: %s", str(e))
+            self._fail_all((e, traceback.format_exc()))
+
+    def _dispatch_loop(self):
+        while True:
+            self._assign_tasks()
+            with self.lock:
+                if self.closed:
+                    return
+            connections = [conn for conn, alive in
+                           zip(self.connections, self.alive) if alive]
+            ready, _, _ = select.select([self.wakeup_in] + connections,
+                                        [], [], _WAIT_INTERVAL)
+            for handle in ready:
+                if handle == self.wakeup_in:
+                    os.read(self.wakeup_in, 4096)
+                else:
+                    self._receive(self.connections.index(handle))
+
+    def _fail_all(self, error):
+        with self.lock:
+            self.closed = True
+            groups = []
+            for group in self.running + [t[2] for t in self.pending]:
+                if group is not None and group not in groups:
+                    groups.append(group)
+            self.pending = []
+            self.running = [None] * self.num_workers
+        for group in groups:
+            if not group.cancelled:
+                group.results_queue.put((_ERROR, error))
+
+    def _assign_tasks(self):
+        """
+        Sends pending tasks to idle workers, at most max_workers
+        tasks of each group are running at the same time
+        """
+        assigned = []
+        with self.lock:
+            for worker_id in range(self.num_workers):
+                if (self.running[worker_id] is not None or
+                        not self.alive[worker_id]):
+                    continue
+                task = self._next_task()
+                if task is None:
+                    break
+                group, func, args = task
+                group.num_running += 1
+                self.running[worker_id] = group
+                assigned.append((worker_id, func, args, group.quiet))
+
+        for worker_id, func, args, quiet in assigned:
+            try:
+                self.connections[worker_id].send((func, args, quiet))
+            except Exception as e:
+                self._finish_task(worker_id, _ERROR,
+                                  (e, traceback.format_exc()))
+
+    def _next_task(self):
+        """
+        The heaviest pending task of a group that can run one more task
+        """
+        skipped = []
+        task = None
+        while self.pending:
+            candidate = heapq.heappop(self.pending)
+            _, _, group, func, args = candidate
+            if group.num_running < group.max_workers:
+                task = group, func, args
+                break
+            skipped.append(candidate)
+        for candidate in skipped:
+            heapq.heappush(self.pending, candidate)
+        return task
+
+    def _receive(self, worker_id):
+        cpu_time = 0
+        usage = None
+        profile = None
+        try:
+            (msg_type, cpu_time, usage, profile), payload = \
+                recv_message(self.connections[worker_id])
+        except (EOFError, IOError, OSError):
+            worker = self.workers[worker_id]
+            worker.join()
+            if worker.exitcode == -9:
+                logger.error("Looks like the system ran out of memory")
+            error = Exception("One of the processes exited with code: {0}"
+                              .format(worker.exitcode))
+            self.connections[worker_id].close()
+            self.connections[worker_id] = _ClosedConnection()
+            with self.lock:
+                self.alive[worker_id] = False
+            msg_type, payload = _ERROR, (error, "")
+        except Exception as e:
+            msg_type, payload = _ERROR, (e, traceback.format_exc())
+        self._finish_task(worker_id, msg_type, payload, cpu_time, usage,
+                          profile)
+
+        if not any(self.alive):
+            self._fail_all((Exception("All worker processes have exited"),
+                            ""))
+
+    def _finish_task(self, worker_id, msg_type, payload, cpu_time=0,
+                     usage=None, profile=None):
+        with self.lock:
+            group = self.running[worker_id]
+            self.running[worker_id] = None
+            if group is None:
+                return
+            group.num_running -= 1
+            group.cpu_time += cpu_time
+        if usage is not None:
+            telemetry.add_worker_usage(group.stage, *usage)
+        if profile is not None:
+            stage_name = group.stage.name if group.stage else None
+            profiling.add_task_stats(stage_name, worker_id, profile)
+        if group.cancelled:
+            return
+        group.results_queue.put((msg_type, payload))
+
+
+class TaskGroup(object):
+    """
+    Tasks submitted by a single stage, at most max_workers of them are
+    running at the same time. Results are returned in the order in which
+    the tasks are completed. The first task error is re-raised in the
+    main process, and the remaining tasks are cancelled
+    """
+    def __init__(self, pool, max_workers):
+        self.pool = pool
+        self.max_workers = max_workers
+        self.num_submitted = 0
+        self.num_received = 0
+        self.num_running = 0
+        self.cancelled = False
+        self.results_queue = queue.Queue()
+        #stage that receives the resource usage of the tasks
+        self.stage = telemetry.current_stage()
+        #tasks of a quiet call do not log either
+        self.quiet = log_scope.is_quiet()
+        #for the load balance report
+        self.start_time = None
+        self.end_time = None
+        self.cpu_time = 0
+
+    def submit(self, func, *args):
+        """
+        Runs func(*args) in one of the workers
+        """
+        self.submit_weighted(0, func, *args)
+
+    def submit_weighted(self, weight, func, *args):
+        """
+        Same as submit, but of all pending tasks the ones with the largest
+        weight (expected running time) are started first, so the long
+        tasks are not left until the end. Tasks of the same weight are
+        started in the submission order
+        """
+        if self.start_time is None:
+            self.start_time = time.time()
+        self.pool._submit(self, weight, func, args)
+
+    def log_balance(self, stage_name):
+        """
+        Reports the makespan (time from the first submitted task until the
+        last result) against the total CPU time of the tasks. Efficiency
+        is the fraction of the available worker time that was used
+        """
+        if self.start_time is None or self.end_time is None:
+            return
+        makespan = self.end_time - self.start_time
+        num_workers = min(self.max_workers, self.pool.num_workers)
+        efficiency = self.cpu_time / max(makespan * num_workers, 1e-9)
+        logger.debug("%s: %d tasks, makespan %.1f s, task CPU time %.1f s "
+                     "on %d workers, efficiency %.2f", stage_name,
+                     self.num_received, makespan, self.cpu_time,
+                     num_workers, efficiency)
+
+    def results(self):
+        """
+        Yields the results of all submitted tasks
+        """
+        while self.num_received < self.num_submitted:
+            msg_type, payload = self._next_result()
+            self.num_received += 1
+            self.end_time = time.time()
+            if msg_type == _ERROR:
+                error, worker_traceback = payload
+                if worker_traceback:
+                    logger.debug("Worker traceback:\n%s", worker_traceback)
+                self.cancel()
+                raise error
+            yield payload
+
+    def cancel(self):
+        self.pool._cancel(self)
+
+    def _next_result(self):
+        #waiting with timeout, so KeyboardInterrupt is not delayed
+        while True:
+            try:
+                return self.results_queue.get(timeout=_WAIT_INTERVAL)
+            except queue.Empty:
+                pass
+
+
+class _InlineTaskGroup(object):
+    """
+    Task group of a nested call within a worker task: the tasks are
+    run in the worker process itself, one by one, once their results
+    are requested. The parallelism comes from the outer tasks
+    """
+    def __init__(self):
+        self.pending = deque()
+
+    def submit(self, func, *args):
+        self.pending.append((func, args))
+
+    def submit_weighted(self, weight, func, *args):
+        self.submit(func, *args)
+
+    def results(self):
+        while self.pending:
+            func, args = self.pending.popleft()
+            yield func(*args)
+
+    def log_balance(self, stage_name):
+        pass
+
+    def cancel(self):
+        self.pending.clear()
+
+
+class _ClosedConnection(object):
+    """
+    Placeholder for the connection to a worker that has exited
+    """
+    def fileno(self):
+        return -1
+
+    def send(self, _):
+        raise IOError("Worker has exited")
+
+    def close(self):
+        pass
+
+
+def _worker_main(connection, pool, worker_id):
+    global _worker_process, _worker_id
+    _worker_process = True
+    _worker_id = worker_id
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pool._release_inherited()
+    telemetry.reset_process()
+    profiling.init_worker()
+
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            break
+        except Exception as e:
+            send_message(connection, (_ERROR, 0, None, None),
+                         (e, traceback.format_exc()))
+            continue
+        if task is None:
+            break
+
+        func, args, quiet = task
+        start_times = os.times()
+        meter = telemetry.TaskMeter()
+        profiler = profiling.start_task()
+        try:
+            with log_scope.quiet(quiet):
+                msg_type, payload = _RESULT, func(*args)
+        except Exception as e:
+            msg_type, payload = _ERROR, (e, traceback.format_exc())
+        profile = profiling.finish_task(profiler)
+        end_times = os.times()
+        cpu_time = sum(end_times[:2]) - sum(start_times[:2])
+        usage = meter.finish()
+        try:
+            send_message(connection, (msg_type, cpu_time, usage, profile),
+                         payload)
+        except Exception as e:
+            send_message(connection, (_ERROR, cpu_time, usage, profile),
+                         (Exception(str(e)), traceback.format_exc()))
+
+
+def current_worker_id():
+    """
+    Index of the current worker in its pool,
+    None outside of the workers
+    """
+    return _worker_id
+
+
+def start_pool(num_workers):
+    """
+    Starts the pipeline-wide pool, which will be used by
+    task_group() calls from this process
+    """
+    global _pipeline_pool
+    _pipeline_pool = WorkerPool(num_workers)
+
+
+def stop_pool(terminate=False):
+    global _pipeline_pool
+    if _pipeline_pool is not None:
+        _pipeline_pool.close(terminate)
+        _pipeline_pool = None
+
+
+@contextmanager
+def task_group(num_workers):
+    """
+    Returns a task group with at most num_workers parallel tasks.
+    Tasks run in the pipeline-wide pool, or in a temporary pool if it
+    was not started. Within a worker task, no new processes are forked,
+    and the tasks run inline in the worker.
+    Unfinished tasks are cancelled if the block exits with an exception
+    """
+    if _worker_process:
+        group = _InlineTaskGroup()
+        try:
+            yield group
+        except BaseException:
+            group.cancel()
+            raise
+        return
+
+    pool = _pipeline_pool
+    temporary = pool is None
+    if temporary:
+        pool = WorkerPool(num_workers)
+
+    group = TaskGroup(pool, num_workers)
+    try:
+        yield group
+    except BaseException:
+        group.cancel()
+        if temporary:
+            pool.close(terminate=True)
+        raise
+    if temporary:
+        pool.close()
@@ -13,19 +13,23 @@
 bool parseArgs(int argc, char** argv, std::string& bubblesFile, 
 			   std::string& scoringMatrix, std::string& hopoMatrix,
 			   std::string& outConsensus, std::string& outVerbose,
-			   int& numThreads, bool& quiet)
+			   int& numThreads, bool& quiet, bool& streaming)
 {
 	auto printUsage = [argv]()
 	{
 		std::cerr << "Usage: flye-polish "
 				  << " --bubbles path --subs-mat path --hopo-mat size --out path\n"
-				  << "\t\t[--treads num] [--quiet] [--debug] [-h]\n\n"
+				  << "\t\t[--treads num] [--stream] [--quiet] [--debug] [-h]\n\n"
 				  << "Required arguments:\n"
-				  << "  --bubbles path\tpath to bubbles file\n"
+				  << "  --bubbles path\tpath to bubbles file "
+				  << "(text or binary, or a list of bubble files)\n"
 				  << "  --subs-mat path\tpath to substitution matrix\n"
 				  << "  --hopo-mat size\tpath to homopolymer matrix\n"
-				  << "  --out path\tpath to output file\n\n"
+				  << "  --out path\tpath to output file "
+				  << "(in the same format as bubbles)\n\n"
 				  << "Optional arguments:\n"
+				  << "  --stream \t\tread bubbles from a pipe, while "
+				  << "they are being generated [default = false] \n"
 				  << "  --quiet \t\tno terminal output "
 				  << "[default = false] \n"
 				  << "  --debug \t\textra debug output "
@@ -44,6 +48,7 @@ bool parseArgs(int argc, char** argv, std::string& bubblesFile,
 		{"threads", required_argument, 0, 0},
 		{"debug", no_argument, 0, 0},
 		{"quiet", no_argument, 0, 0},
+		{"stream", no_argument, 0, 0},
 		{0, 0, 0, 0}
 	};
 
@@ -59,6 +64,8 @@ bool parseArgs(int argc, char** argv, std::string& bubblesFile,
 				outVerbose = true;
 			else if (!strcmp(longOptions[optionIndex].name, "quiet"))
 				quiet = true;
+			else if (!strcmp(longOptions[optionIndex].name, "stream"))
+				streaming = true;
 			else if (!strcmp(longOptions[optionIndex].name, "bubbles"))
 				bubblesFile = optarg;
 			else if (!strcmp(longOptions[optionIndex].name, "subs-mat"))
@@ -93,15 +100,16 @@ int main(int argc, char* argv[])
 	std::string outVerbose;
 	int  numThreads = 1;
 	bool quiet = false;
+	bool streaming = false;
 	if (!parseArgs(argc, argv, bubblesFile, scoringMatrix, 
 				   hopoMatrix, outConsensus, outVerbose, numThreads,
-				   quiet))
+				   quiet, streaming))
 		return 1;
 
 	BubbleProcessor bp(scoringMatrix, hopoMatrix, !quiet);
 	if (!outVerbose.empty())
 		bp.enableVerboseOutput(outVerbose);
-	bp.polishAll(bubblesFile, outConsensus, numThreads); 
+	bp.polishAll(bubblesFile, outConsensus, numThreads, streaming); 
 
 	return 0;
 }
@@ -10,12 +10,129 @@
 
 namespace
 {
+	//binary records format, see flye/polishing/binary_records.py
+	const std::string BUBBLES_MAGIC = "FLYEBUB1";
+	const std::string CONSENSUS_MAGIC = "FLYECNS1";
+	const char BUBBLE_TAG = 'B';
+	const char CONSENSUS_TAG = 'C';
+	const char INDEX_TAG = 'I';
+
+	//integers are little-endian, regardless of the platform
+	template <class T>
+	T readInt(std::istream& stream)
+	{
+		unsigned char buffer[sizeof(T)];
+		if (!stream.read((char*)buffer, sizeof(T)))
+		{
+			throw std::runtime_error("Error parsing bubbles file");
+		}
+		uint64_t value = 0;
+		for (int i = sizeof(T) - 1; i >= 0; --i) value = (value << 8) | buffer[i];
+		return (T)value;
+	}
+
+	std::string readString(std::istream& stream)
+	{
+		uint32_t length = readInt<uint32_t>(stream);
+		std::string str(length, '\0');
+		if (length > 0 && !stream.read(&str[0], length))
+		{
+			throw std::runtime_error("Error parsing bubbles file");
+		}
+		return str;
+	}
+
+	//bubble sequences are either raw, or 2 bits per base
+	std::string readSequence(std::istream& stream)
+	{
+		const char TWO_BIT = 1;
+		const std::string NUCL = "ACGT";
+
+		uint32_t length = readInt<uint32_t>(stream);
+		char encoding = 0;
+		if (!stream.get(encoding))
+		{
+			throw std::runtime_error("Error parsing bubbles file");
+		}
+		size_t payloadSize = encoding == TWO_BIT ? (length + 3) / 4 : length;
+		std::string payload(payloadSize, '\0');
+		if (payloadSize > 0 && !stream.read(&payload[0], payloadSize))
+		{
+			throw std::runtime_error("Error parsing bubbles file");
+		}
+		if (encoding != TWO_BIT) return payload;
+
+		std::string seq(length, 'A');
+		for (size_t i = 0; i < length; ++i)
+		{
+			seq[i] = NUCL[((unsigned char)payload[i / 4] >> (2 * (i % 4))) & 3];
+		}
+		return seq;
+	}
+
+	template <class T>
+	void writeInt(std::ostream& stream, T value)
+	{
+		uint64_t bytes = (uint64_t)value;
+		for (size_t i = 0; i < sizeof(T); ++i)
+		{
+			stream.put((char)(bytes & 0xff));
+			bytes >>= 8;
+		}
+	}
+
+	void writeString(std::ostream& stream, const std::string& str)
+	{
+		writeInt<uint32_t>(stream, str.size());
+		stream.write(str.data(), str.size());
+	}
+
+	bool hasMagic(std::istream& stream, const std::string& magic)
+	{
+		std::string buffer(magic.size(), '\0');
+		stream.read(&buffer[0], magic.size());
+		return stream.gcount() == (std::streamsize)magic.size() &&
+			   buffer == magic;
+	}
+
 	size_t fileSize(const std::string& filename)
 	{
 		struct stat st;
 		if (stat(filename.c_str(), &st) != 0) return 0;
 		return st.st_size;
 	}
+
+	//the input is either a bubbles file, or a manifest that lists
+	//bubble files (shards), relative to the manifest location
+	std::vector<std::string> getBubbleFiles(const std::string& inBubbles)
+	{
+		std::ifstream inStream(inBubbles);
+		if (!inStream.is_open())
+		{
+			throw std::runtime_error("Error opening bubbles file");
+		}
+		if (inStream.peek() == '>') return {inBubbles};
+		if (hasMagic(inStream, BUBBLES_MAGIC)) return {inBubbles};
+		inStream.clear();
+		inStream.seekg(0);
+
+		std::string manifestDir;
+		size_t slashPos = inBubbles.rfind('/');
+		if (slashPos != std::string::npos)
+		{
+			manifestDir = inBubbles.substr(0, slashPos + 1);
+		}
+
+		std::vector<std::string> bubbleFiles;
+		std::string buffer;
+		while (std::getline(inStream, buffer))
+		{
+			if (buffer.empty()) continue;
+			bubbleFiles.push_back(buffer[0] == '/' ? buffer :
+								  manifestDir + buffer);
+		}
+		return bubbleFiles;
+	}
 }
 
 BubbleProcessor::BubbleProcessor(const std::string& subsMatPath,
@@ -26,6 +143,9 @@ BubbleProcessor::BubbleProcessor(const std::string& subsMatPath,
 	_generalPolisher(_subsMatrix),
 	_homoPolisher(_subsMatrix, _hopoMatrix),
 	_dinucFixer(_subsMatrix),
+	_binaryInput(false),
+	_binaryOutput(false),
+	_streaming(false),
 	_verbose(false),
 	_showProgress(showProgress)
 {
@@ -34,29 +154,47 @@ BubbleProcessor::BubbleProcessor(const std::string& subsMatPath,
 
 void BubbleProcessor::polishAll(const std::string& inBubbles, 
 								const std::string& outConsensus,
-			   					int numThreads)
+			   					int numThreads, bool streaming)
 {
 	_cachedBubbles.clear();
 	_cachedBubbles.reserve(BUBBLES_CACHE);
 
-	size_t fileLength = fileSize(inBubbles);
-	if (!fileLength)
+	//a stream (pipe) is read until it is closed by the writer,
+	//so its size is not known in advance
+	_streaming = streaming;
+	_nextFile = 0;
+	_processedBytes = 0;
+	if (_streaming)
 	{
-		throw std::runtime_error("Empty bubbles file!");
+		_bubbleFiles = {inBubbles};
+		_showProgress = false;
 	}
-	_bubblesFile.open(inBubbles);
-	if (!_bubblesFile.is_open())
+	else
 	{
-		throw std::runtime_error("Error opening bubbles file");
+		if (!fileSize(inBubbles))
+		{
+			throw std::runtime_error("Empty bubbles file!");
+		}
+		_bubbleFiles = getBubbleFiles(inBubbles);
+		size_t totalLength = 0;
+		for (auto& bubblesFile : _bubbleFiles) totalLength += fileSize(bubblesFile);
+		if (!totalLength)
+		{
+			throw std::runtime_error("Empty bubbles file!");
+		}
+		_progress.setFinalCount(totalLength);
 	}
+	this->openNextFile();
 
-	_progress.setFinalCount(fileLength);
-
-	_consensusFile.open(outConsensus);
+	//consensus is written in the same format as the input bubbles
+	_binaryOutput = _binaryInput;
+	_consensusOffsets.clear();
+	_consensusFile.open(outConsensus, std::ios::binary);
 	if (!_consensusFile.is_open())
 	{
 		throw std::runtime_error("Error opening consensus file");
 	}
+	if (_binaryOutput) _consensusFile << CONSENSUS_MAGIC;
 
 	std::vector<std::thread> threads(numThreads);
 	for (size_t i = 0; i < threads.size(); ++i)
@@ -67,6 +205,8 @@ void BubbleProcessor::polishAll(const std::string& inBubbles,
 	{
 		threads[i].join();
 	}
+	//the index is not written into a stream, as it is not seekable
+	if (_binaryOutput && !_streaming) this->writeConsensusIndex();
 	if (_showProgress) _progress.setDone();
 }
 
@@ -111,12 +251,32 @@ void BubbleProcessor::writeBubbles(const std::vector<Bubble>& bubbles)
 {
 	for (auto& bubble : bubbles)
 	{
+		if (_binaryOutput)
+		{
+			if (!_streaming) _consensusOffsets.push_back(_consensusFile.tellp());
+			_consensusFile.put(CONSENSUS_TAG);
+			writeString(_consensusFile, bubble.header);
+			writeInt<int64_t>(_consensusFile, bubble.position);
+			writeInt<uint32_t>(_consensusFile, bubble.branches.size());
+			writeString(_consensusFile, bubble.candidate);
+			continue;
+		}
 		_consensusFile << ">" << bubble.header << " " << bubble.position
 			 		   << " " << bubble.branches.size() << std::endl
 			 		   << bubble.candidate << std::endl;
 	}
 }
 
+void BubbleProcessor::writeConsensusIndex()
+{
+	_consensusFile.put(INDEX_TAG);
+	writeInt<uint64_t>(_consensusFile, _consensusOffsets.size());
+	for (uint64_t offset : _consensusOffsets)
+	{
+		writeInt<uint64_t>(_consensusFile, offset);
+	}
+}
+
 void BubbleProcessor::enableVerboseOutput(const std::string& filename)
 {
 	_verbose = true;
@@ -149,56 +309,128 @@ void BubbleProcessor::writeLog(const std::vector<Bubble>& bubbles)
 }
 
 
-void BubbleProcessor::cacheBubbles(int maxRead)
+bool BubbleProcessor::openNextFile()
 {
-	std::string buffer;
-	std::string candidate;
+	if (_bubblesFile.is_open())
+	{
+		_processedBytes += fileSize(_bubbleFiles[_nextFile - 1]);
+		_bubblesFile.close();
+	}
+	if (_nextFile == _bubbleFiles.size()) return false;
 
-	int readBubbles = 0;
-	while (!_bubblesFile.eof() && readBubbles < maxRead)
+	_bubblesFile.clear();
+	_bubblesFile.open(_bubbleFiles[_nextFile++], std::ios::binary);
+	if (!_bubblesFile.is_open())
 	{
-		std::getline(_bubblesFile, buffer);
-		if (buffer.empty()) break;
+		throw std::runtime_error("Error opening bubbles file");
+	}
+	//peeking, as the stream might not be seekable
+	_binaryInput = _bubblesFile.peek() == BUBBLES_MAGIC[0];
+	if (_binaryInput && !hasMagic(_bubblesFile, BUBBLES_MAGIC))
+	{
+		throw std::runtime_error("Error parsing bubbles file");
+	}
+	return true;
+}
 
-		std::vector<std::string> elems = splitString(buffer, ' ');
-		if (elems.size() < 3 || elems[0][0] != '>')
-		{
-			throw std::runtime_error("Error parsing bubbles file");
-		}
-		std::getline(_bubblesFile, candidate);
-		std::transform(candidate.begin(), candidate.end(), 
-				       candidate.begin(), ::toupper);
-		
-		Bubble bubble;
-		bubble.candidate = candidate;
-		bubble.header = elems[0].substr(1, std::string::npos);
-		bubble.position = std::stoi(elems[1]);
-		int numOfReads = std::stoi(elems[2]);
 
-		int count = 0;
-		while (count < numOfReads) 
+void BubbleProcessor::cacheBubbles(int maxRead)
+{
+	int readBubbles = 0;
+	while (readBubbles < maxRead)
+	{
+		//proceeding to the next shard, if the current one is done
+		if (_bubblesFile.eof() || !_bubblesFile.is_open())
 		{
-			if (buffer.empty()) break;
-
-			std::getline(_bubblesFile, buffer);
-			std::getline(_bubblesFile, buffer);
-			std::transform(buffer.begin(), buffer.end(), 
-				       	   buffer.begin(), ::toupper);
-			bubble.branches.push_back(buffer);
-			count++;
+			if (!this->openNextFile()) break;
 		}
-		if (count != numOfReads)
+
+		Bubble bubble;
+		bool hasBubble = _binaryInput ? this->readBinaryBubble(bubble) :
+										this->readTextBubble(bubble);
+		if (!hasBubble)
 		{
-			throw std::runtime_error("Error parsing bubbles file");
+			if (!this->openNextFile()) break;
+			continue;
 		}
 
 		_cachedBubbles.push_back(std::move(bubble));
 		++readBubbles;
 	}
 
-	int64_t filePos = _bubblesFile.tellg();
-	if (_showProgress && filePos > 0)
+	int64_t filePos = _bubblesFile.is_open() ? (int64_t)_bubblesFile.tellg() : 0;
+	if (_showProgress && filePos >= 0)
+	{
+		_progress.setValue(_processedBytes + filePos);
+	}
+}
+
+
+bool BubbleProcessor::readTextBubble(Bubble& bubble)
+{
+	std::string buffer;
+	std::string candidate;
+
+	std::getline(_bubblesFile, buffer);
+	if (buffer.empty()) return false;
+
+	std::vector<std::string> elems = splitString(buffer, ' ');
+	if (elems.size() < 3 || elems[0][0] != '>')
+	{
+		throw std::runtime_error("Error parsing bubbles file");
+	}
+	std::getline(_bubblesFile, candidate);
+	std::transform(candidate.begin(), candidate.end(), 
+				   candidate.begin(), ::toupper);
+	
+	bubble.candidate = candidate;
+	bubble.header = elems[0].substr(1, std::string::npos);
+	bubble.position = std::stoi(elems[1]);
+	int numOfReads = std::stoi(elems[2]);
+
+	int count = 0;
+	while (count < numOfReads) 
+	{
+		if (buffer.empty()) break;
+
+		std::getline(_bubblesFile, buffer);
+		std::getline(_bubblesFile, buffer);
+		std::transform(buffer.begin(), buffer.end(), 
+					   buffer.begin(), ::toupper);
+		bubble.branches.push_back(buffer);
+		count++;
+	}
+	if (count != numOfReads)
+	{
+		throw std::runtime_error("Error parsing bubbles file");
+	}
+	return true;
+}
+
+
+bool BubbleProcessor::readBinaryBubble(Bubble& bubble)
+{
+	char tag = 0;
+	if (!_bubblesFile.get(tag) || tag == INDEX_TAG) return false;
+	if (tag != BUBBLE_TAG)
+	{
+		throw std::runtime_error("Error parsing bubbles file");
+	}
+
+	bubble.header = readString(_bubblesFile);
+	bubble.position = readInt<int64_t>(_bubblesFile);
+	uint32_t numOfReads = readInt<uint32_t>(_bubblesFile);
+	bubble.candidate = readSequence(_bubblesFile);
+	std::transform(bubble.candidate.begin(), bubble.candidate.end(), 
+				   bubble.candidate.begin(), ::toupper);
+
+	bubble.branches.reserve(numOfReads);
+	for (uint32_t i = 0; i < numOfReads; ++i)
 	{
-		_progress.setValue(filePos);
+		bubble.branches.push_back(readSequence(_bubblesFile));
+		std::transform(bubble.branches.back().begin(),
+					   bubble.branches.back().end(), 
+					   bubble.branches.back().begin(), ::toupper);
 	}
+	return true;
 }
@@ -26,13 +26,17 @@ public:
 					const std::string& hopoMatrixPath,
 					bool  showProgress);
 	void polishAll(const std::string& inBubbles, const std::string& outConsensus,
-				   int numThreads);
+				   int numThreads, bool streaming = false);
 	void enableVerboseOutput(const std::string& filename);
 
 private:
 	void parallelWorker();
 	void cacheBubbles(int numBubbles);
+	bool readTextBubble(Bubble& bubble);
+	bool readBinaryBubble(Bubble& bubble);
+	bool openNextFile();
 	void writeBubbles(const std::vector<Bubble>& bubbles);
+	void writeConsensusIndex();
 	void writeLog(const std::vector<Bubble>& bubbles);
 
 	const int BUBBLES_CACHE = 100;
@@ -47,8 +51,15 @@ private:
 	std::mutex				  _stateMutex;
 	std::vector<Bubble>		  _cachedBubbles;
 
+	std::vector<std::string>  _bubbleFiles;
+	size_t					  _nextFile;
+	size_t					  _processedBytes;
 	std::ifstream			  _bubblesFile;
 	std::ofstream			  _consensusFile;
+	std::vector<uint64_t>	  _consensusOffsets;
+	bool					  _binaryInput;
+	bool					  _binaryOutput;
+	bool					  _streaming;
 	std::ofstream			  _logFile;
 	bool					  _verbose;
 	bool 					  _showProgress;